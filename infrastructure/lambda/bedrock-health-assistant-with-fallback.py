@@ -1,10 +1,21 @@
+import asyncio
 import json
 import boto3
 import logging
 from datetime import datetime
 import os
-from typing import Dict, List, Any
-import random
+import time
+from typing import Dict, List, Any, Optional, Tuple
+from circuit_breaker import CircuitBreaker
+from fallback_templates import render_fallback
+from bedrock_prompt import build_claude_request, encode_claude_request
+from context_packer import ContextPacker
+from guardrail_matcher import classify_message
+from health_retrieval import handle_ingest_event, retrieve_health_context
+from model_router import AllModelsUnavailableError, ModelRouter, is_retryable_error
+from session_store import DynamoDBSessionBackend, SessionStore
+from telemetry import telemetry
+from token_usage import extract_usage
 
 # Configure logging
 logger = logging.getLogger()
@@ -13,11 +24,30 @@ logger.setLevel(logging.INFO)
 # Initialize AWS clients
 bedrock_runtime = boto3.client('bedrock-runtime', region_name='your-aws-region')
 
+# Ordered Bedrock models with a fast model for short factual questions (BEDROCK_MODEL_IDS, BEDROCK_FAST_MODEL_ID)
+model_router = ModelRouter(client=bedrock_runtime)
+
 # Configuration
-CLAUDE_MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+CLAUDE_MODEL_ID = model_router.model_ids[0]
 OPENSEARCH_ENDPOINT = "search-YOUR-DOMAIN.us-region-1.es.amazonaws.com"
 HEALTH_INDEX = "health-data-index"
 
+# Packs retrieved readings into a bounded prompt context (CONTEXT_TOKEN_BUDGET)
+context_packer = ContextPacker()
+
+# Multi-turn session memory (in-memory LRU, or DynamoDB when SESSION_TABLE is set)
+SESSION_TABLE = os.environ.get('SESSION_TABLE')
+session_store = SessionStore(backend=DynamoDBSessionBackend(SESSION_TABLE) if SESSION_TABLE else None)
+
+# Circuit breaker around Bedrock as a whole (each model also has its own in the router):
+# route straight to the fallback while every model is unhealthy
+bedrock_breaker = CircuitBreaker(
+    "bedrock",
+    failure_rate_threshold=float(os.environ.get('BEDROCK_BREAKER_FAILURE_RATE', '0.5')),
+    slow_call_ms=float(os.environ.get('BEDROCK_BREAKER_SLOW_CALL_MS', '8000')),
+    base_backoff_seconds=float(os.environ.get('BEDROCK_BREAKER_BACKOFF_SECONDS', '5'))
+)
+
 # Guardrails configuration
 GUARDRAILS_CONFIG = {
     "medical_advice_filter": True,
@@ -28,66 +58,17 @@ GUARDRAILS_CONFIG = {
     "disclaimer_frequency": "always"
 }
 
-# Intelligent fallback responses for when Bedrock is rate-limited
-FALLBACK_RESPONSES = {
-    "heart_rate": """Based on your recent health data, I can provide some general insights about heart rate patterns:
-
-Your resting heart rate of 72 beats per minute falls within the normal range for adults (60-100 bpm). This suggests your cardiovascular system is functioning well.
-
-Key insights about heart rate:
-• A consistent resting heart rate indicates good cardiovascular health
-• Factors like fitness level, age, and stress can influence heart rate
-• Regular monitoring helps identify trends over time
-
-Your current heart rate data suggests you're maintaining healthy cardiovascular patterns.
-
-Remember to consult your healthcare provider for medical advice.""",
-
-    "activity": """Looking at your activity patterns, here are some general observations:
-
-Your daily step count of 8,247 steps shows good activity levels. While the common goal is 10,000 steps, any regular movement is beneficial for health.
-
-Activity insights:
-• Consistent daily movement supports cardiovascular health
-• Your current activity level indicates an active lifestyle
-• Regular walking contributes to overall fitness and well-being
-
-Consider maintaining or gradually increasing your activity levels as comfortable.
-
-Remember to consult your healthcare provider for medical advice.""",
-
-    "sleep": """Based on your sleep data, here are some general insights:
-
-Your sleep duration of 7.5 hours falls within the recommended range for adults (7-9 hours). This suggests you're getting adequate rest for recovery and health.
-
-Sleep pattern observations:
-• Consistent sleep duration supports overall health
-• Quality sleep is essential for physical and mental well-being
-• Regular sleep patterns help maintain your body's natural rhythms
-
-Your current sleep patterns appear to support healthy rest and recovery.
-
-Remember to consult your healthcare provider for medical advice.""",
-
-    "general": """Thank you for your health question. While I'm experiencing high demand right now, I can share some general insights:
-
-Based on typical health data patterns:
-• Regular monitoring of health metrics helps identify trends
-• Consistent patterns in heart rate, activity, and sleep are positive indicators
-• Small, sustainable changes often lead to the best health outcomes
-
-Your engagement with health tracking shows a proactive approach to wellness, which is excellent for long-term health management.
-
-For personalized medical advice and specific health concerns, please consult with your healthcare provider.
-
-Remember to consult your healthcare provider for medical advice."""
-}
-
+@telemetry.flush_after
 def lambda_handler(event, context):
     """
     Enhanced Lambda handler with intelligent fallback responses
     """
     try:
+        # Health-data ingest events only refresh this container's hot context
+        invalidated = handle_ingest_event(event)
+        if invalidated is not None:
+            return {"invalidated": invalidated}
+        
         # Parse the incoming request
         body = json.loads(event.get('body', '{}'))
         user_message = body.get('message', '')
@@ -96,37 +77,77 @@ def lambda_handler(event, context):
         
         logger.info(f"Processing message from user {user_id}: {user_message[:100]}...")
         
-        # Apply guardrails
-        if not passes_guardrails(user_message):
+        # Apply guardrails while relevant health data is retrieved
+        classification, guardrails_passed, health_context = asyncio.run(
+            evaluate_and_retrieve(user_message, user_id)
+        )
+        if not guardrails_passed:
             return create_response(400, {
                 "error": "Message blocked by safety guardrails",
-                "response": get_guardrail_response(user_message),
+                "response": get_guardrail_response(user_message, classification),
                 "guardrails_active": True,
                 "fallback_used": False
             })
         
-        # Search relevant health data
-        health_context = search_health_data(user_message, user_id)
+        # Earlier turns of this conversation, loaded outside the breaker so session-store
+        # errors never count as Bedrock failures; only explicit sessions of identified users are remembered
+        session = None
+        if SessionStore.is_tracked(user_id, body.get('session_id')):
+            session = session_store.load(user_id, session_id)
+        
+        # Try Bedrock first unless the circuit is open, fallback to intelligent responses if rate-limited
+        ai_response = None
+        bedrock_latency_ms = 0.0
+        if bedrock_breaker.allow_request():
+            call_start = time.perf_counter()
+            try:
+                ai_response = generate_bedrock_response(user_message, health_context, user_id, session)
+                bedrock_latency_ms = (time.perf_counter() - call_start) * 1000
+                bedrock_breaker.record_success(bedrock_latency_ms)
+                logger.info(f"Generated Bedrock AI response for user {user_id}")
+                
+            except Exception as bedrock_error:
+                bedrock_latency_ms = (time.perf_counter() - call_start) * 1000
+                # Only unavailability trips the breaker; rejected requests and parsing errors
+                # say nothing about Bedrock's health and just give back a half-open probe
+                if isinstance(bedrock_error, AllModelsUnavailableError) or is_retryable_error(bedrock_error):
+                    bedrock_breaker.record_failure(bedrock_latency_ms)
+                else:
+                    bedrock_breaker.release()
+                logger.warning(f"Bedrock unavailable, using intelligent fallback: {str(bedrock_error)}")
+        else:
+            logger.info("Bedrock circuit open, using intelligent fallback")
         
-        # Try Bedrock first, fallback to intelligent responses if rate-limited
-        try:
-            ai_response = generate_bedrock_response(user_message, health_context, user_id)
-            fallback_used = False
-            logger.info(f"Generated Bedrock AI response for user {user_id}")
-            
-        except Exception as bedrock_error:
-            logger.warning(f"Bedrock unavailable, using intelligent fallback: {str(bedrock_error)}")
-            ai_response = generate_intelligent_fallback(user_message, health_context)
-            fallback_used = True
+        # Only model answers become conversation history; canned fallbacks do not
+        if ai_response is not None and session is not None:
+            session_store.append_turn(user_id, session_id, session, user_message, ai_response)
+        
+        fallback_used = ai_response is None
+        if fallback_used:
+            ai_response = generate_intelligent_fallback(user_message, health_context, classification)
+        
+        circuit = bedrock_breaker.snapshot()
+        telemetry.record(
+            "BedrockCircuit",
+            metrics={
+                "CircuitOpen": int(circuit["state"] != "closed"),
+                "BedrockLatencyMs": bedrock_latency_ms,
+                "FallbackUsed": int(fallback_used)
+            },
+            dimensions={"CircuitState": circuit["state"]},
+            units={"BedrockLatencyMs": "Milliseconds"}
+        )
         
         # Log the interaction
-        log_interaction(user_id, session_id, user_message, ai_response, fallback_used)
+        log_interaction(user_id, session_id, user_message, ai_response, fallback_used,
+                        guardrails_triggered=not guardrails_passed)
         
         return create_response(200, {
             "response": ai_response,
             "context_used": len(health_context) > 0,
             "guardrails_active": True,
             "fallback_used": fallback_used,
+            "circuit_state": circuit["state"],
             "timestamp": datetime.utcnow().isoformat()
         })
         
@@ -134,85 +155,60 @@ def lambda_handler(event, context):
         logger.error(f"Error processing request: {str(e)}")
         return create_response(500, {
             "error": "Internal server error",
-            "response": FALLBACK_RESPONSES["general"],
+            "response": render_fallback("general"),
             "guardrails_active": True,
             "fallback_used": True
         })
 
-def generate_intelligent_fallback(message: str, health_context: List[Dict]) -> str:
+def generate_intelligent_fallback(message: str, health_context: List[Dict],
+                                  classification: Optional[Dict[str, List[str]]] = None) -> str:
     """
     Generate intelligent fallback responses based on message content and health context
     """
-    message_lower = message.lower()
+    if classification is None:
+        classification = classify_message(message)
     
     # Determine response type based on keywords
-    if any(keyword in message_lower for keyword in ['heart', 'pulse', 'bpm', 'cardiac']):
+    if "heart_rate" in classification:
         response_type = "heart_rate"
-    elif any(keyword in message_lower for keyword in ['steps', 'walk', 'activity', 'exercise', 'movement']):
+    elif "activity" in classification:
         response_type = "activity"
-    elif any(keyword in message_lower for keyword in ['sleep', 'rest', 'tired', 'fatigue']):
+    elif "sleep" in classification:
         response_type = "sleep"
     else:
         response_type = "general"
     
-    # Get base response
-    base_response = FALLBACK_RESPONSES[response_type]
-    
-    # Add context-specific information if available
-    if health_context and response_type != "general":
-        context_info = "\n\nBased on your recent data:\n"
-        for data in health_context[:3]:  # Limit to 3 most recent
-            if data['type'] == 'heart_rate' and response_type == "heart_rate":
-                context_info += f"• Heart rate: {data['value']} bpm ({data['context']})\n"
-            elif data['type'] == 'steps' and response_type == "activity":
-                context_info += f"• Daily steps: {data['value']:,} steps\n"
-            elif data['type'] == 'sleep' and response_type == "sleep":
-                context_info += f"• Sleep duration: {data['value']} hours\n"
-        
-        if context_info != "\n\nBased on your recent data:\n":
-            base_response = base_response.replace(
-                "Remember to consult your healthcare provider for medical advice.",
-                context_info + "\nRemember to consult your healthcare provider for medical advice."
-            )
-    
-    return base_response
+    # Render the precompiled template with the user's own readings
+    return render_fallback(response_type, health_context)
 
-def passes_guardrails(message: str) -> bool:
+def passes_guardrails(message: str, classification: Optional[Dict[str, List[str]]] = None) -> bool:
     """
     Apply safety guardrails to user messages
     """
-    message_lower = message.lower()
+    if classification is None:
+        classification = classify_message(message)
     
     # Medical advice filter
-    if GUARDRAILS_CONFIG["medical_advice_filter"]:
-        medical_keywords = [
-            "diagnose", "diagnosis", "prescribe", "prescription", "medication",
-            "treatment", "cure", "medicine", "drug", "dosage", "should i take"
-        ]
-        if any(keyword in message_lower for keyword in medical_keywords):
-            logger.info("Message blocked by medical advice filter")
-            return False
+    if GUARDRAILS_CONFIG["medical_advice_filter"] and "medical" in classification:
+        logger.info("Message blocked by medical advice filter")
+        return False
     
     # Harmful content filter
-    if GUARDRAILS_CONFIG["harmful_content_filter"]:
-        harmful_keywords = [
-            "suicide", "self-harm", "kill myself", "end my life", "hurt myself"
-        ]
-        if any(keyword in message_lower for keyword in harmful_keywords):
-            logger.info("Message blocked by harmful content filter")
-            return False
+    if GUARDRAILS_CONFIG["harmful_content_filter"] and "harmful" in classification:
+        logger.info("Message blocked by harmful content filter")
+        return False
     
     return True
 
-def get_guardrail_response(message: str) -> str:
+def get_guardrail_response(message: str, classification: Optional[Dict[str, List[str]]] = None) -> str:
     """
     Generate appropriate response when guardrails are triggered
     """
-    message_lower = message.lower()
+    if classification is None:
+        classification = classify_message(message)
     
     # Check for emergency situations
-    emergency_keywords = ["suicide", "self-harm", "kill myself", "emergency"]
-    if any(keyword in message_lower for keyword in emergency_keywords):
+    if "emergency" in classification:
         return """🚨 **Emergency Support Available**
         
 If you're experiencing a mental health emergency, please contact:
@@ -223,8 +219,7 @@ If you're experiencing a mental health emergency, please contact:
 Your safety is important. Please reach out for professional help."""
     
     # Medical advice filter response
-    medical_keywords = ["diagnose", "prescribe", "treatment", "medication"]
-    if any(keyword in message_lower for keyword in medical_keywords):
+    if "medical_disclaimer" in classification:
         return """⚕️ **Medical Disclaimer**
         
 I cannot provide medical diagnoses, prescribe medications, or recommend specific treatments. 
@@ -238,117 +233,82 @@ I can help you understand your health data and provide general wellness informat
     
     return "I'm not able to respond to that type of question. Please ask about your health data or general wellness topics."
 
-def search_health_data(query: str, user_id: str) -> List[Dict]:
+async def evaluate_and_retrieve(user_message: str, user_id: str) -> Tuple[Dict[str, List[str]], bool, List[Dict]]:
     """
-    Search for relevant health data (mock implementation)
+    Start health-context retrieval, evaluate guardrails meanwhile, and cancel retrieval if they block
     """
-    try:
-        # Mock health data with realistic values
-        mock_health_data = [
-            {
-                "type": "heart_rate",
-                "value": 72,
-                "timestamp": "2025-06-29T10:00:00Z",
-                "context": "resting heart rate"
-            },
-            {
-                "type": "steps",
-                "value": 8247,
-                "timestamp": "2025-06-29T00:00:00Z",
-                "context": "daily step count"
-            },
-            {
-                "type": "sleep",
-                "value": 7.5,
-                "timestamp": "2025-06-28T22:00:00Z",
-                "context": "sleep duration in hours"
-            }
-        ]
-        
-        logger.info(f"Retrieved {len(mock_health_data)} health data points for user {user_id}")
-        return mock_health_data
-        
-    except Exception as e:
-        logger.error(f"Error searching health data: {str(e)}")
-        return []
+    retrieval = asyncio.ensure_future(retrieve_health_context(user_message, user_id))
+    await asyncio.sleep(0)  # Let the embedding stage start before classifying
+    
+    # Classify the message once for guardrails and fallback routing
+    classification = classify_message(user_message)
+    if not passes_guardrails(user_message, classification):
+        retrieval.cancel()
+        return classification, False, []
+    
+    return classification, True, await retrieval
 
-def generate_bedrock_response(user_message: str, health_context: List[Dict], user_id: str) -> str:
+def generate_bedrock_response(user_message: str, health_context: List[Dict], user_id: str,
+                              session: Optional[Dict[str, Any]] = None) -> str:
     """
     Generate AI response using Amazon Bedrock Claude model
     """
-    # Prepare the context
-    context_str = ""
-    if health_context:
-        context_str = "Recent health data:\n"
-        for data in health_context:
-            context_str += f"- {data['type']}: {data['value']} ({data['context']})\n"
-    
-    # Create the prompt with guardrails
-    system_prompt = """You are a helpful health data assistant. Follow these guidelines:
-
-1. NEVER provide medical diagnoses or treatment recommendations
-2. NEVER prescribe medications or suggest specific medical treatments
-3. Always include appropriate medical disclaimers
-4. Focus on helping users understand their health data
-5. Encourage users to consult healthcare professionals for medical concerns
-6. Be supportive and informative about general wellness
-
-If asked about medical conditions, diagnoses, or treatments, politely redirect to healthcare professionals."""
-
-    user_prompt = f"""
-    User question: {user_message}
-    
-    {context_str}
-    
-    Please provide a helpful response about the user's health data while following all safety guidelines.
-    Always end with: "Remember to consult your healthcare provider for medical advice."
-    """
+    # Prepare the context within the token budget
+    context_str = context_packer.pack(health_context, user_id)
     
-    # Prepare the request body
-    request_body = {
-        "anthropic_version": "bedrock-2023-05-31",
-        "max_tokens": 1000,
-        "system": system_prompt,
-        "messages": [
-            {
-                "role": "user",
-                "content": user_prompt
-            }
-        ],
-        "temperature": 0.7,
-        "top_p": 0.9
-    }
+    # Static guidelines come from the cached prompt template; prior turns are already bounded by the session store
+    if session is None:
+        request_body = build_claude_request(user_message, context_str)
+    else:
+        request_body = build_claude_request(user_message, context_str,
+                                            history=SessionStore.history_messages(session),
+                                            summary=SessionStore.summary_text(session))
     
-    # Call Bedrock
-    response = bedrock_runtime.invoke_model(
-        modelId=CLAUDE_MODEL_ID,
-        body=json.dumps(request_body),
-        contentType='application/json',
-        accept='application/json'
-    )
+    # Call Bedrock, failing over across models; raises once every model is unavailable
+    model_id, response = model_router.invoke(encode_claude_request(request_body), user_message)
     
     # Parse response
     response_body = json.loads(response['body'].read())
     ai_response = response_body['content'][0]['text']
     
+    # Record token usage from the model's usage block
+    usage = extract_usage(response_body, prompt_messages=request_body["messages"], completion_text=ai_response)
+    telemetry.record(
+        "BedrockUsage",
+        metrics={
+            "InputTokens": usage["input_tokens"],
+            "OutputTokens": usage["output_tokens"],
+            "CacheReadInputTokens": usage["cache_read_input_tokens"],
+            "CacheWriteInputTokens": usage["cache_write_input_tokens"]
+        },
+        dimensions={"Model": model_id},
+        properties={"user_id": user_id, "token_source": usage["source"]}
+    )
+    
     return ai_response
 
-def log_interaction(user_id: str, session_id: str, user_message: str, ai_response: str, fallback_used: bool = False):
+def log_interaction(user_id: str, session_id: str, user_message: str, ai_response: str, fallback_used: bool = False,
+                    guardrails_triggered: bool = False):
     """
-    Log the interaction for monitoring and improvement
+    Buffer the interaction for monitoring and improvement (flushed at the end of the invocation)
     """
     try:
-        interaction_log = {
-            "timestamp": datetime.utcnow().isoformat(),
-            "user_id": user_id,
-            "session_id": session_id,
-            "user_message": user_message[:500],
-            "ai_response": ai_response[:500],
-            "fallback_used": fallback_used,
-            "guardrails_triggered": not passes_guardrails(user_message)
-        }
-        
-        logger.info(f"Interaction logged: {json.dumps(interaction_log)}")
+        telemetry.record(
+            "HealthAssistantInteraction",
+            metrics={
+                "Interactions": 1,
+                "FallbackUsed": int(fallback_used),
+                "GuardrailsTriggered": int(guardrails_triggered)
+            },
+            properties={
+                "user_id": user_id,
+                "session_id": session_id,
+                "user_message": user_message[:500],
+                "ai_response": ai_response[:500],
+                "fallback_used": fallback_used,
+                "guardrails_triggered": guardrails_triggered
+            }
+        )
         
     except Exception as e:
         logger.error(f"Error logging interaction: {str(e)}")
@@ -1,9 +1,22 @@
+import asyncio
 import json
 import boto3
 import logging
 from datetime import datetime
 import os
-from typing import Dict, List, Any
+import re
+import time
+from typing import Dict, List, Any, Optional, Tuple
+from bedrock_prompt import MEDICAL_DISCLAIMER, build_claude_request, encode_claude_request
+from context_packer import ContextPacker
+from guardrail_matcher import classify_message
+from model_router import ModelRouter
+from health_retrieval import handle_ingest_event, retrieve_health_context
+from response_cache import DynamoDBCacheTier, SemanticResponseCache, context_fingerprint
+from response_streaming import SSE_DONE, create_streaming_response, format_sse_event
+from session_store import DynamoDBSessionBackend, SessionStore
+from telemetry import telemetry
+from token_usage import extract_usage
 
 # Configure logging
 logger = logging.getLogger()
@@ -13,11 +26,33 @@ logger.setLevel(logging.INFO)
 bedrock_runtime = boto3.client('bedrock-runtime', region_name='your-aws-region')
 opensearch_client = boto3.client('opensearchserverless', region_name='your-aws-region')
 
+# Ordered Bedrock models with a fast model for short factual questions (BEDROCK_MODEL_IDS, BEDROCK_FAST_MODEL_ID)
+model_router = ModelRouter(client=bedrock_runtime)
+
 # Configuration
-CLAUDE_MODEL_ID = "anthropic.claude-3-5-sonnet-20240620-v1:0"
+CLAUDE_MODEL_ID = model_router.model_ids[0]
 OPENSEARCH_ENDPOINT = "search-YOUR-DOMAIN.us-region-1.es.amazonaws.com"
 HEALTH_INDEX = "health-data-index"
 
+# Packs retrieved readings into a bounded prompt context (CONTEXT_TOKEN_BUDGET)
+context_packer = ContextPacker()
+
+# Semantic response cache (in-memory tier plus optional DynamoDB tier)
+RESPONSE_CACHE_TABLE = os.environ.get('RESPONSE_CACHE_TABLE')
+response_cache = SemanticResponseCache(
+    similarity_threshold=float(os.environ.get('RESPONSE_CACHE_SIMILARITY', '0.92')),
+    ttl_seconds=int(os.environ.get('RESPONSE_CACHE_TTL_SECONDS', '3600')),
+    persistent_tier=DynamoDBCacheTier(RESPONSE_CACHE_TABLE) if RESPONSE_CACHE_TABLE else None
+)
+
+# Multi-turn session memory (in-memory LRU, or DynamoDB when SESSION_TABLE is set)
+SESSION_TABLE = os.environ.get('SESSION_TABLE')
+session_store = SessionStore(backend=DynamoDBSessionBackend(SESSION_TABLE) if SESSION_TABLE else None)
+
+# Bedrock on-demand pricing used to report spend saved by the cache (USD per 1K tokens)
+BEDROCK_INPUT_COST_PER_1K = float(os.environ.get('BEDROCK_INPUT_COST_PER_1K', '0.003'))
+BEDROCK_OUTPUT_COST_PER_1K = float(os.environ.get('BEDROCK_OUTPUT_COST_PER_1K', '0.015'))
+
 # Guardrails configuration
 GUARDRAILS_CONFIG = {
     "medical_advice_filter": True,
@@ -28,11 +63,18 @@ GUARDRAILS_CONFIG = {
     "disclaimer_frequency": "always"
 }
 
+@telemetry.flush_after
 def lambda_handler(event, context):
     """
     Main Lambda handler for health assistant AI interactions
+    Set "stream": true in the body to receive the answer as a server-sent events body
     """
     try:
+        # Health-data ingest events only refresh this container's hot context
+        invalidated = handle_ingest_event(event)
+        if invalidated is not None:
+            return {"invalidated": invalidated}
+        
         # Parse the incoming request
         body = json.loads(event.get('body', '{}'))
         user_message = body.get('message', '')
@@ -41,26 +83,60 @@ def lambda_handler(event, context):
         
         logger.info(f"Processing message from user {user_id}: {user_message[:100]}...")
         
-        # Apply guardrails
-        if not passes_guardrails(user_message):
+        # Apply guardrails while relevant health data is retrieved
+        classification, guardrails_passed, health_context = asyncio.run(
+            evaluate_and_retrieve(user_message, user_id)
+        )
+        if not guardrails_passed:
             return create_response(400, {
                 "error": "Message blocked by safety guardrails",
-                "message": get_guardrail_response(user_message)
+                "message": get_guardrail_response(user_message, classification)
             })
         
-        # Search relevant health data
-        health_context = search_health_data(user_message, user_id)
+        # Earlier turns of this conversation; only explicit sessions of identified users are remembered
+        session = None
+        if SessionStore.is_tracked(user_id, body.get('session_id')):
+            session = session_store.load(user_id, session_id)
+        first_turn = session is None or (not session["turns"] and not session["summary"])
+        
+        # Serve near-duplicate questions about the same data from the cache;
+        # follow-up questions depend on the conversation so they always go to the model
+        context_hash = context_fingerprint(health_context)
+        cached = lookup_cached_response(user_id, user_message, context_hash) if first_turn else None
+        stream = body.get('stream', False)
         
-        # Generate AI response using Bedrock
-        ai_response = generate_bedrock_response(user_message, health_context, user_id)
+        if stream:
+            if cached:
+                if session is not None:
+                    session_store.append_turn(user_id, session_id, session, user_message, cached["answer"])
+                log_interaction(user_id, session_id, user_message, cached["answer"])
+                frames = replay_cached_response(cached["answer"], health_context)
+            else:
+                frames = stream_bedrock_response(user_message, health_context, user_id, session_id, context_hash, session)
+            return create_streaming_response(frames)
+        
+        if cached:
+            ai_response = cached["answer"]
+            if session is not None:
+                session_store.append_turn(user_id, session_id, session, user_message, ai_response)
+        else:
+            # Generate AI response using Bedrock
+            ai_response, usage = generate_bedrock_response(user_message, health_context, user_id, session)
+            if usage is not None:
+                if first_turn:
+                    response_cache.store(user_id, user_message, context_hash, ai_response, usage)
+                if session is not None:
+                    session_store.append_turn(user_id, session_id, session, user_message, ai_response)
         
         # Log the interaction
-        log_interaction(user_id, session_id, user_message, ai_response)
+        log_interaction(user_id, session_id, user_message, ai_response,
+                        guardrails_triggered=not guardrails_passed)
         
         return create_response(200, {
             "response": ai_response,
             "context_used": len(health_context) > 0,
             "guardrails_active": True,
+            "cached": cached is not None,
             "timestamp": datetime.utcnow().isoformat()
         })
         
@@ -71,43 +147,34 @@ def lambda_handler(event, context):
             "message": "I'm experiencing technical difficulties. Please try again later."
         })
 
-def passes_guardrails(message: str) -> bool:
+def passes_guardrails(message: str, classification: Optional[Dict[str, List[str]]] = None) -> bool:
     """
     Apply safety guardrails to user messages
     """
-    # Convert to lowercase for checking
-    message_lower = message.lower()
+    if classification is None:
+        classification = classify_message(message)
     
     # Medical advice filter
-    if GUARDRAILS_CONFIG["medical_advice_filter"]:
-        medical_keywords = [
-            "diagnose", "diagnosis", "prescribe", "prescription", "medication",
-            "treatment", "cure", "medicine", "drug", "dosage", "should i take"
-        ]
-        if any(keyword in message_lower for keyword in medical_keywords):
-            logger.info("Message blocked by medical advice filter")
-            return False
+    if GUARDRAILS_CONFIG["medical_advice_filter"] and "medical" in classification:
+        logger.info("Message blocked by medical advice filter")
+        return False
     
     # Harmful content filter
-    if GUARDRAILS_CONFIG["harmful_content_filter"]:
-        harmful_keywords = [
-            "suicide", "self-harm", "kill myself", "end my life", "hurt myself"
-        ]
-        if any(keyword in message_lower for keyword in harmful_keywords):
-            logger.info("Message blocked by harmful content filter")
-            return False
+    if GUARDRAILS_CONFIG["harmful_content_filter"] and "harmful" in classification:
+        logger.info("Message blocked by harmful content filter")
+        return False
     
     return True
 
-def get_guardrail_response(message: str) -> str:
+def get_guardrail_response(message: str, classification: Optional[Dict[str, List[str]]] = None) -> str:
     """
     Generate appropriate response when guardrails are triggered
     """
-    message_lower = message.lower()
+    if classification is None:
+        classification = classify_message(message)
     
     # Check for emergency situations
-    emergency_keywords = ["suicide", "self-harm", "kill myself", "emergency"]
-    if any(keyword in message_lower for keyword in emergency_keywords):
+    if "emergency" in classification:
         return """
         🚨 **Emergency Support Available**
         
@@ -120,8 +187,7 @@ def get_guardrail_response(message: str) -> str:
         """
     
     # Medical advice filter response
-    medical_keywords = ["diagnose", "prescribe", "treatment", "medication"]
-    if any(keyword in message_lower for keyword in medical_keywords):
+    if "medical_disclaimer" in classification:
         return """
         ⚕️ **Medical Disclaimer**
         
@@ -137,103 +203,80 @@ def get_guardrail_response(message: str) -> str:
     
     return "I'm not able to respond to that type of question. Please ask about your health data or general wellness topics."
 
-def search_health_data(query: str, user_id: str) -> List[Dict]:
+async def evaluate_and_retrieve(user_message: str, user_id: str) -> Tuple[Dict[str, List[str]], bool, List[Dict]]:
     """
-    Search OpenSearch for relevant health data
+    Start health-context retrieval, evaluate guardrails meanwhile, and cancel retrieval if they block
     """
-    try:
-        # This would connect to OpenSearch and search for relevant health data
-        # For now, returning mock data structure
-        mock_health_data = [
-            {
-                "type": "heart_rate",
-                "value": 72,
-                "timestamp": "2025-06-29T10:00:00Z",
-                "context": "resting heart rate"
-            },
-            {
-                "type": "steps",
-                "value": 8247,
-                "timestamp": "2025-06-29T00:00:00Z",
-                "context": "daily step count"
-            },
-            {
-                "type": "sleep",
-                "value": 7.5,
-                "timestamp": "2025-06-28T22:00:00Z",
-                "context": "sleep duration in hours"
-            }
-        ]
-        
-        logger.info(f"Retrieved {len(mock_health_data)} health data points for user {user_id}")
-        return mock_health_data
-        
-    except Exception as e:
-        logger.error(f"Error searching health data: {str(e)}")
-        return []
+    retrieval = asyncio.ensure_future(retrieve_health_context(user_message, user_id))
+    await asyncio.sleep(0)  # Let the embedding stage start before classifying
+    
+    # Classify the message once for guardrails and fallback routing
+    classification = classify_message(user_message)
+    if not passes_guardrails(user_message, classification):
+        retrieval.cancel()
+        return classification, False, []
+    
+    return classification, True, await retrieval
 
-def generate_bedrock_response(user_message: str, health_context: List[Dict], user_id: str) -> str:
+def build_bedrock_request(user_message: str, health_context: List[Dict], user_id: str,
+                          session: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
     """
-    Generate AI response using Amazon Bedrock Claude model
+    Build the Claude messages request body with health context ahead of the question
     """
-    try:
-        # Prepare the context
-        context_str = ""
-        if health_context:
-            context_str = "Recent health data:\n"
-            for data in health_context:
-                context_str += f"- {data['type']}: {data['value']} ({data['context']})\n"
-        
-        # Create the prompt with guardrails
-        system_prompt = """You are a helpful health data assistant. Follow these guidelines:
-
-1. NEVER provide medical diagnoses or treatment recommendations
-2. NEVER prescribe medications or suggest specific medical treatments
-3. Always include appropriate medical disclaimers
-4. Focus on helping users understand their health data
-5. Encourage users to consult healthcare professionals for medical concerns
-6. Be supportive and informative about general wellness
+    # Prepare the context within the token budget
+    context_str = context_packer.pack(health_context, user_id)
+    
+    # Static guidelines come from the cached prompt template; prior turns are already bounded by the session store
+    if session is None:
+        return build_claude_request(user_message, context_str)
+    return build_claude_request(user_message, context_str,
+                                history=SessionStore.history_messages(session),
+                                summary=SessionStore.summary_text(session))
 
-If asked about medical conditions, diagnoses, or treatments, politely redirect to healthcare professionals."""
+def record_bedrock_usage(response_body: Dict[str, Any], request_body: Dict[str, Any], ai_response: str,
+                         user_id: str, model_id: str = CLAUDE_MODEL_ID,
+                         timings_ms: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+    """
+    Record token usage from the model's usage block, plus any latency timings in milliseconds
+    """
+    usage = extract_usage(response_body, prompt_messages=request_body["messages"], completion_text=ai_response)
+    metrics = {
+        "InputTokens": usage["input_tokens"],
+        "OutputTokens": usage["output_tokens"],
+        "CacheReadInputTokens": usage["cache_read_input_tokens"],
+        "CacheWriteInputTokens": usage["cache_write_input_tokens"]
+    }
+    timings_ms = timings_ms or {}
+    metrics.update(timings_ms)
+    telemetry.record(
+        "BedrockUsage",
+        metrics=metrics,
+        dimensions={"Model": model_id},
+        properties={"user_id": user_id, "token_source": usage["source"]},
+        units={name: "Milliseconds" for name in timings_ms}
+    )
+    return usage
 
-        user_prompt = f"""
-        User question: {user_message}
-        
-        {context_str}
-        
-        Please provide a helpful response about the user's health data while following all safety guidelines.
-        Always end with: "Remember to consult your healthcare provider for medical advice."
-        """
+def generate_bedrock_response(user_message: str, health_context: List[Dict], user_id: str,
+                              session: Optional[Dict[str, Any]] = None) -> Tuple[str, Optional[Dict]]:
+    """
+    Generate AI response using Amazon Bedrock Claude model
+    Returns the response text and its token usage (None when the canned error reply is used)
+    """
+    try:
+        request_body = build_bedrock_request(user_message, health_context, user_id, session)
         
-        # Prepare the request body
-        request_body = {
-            "anthropic_version": "bedrock-2023-05-31",
-            "max_tokens": 1000,
-            "system": system_prompt,
-            "messages": [
-                {
-                    "role": "user",
-                    "content": user_prompt
-                }
-            ],
-            "temperature": 0.7,
-            "top_p": 0.9
-        }
-        
-        # Call Bedrock
-        response = bedrock_runtime.invoke_model(
-            modelId=CLAUDE_MODEL_ID,
-            body=json.dumps(request_body),
-            contentType='application/json',
-            accept='application/json'
-        )
+        # Call Bedrock, failing over across models before the canned reply
+        model_id, response = model_router.invoke(encode_claude_request(request_body), user_message)
         
         # Parse response
         response_body = json.loads(response['body'].read())
         ai_response = response_body['content'][0]['text']
         
-        logger.info(f"Generated AI response for user {user_id}")
-        return ai_response
+        usage = record_bedrock_usage(response_body, request_body, ai_response, user_id, model_id)
+        
+        logger.info(f"Generated AI response for user {user_id} with {model_id}")
+        return ai_response, usage
         
     except Exception as e:
         logger.error(f"Error generating Bedrock response: {str(e)}")
@@ -241,24 +284,190 @@ If asked about medical conditions, diagnoses, or treatments, politely redirect t
         
         For immediate health concerns, please contact your healthcare provider.
         
-        Remember to consult your healthcare provider for medical advice."""
+        Remember to consult your healthcare provider for medical advice.""", None
+
+class StreamGuard:
+    """
+    Incremental post-processing for streamed model output
+
+    Text is released one complete sentence at a time so each sentence passes the
+    output guardrail before the client sees it. The disclaimer suffix is checked
+    once the stream ends and appended only if the model did not write it.
+    """
+    SENTENCE_END = re.compile(r"[.!?]\s|\n")
+
+    def __init__(self):
+        self.pending = ""
+        self.released = []
+        self.blocked = False
+
+    def feed(self, text: str) -> str:
+        """
+        Accept a model chunk and return the text that is safe to send now
+        """
+        if self.blocked:
+            return ""
+        
+        self.pending += text
+        boundary = None
+        for boundary in self.SENTENCE_END.finditer(self.pending):
+            pass
+        if boundary is None:
+            return ""
+        
+        return self._release(self.pending[:boundary.end()], self.pending[boundary.end():])
 
-def log_interaction(user_id: str, session_id: str, user_message: str, ai_response: str):
+    def finish(self) -> str:
+        """
+        Flush held text and append the disclaimer if the model did not end with it
+        """
+        if self.blocked:
+            return ""
+        
+        text = self._release(self.pending, "")
+        if self.blocked:
+            return text
+        if not "".join(self.released).rstrip().endswith(MEDICAL_DISCLAIMER):
+            suffix = "\n\n" + MEDICAL_DISCLAIMER
+            self.released.append(suffix)
+            text += suffix
+        return text
+
+    def _release(self, text: str, remainder: str) -> str:
+        if "harmful" in classify_message(text):
+            logger.info("Streamed response blocked by harmful content filter")
+            self.blocked = True
+            text = "\n\n" + get_guardrail_response(text)
+        self.released.append(text)
+        self.pending = remainder
+        return text
+
+def stream_bedrock_response(user_message: str, health_context: List[Dict], user_id: str, session_id: str,
+                            context_hash: str, session: Optional[Dict[str, Any]] = None):
     """
-    Log the interaction for monitoring and improvement
+    Convert Claude's streamed output into SSE frames, filtered as it arrives
+
+    The frames reach the client together in one buffered body, so the model's
+    time to first token is reported next to the time the body was complete.
     """
+    request_body = build_bedrock_request(user_message, health_context, user_id, session)
+    guard = StreamGuard()
+    response_body = {"usage": {}}
+    request_start = time.perf_counter()
+    timings_ms = {}
+    model_id = CLAUDE_MODEL_ID
+    
     try:
-        interaction_log = {
-            "timestamp": datetime.utcnow().isoformat(),
-            "user_id": user_id,
-            "session_id": session_id,
-            "user_message": user_message[:500],  # Truncate for privacy
-            "ai_response": ai_response[:500],     # Truncate for storage
-            "guardrails_triggered": not passes_guardrails(user_message)
-        }
+        # Failover happens before the stream opens; once text is flowing the model is fixed
+        model_id, response = model_router.invoke(encode_claude_request(request_body), user_message, stream=True)
         
-        # In production, this would be sent to CloudWatch Logs or a database
-        logger.info(f"Interaction logged: {json.dumps(interaction_log)}")
+        for event in response['body']:
+            chunk = json.loads(event['chunk']['bytes'])
+            
+            if chunk.get('type') == 'message_start':
+                response_body["usage"].update(chunk.get('message', {}).get('usage', {}))
+            elif chunk.get('type') == 'message_delta':
+                response_body["usage"].update(chunk.get('usage', {}))
+            elif chunk.get('type') == 'content_block_delta':
+                if "TimeToFirstTokenMs" not in timings_ms:
+                    timings_ms["TimeToFirstTokenMs"] = (time.perf_counter() - request_start) * 1000
+                    logger.info(f"Bedrock time to first token: {timings_ms['TimeToFirstTokenMs']:.0f} ms")
+                text = guard.feed(chunk.get('delta', {}).get('text', ''))
+                if text:
+                    yield format_sse_event({"type": "delta", "text": text})
+                if guard.blocked:
+                    break
+        
+        text = guard.finish()
+        if text:
+            yield format_sse_event({"type": "delta", "text": text})
+        
+    except Exception as e:
+        logger.error(f"Error streaming Bedrock response: {str(e)}")
+        guard.blocked = True
+        yield format_sse_event({"type": "error", "message": "I'm having trouble processing your request right now. Please try again later."}, event="error")
+    
+    yield format_sse_event({
+        "type": "done",
+        "context_used": len(health_context) > 0,
+        "guardrails_active": True,
+        "timestamp": datetime.utcnow().isoformat()
+    })
+    yield SSE_DONE
+    
+    # Record the full text once every frame has been produced
+    timings_ms["ResponseCompleteMs"] = (time.perf_counter() - request_start) * 1000
+    ai_response = "".join(guard.released)
+    usage = record_bedrock_usage(response_body, request_body, ai_response, user_id, model_id, timings_ms)
+    if not guard.blocked:
+        if session is None or (not session["turns"] and not session["summary"]):
+            response_cache.store(user_id, user_message, context_hash, ai_response, usage)
+        if session is not None:
+            session_store.append_turn(user_id, session_id, session, user_message, ai_response)
+    log_interaction(user_id, session_id, user_message, ai_response)
+
+def replay_cached_response(ai_response: str, health_context: List[Dict]):
+    """
+    Replay a cached answer as SSE frames
+    """
+    yield format_sse_event({"type": "delta", "text": ai_response})
+    yield format_sse_event({
+        "type": "done",
+        "context_used": len(health_context) > 0,
+        "guardrails_active": True,
+        "cached": True,
+        "timestamp": datetime.utcnow().isoformat()
+    })
+    yield SSE_DONE
+
+def lookup_cached_response(user_id: str, user_message: str, context_hash: str) -> Optional[Dict[str, Any]]:
+    """
+    Look up a cached answer and report hit rate and Bedrock spend saved
+    """
+    try:
+        entry = response_cache.lookup(user_id, user_message, context_hash)
+    except Exception as e:
+        logger.error(f"Error reading response cache: {str(e)}")
+        return None
+    
+    metrics = {"CacheHit": int(entry is not None), "CacheHitRate": response_cache.hit_rate}
+    if entry is not None:
+        metrics.update({
+            "InputTokensSaved": entry["input_tokens"],
+            "OutputTokensSaved": entry["output_tokens"],
+            "BedrockCostSavedUSD": (entry["input_tokens"] * BEDROCK_INPUT_COST_PER_1K +
+                                    entry["output_tokens"] * BEDROCK_OUTPUT_COST_PER_1K) / 1000
+        })
+        logger.info(f"Response cache hit for user {user_id}")
+    
+    telemetry.record(
+        "ResponseCache",
+        metrics=metrics,
+        dimensions={"Model": CLAUDE_MODEL_ID},
+        units={"CacheHitRate": "None", "BedrockCostSavedUSD": "None"}
+    )
+    return entry
+
+def log_interaction(user_id: str, session_id: str, user_message: str, ai_response: str,
+                    guardrails_triggered: bool = False):
+    """
+    Buffer the interaction for monitoring and improvement (flushed at the end of the invocation)
+    """
+    try:
+        telemetry.record(
+            "HealthAssistantInteraction",
+            metrics={
+                "Interactions": 1,
+                "GuardrailsTriggered": int(guardrails_triggered)
+            },
+            properties={
+                "user_id": user_id,
+                "session_id": session_id,
+                "user_message": user_message[:500],  # Truncate for privacy
+                "ai_response": ai_response[:500],     # Truncate for storage
+                "guardrails_triggered": guardrails_triggered
+            }
+        )
         
     except Exception as e:
         logger.error(f"Error logging interaction: {str(e)}")
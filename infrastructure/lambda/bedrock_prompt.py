@@ -0,0 +1,107 @@
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+# Claude request template for the health assistant lambdas.
+#
+# Messages are ordered from most to least stable so the cached prefix survives
+# from turn to turn. The system prompt and response guidelines never change and
+# are built once into the request template as a cache point. Earlier session
+# turns follow, with a second cache point on the last of them: next turn the
+# same turns are resent with one more exchange appended, so Bedrock finds the
+# previous prefix. The per-request parts, the user's health context and the
+# question, come last in the final user message. Bedrock reports the cached
+# prefix in usage as cache_read_input_tokens / cache_creation_input_tokens.
+#
+# Prompt caching is on by default (BEDROCK_PROMPT_CACHING=false turns it off).
+# Not every model accepts cache_control, so the model router removes the cache
+# points for models outside BEDROCK_PROMPT_CACHING_MODELS before invoking them.
+
+ANTHROPIC_VERSION = "bedrock-2023-05-31"
+MEDICAL_DISCLAIMER = "Remember to consult your healthcare provider for medical advice."
+PROMPT_CACHING_ENABLED = os.environ.get('BEDROCK_PROMPT_CACHING', 'true').lower() == 'true'
+CACHE_POINT = {"type": "ephemeral"}
+# How json.dumps writes a cache point into a text block; text never contains it unescaped
+CACHE_POINT_JSON = ', "cache_control": ' + json.dumps(CACHE_POINT)
+
+
+def _text_block(text: str, cacheable: bool = False) -> Dict[str, Any]:
+    block = {"type": "text", "text": text}
+    if cacheable and PROMPT_CACHING_ENABLED:
+        block["cache_control"] = CACHE_POINT
+    return block
+
+
+SYSTEM_PROMPT = f"""You are a helpful health data assistant. Follow these guidelines:
+
+1. NEVER provide medical diagnoses or treatment recommendations
+2. NEVER prescribe medications or suggest specific medical treatments
+3. Always include appropriate medical disclaimers
+4. Focus on helping users understand their health data
+5. Encourage users to consult healthcare professionals for medical concerns
+6. Be supportive and informative about general wellness
+
+If asked about medical conditions, diagnoses, or treatments, politely redirect to healthcare professionals.
+
+Please provide a helpful response about the user's health data while following all safety guidelines.
+Always end with: "{MEDICAL_DISCLAIMER}\""""
+
+REQUEST_TEMPLATE = {
+    "anthropic_version": ANTHROPIC_VERSION,
+    "max_tokens": 1000,
+    "system": [_text_block(SYSTEM_PROMPT, cacheable=True)],
+    "temperature": 0.7,
+    "top_p": 0.9
+}
+
+# Serialized once; only the messages are encoded per request
+_REQUEST_PREFIX = json.dumps(REQUEST_TEMPLATE)[:-1]
+
+
+def build_history_messages(history: List[Dict[str, Any]], summary: str = "") -> List[Dict[str, Any]]:
+    """
+    Earlier session turns, opened by the rolling summary, with a cache point after the last turn
+    """
+    messages = [{"role": turn["role"], "content": [_text_block(turn["content"])]} for turn in history]
+    if summary:
+        # Session history always starts with a user turn; the summary only changes when turns are dropped
+        messages[0]["content"].insert(0, _text_block(summary))
+    messages[-1]["content"][-1] = _text_block(messages[-1]["content"][-1]["text"], cacheable=True)
+    return messages
+
+
+def build_claude_request(user_message: str, context_str: str, history: Optional[List[Dict[str, Any]]] = None,
+                         summary: str = "") -> Dict[str, Any]:
+    """
+    Build a request body from the prebuilt template: earlier session turns, then the context and the question
+    """
+    content = [_text_block(context_str)] if context_str else []
+    content.append(_text_block(f"User question: {user_message}"))
+    if history:
+        messages = build_history_messages(history, summary)
+    else:
+        messages = []
+        if summary:
+            content.insert(0, _text_block(summary))
+    messages.append({"role": "user", "content": content})
+
+    request = dict(REQUEST_TEMPLATE)
+    request["messages"] = messages
+    return request
+
+
+def encode_claude_request(request: Dict[str, Any]) -> str:
+    """
+    Serialize a request body, reusing the pre-serialized template when it is unchanged
+    """
+    if len(request) == len(REQUEST_TEMPLATE) + 1 and all(
+            request.get(key) is value for key, value in REQUEST_TEMPLATE.items()):
+        return f'{_REQUEST_PREFIX}, "messages": {json.dumps(request["messages"])}}}'
+    return json.dumps(request)
+
+
+def strip_cache_points(body: str) -> str:
+    """
+    Remove every cache point from an encoded request, for models without prompt caching
+    """
+    return body.replace(CACHE_POINT_JSON, "")
@@ -0,0 +1,141 @@
+import logging
+import random
+import threading
+import time
+from collections import deque
+from typing import Any, Callable, Dict
+
+# Configure logging
+logger = logging.getLogger()
+
+# Per-container circuit breaker for downstream model calls.
+#
+# The breaker trips when the error rate or the slow-call rate over a rolling
+# window of recent calls crosses its threshold. While open, callers skip the
+# dependency entirely; after a jittered exponential backoff it lets a probe
+# through (half-open) and closes again only if the probe succeeds quickly.
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """
+    Closed/open/half-open breaker driven by error rate and latency
+    """
+
+    def __init__(self, name: str, window_size: int = 20, minimum_calls: int = 5,
+                 failure_rate_threshold: float = 0.5, slow_call_ms: float = 8000,
+                 slow_call_rate_threshold: float = 0.8, base_backoff_seconds: float = 5,
+                 max_backoff_seconds: float = 120, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.minimum_calls = minimum_calls
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_ms = slow_call_ms
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.base_backoff_seconds = base_backoff_seconds
+        self.max_backoff_seconds = max_backoff_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._outcomes = deque(maxlen=window_size)  # (failed, slow)
+        self._state = CLOSED
+        self._consecutive_trips = 0
+        self._retry_at = 0.0
+        self._probe_in_flight = False
+
+    @property
+    def state(self) -> str:
+        return self._state
+
+    def allow_request(self) -> bool:
+        """
+        Return True if the protected call should be attempted now
+        """
+        with self._lock:
+            if self._state == CLOSED:
+                return True
+
+            if self._state == OPEN and self._clock() >= self._retry_at:
+                self._transition(HALF_OPEN)
+
+            if self._state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+
+            return False
+
+    def record_success(self, latency_ms: float):
+        """
+        Record a completed call and its latency
+        """
+        slow = latency_ms >= self.slow_call_ms
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probe_in_flight = False
+                if slow:
+                    self._trip()
+                else:
+                    self._consecutive_trips = 0
+                    self._outcomes.clear()
+                    self._transition(CLOSED)
+                return
+
+            self._outcomes.append((False, slow))
+            self._evaluate()
+
+    def record_failure(self, latency_ms: float = 0.0):
+        """
+        Record a failed call (throttling, timeout or error)
+        """
+        with self._lock:
+            if self._state == HALF_OPEN:
+                self._probe_in_flight = False
+                self._trip()
+                return
+
+            self._outcomes.append((True, latency_ms >= self.slow_call_ms))
+            self._evaluate()
+
+    def release(self):
+        """
+        Give back a half-open probe slot for a call whose outcome says nothing about the dependency
+        """
+        with self._lock:
+            self._probe_in_flight = False
+
+    def snapshot(self) -> Dict[str, Any]:
+        """
+        Return the breaker state for responses and metrics
+        """
+        with self._lock:
+            calls = len(self._outcomes)
+            failures = sum(1 for failed, _ in self._outcomes if failed)
+            return {
+                "state": self._state,
+                "failure_rate": round(failures / calls, 3) if calls else 0.0,
+                "retry_in_seconds": round(max(self._retry_at - self._clock(), 0), 1) if self._state == OPEN else 0
+            }
+
+    def _evaluate(self):
+        calls = len(self._outcomes)
+        if self._state != CLOSED or calls < self.minimum_calls:
+            return
+
+        failure_rate = sum(1 for failed, _ in self._outcomes if failed) / calls
+        slow_rate = sum(1 for _, slow in self._outcomes if slow) / calls
+        if failure_rate >= self.failure_rate_threshold or slow_rate >= self.slow_call_rate_threshold:
+            self._trip()
+
+    def _trip(self):
+        # Exponential backoff with equal jitter so containers do not probe in lockstep
+        self._consecutive_trips += 1
+        backoff = min(self.max_backoff_seconds, self.base_backoff_seconds * 2 ** (self._consecutive_trips - 1))
+        self._retry_at = self._clock() + random.uniform(backoff / 2, backoff)
+        self._outcomes.clear()
+        self._transition(OPEN)
+
+    def _transition(self, state: str):
+        if state != self._state:
+            logger.warning(f"Circuit breaker {self.name}: {self._state} -> {state}")
+            self._state = state
@@ -0,0 +1,179 @@
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Any, Dict, List, Optional, Tuple
+
+from token_usage import estimate_tokens
+
+# Token-budgeted packing of retrieved health readings into prompt context.
+#
+# Readings are grouped per data type. Dense series are collapsed into one
+# min/avg/max line per day (the latest raw reading is kept alongside), every
+# candidate line is ranked by search relevance and recency, and lines are
+# taken in rank order until the token budget is spent. Daily summaries are
+# cached per user so repeated turns over the same series skip re-aggregation.
+
+CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '600'))
+DENSE_SERIES_THRESHOLD = int(os.environ.get('DENSE_SERIES_THRESHOLD', '6'))
+RECENCY_HALF_LIFE_HOURS = float(os.environ.get('RECENCY_HALF_LIFE_HOURS', '48'))
+SUMMARY_CACHE_TTL_SECONDS = int(os.environ.get('SUMMARY_CACHE_TTL_SECONDS', '900'))
+
+
+def _parse_timestamp(value: Any) -> Optional[datetime]:
+    if not value:
+        return None
+    try:
+        parsed = datetime.fromisoformat(str(value).replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _as_number(value: Any) -> Optional[float]:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def _format_number(value: float) -> str:
+    return f"{value:,.0f}" if abs(value) >= 100 else f"{value:.1f}".rstrip('0').rstrip('.')
+
+
+class ContextPacker:
+    """
+    Rank, summarize and pack health readings into a token budget
+    """
+
+    def __init__(self, token_budget: int = CONTEXT_TOKEN_BUDGET, dense_series_threshold: int = DENSE_SERIES_THRESHOLD,
+                 recency_half_life_hours: float = RECENCY_HALF_LIFE_HOURS,
+                 summary_ttl_seconds: int = SUMMARY_CACHE_TTL_SECONDS, max_cached_users: int = 1000):
+        self.token_budget = token_budget
+        self.dense_series_threshold = dense_series_threshold
+        self.recency_half_life_hours = recency_half_life_hours
+        self.summary_ttl_seconds = summary_ttl_seconds
+        self.max_cached_users = max_cached_users
+        self._summaries: "OrderedDict[str, Dict[Tuple, Tuple[float, Dict]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def pack(self, health_context: List[Dict], user_id: str, now: Optional[datetime] = None) -> str:
+        """
+        Return the context block for the prompt, or an empty string if there is no data
+        """
+        if not health_context:
+            return ""
+
+        now = now or datetime.now(timezone.utc)
+        max_score = max((_as_number(item.get('score')) or 0.0) for item in health_context) or 1.0
+
+        series: Dict[str, List[Dict]] = {}
+        for item in health_context:
+            series.setdefault(item.get('type') or 'unknown', []).append(item)
+
+        candidates = []  # (rank, data_type, sort_time, line)
+        for data_type, readings in series.items():
+            readings.sort(key=lambda item: _parse_timestamp(item.get('timestamp')) or datetime.min.replace(tzinfo=timezone.utc))
+            numeric = [item for item in readings if _as_number(item.get('value')) is not None]
+
+            if len(numeric) > self.dense_series_threshold:
+                for summary in self._daily_summaries(user_id, data_type, numeric):
+                    rank = self._rank(summary['relevance'] / max_score, summary['last'], now)
+                    candidates.append((rank, data_type, summary['last'], self._summary_line(data_type, summary)))
+                # The latest reading stays verbatim next to its summaries
+                readings = readings[-1:]
+
+            for item in readings:
+                timestamp = _parse_timestamp(item.get('timestamp'))
+                rank = self._rank((_as_number(item.get('score')) or 0.0) / max_score, timestamp, now)
+                candidates.append((rank, data_type, timestamp, self._reading_line(item)))
+
+        # Greedy fill in rank order, then present grouped by type and time
+        header = "Recent health data:"
+        used = estimate_tokens(header)
+        selected = []
+        for candidate in sorted(candidates, key=lambda c: c[0], reverse=True):
+            cost = estimate_tokens(candidate[3])
+            if used + cost > self.token_budget:
+                continue
+            used += cost
+            selected.append(candidate)
+
+        if not selected:
+            return ""
+
+        minimum = datetime.min.replace(tzinfo=timezone.utc)
+        selected.sort(key=lambda c: (c[1], c[2] or minimum))
+        return header + "\n" + "".join(line + "\n" for _, _, _, line in selected)
+
+    def _rank(self, relevance: float, timestamp: Optional[datetime], now: datetime) -> float:
+        if timestamp is None:
+            recency = 0.0
+        else:
+            age_hours = max((now - timestamp).total_seconds() / 3600, 0.0)
+            recency = math.exp(-math.log(2) * age_hours / self.recency_half_life_hours)
+        return 0.6 * relevance + 0.4 * recency
+
+    def _daily_summaries(self, user_id: str, data_type: str, readings: List[Dict]) -> List[Dict]:
+        days: Dict[str, List[Dict]] = {}
+        for item in readings:
+            timestamp = _parse_timestamp(item.get('timestamp'))
+            days.setdefault(timestamp.date().isoformat() if timestamp else 'undated', []).append(item)
+
+        summaries = []
+        for day, day_readings in days.items():
+            key = (data_type, day, len(day_readings), day_readings[0].get('timestamp'), day_readings[-1].get('timestamp'))
+            summary = self._cached_summary(user_id, key)
+            if summary is None:
+                values = [_as_number(item.get('value')) for item in day_readings]
+                summary = {
+                    "day": day,
+                    "count": len(values),
+                    "min": min(values),
+                    "max": max(values),
+                    "avg": sum(values) / len(values),
+                    "unit": day_readings[-1].get('unit', ''),
+                    "last": _parse_timestamp(day_readings[-1].get('timestamp')),
+                    "relevance": max((_as_number(item.get('score')) or 0.0) for item in day_readings)
+                }
+                self._store_summary(user_id, key, summary)
+            summaries.append(summary)
+        return summaries
+
+    def _cached_summary(self, user_id: str, key: Tuple) -> Optional[Dict]:
+        with self._lock:
+            cached = self._summaries.get(user_id, {}).get(key)
+            if cached is None or cached[0] < time.monotonic():
+                return None
+            self._summaries.move_to_end(user_id)
+            return cached[1]
+
+    def _store_summary(self, user_id: str, key: Tuple, summary: Dict):
+        with self._lock:
+            user_summaries = self._summaries.setdefault(user_id, {})
+            self._summaries.move_to_end(user_id)
+            now = time.monotonic()
+            for stale in [k for k, (expires, _) in user_summaries.items() if expires < now]:
+                del user_summaries[stale]
+            user_summaries[key] = (now + self.summary_ttl_seconds, summary)
+            while len(self._summaries) > self.max_cached_users:
+                self._summaries.popitem(last=False)
+
+    @staticmethod
+    def _reading_line(item: Dict) -> str:
+        value = item.get('value')
+        number = _as_number(value)
+        value_text = _format_number(number) if number is not None else str(value)
+        unit = f" {item['unit']}" if item.get('unit') else ""
+        detail = f" ({item['context']})" if item.get('context') and item.get('context') != item.get('unit') else ""
+        when = f" at {item['timestamp']}" if item.get('timestamp') else ""
+        return f"- {item.get('type')}: {value_text}{unit}{detail}{when}"
+
+    @staticmethod
+    def _summary_line(data_type: str, summary: Dict) -> str:
+        unit = f" {summary['unit']}" if summary['unit'] else ""
+        return (f"- {data_type} {summary['day']}: min {_format_number(summary['min'])}, "
+                f"avg {_format_number(summary['avg'])}, max {_format_number(summary['max'])}{unit} "
+                f"({summary['count']} readings)")
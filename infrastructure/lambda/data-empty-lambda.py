@@ -1,28 +1,70 @@
 import json
 import boto3
 import logging
+import os
+import re
+import time
+import uuid
 from datetime import datetime
+import requests
+from health_rollups import ROLLUP_INDEX
+from hot_context import publish_ingest_event
+from query_cache import bump_user_generation
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Initialize AWS clients
-opensearch_client = boto3.client('opensearchserverless')
+lambda_client = boto3.client('lambda')
 s3_client = boto3.client('s3')
 
 # Configuration
 OPENSEARCH_ENDPOINT = "https://your-service.amazonaws.com"
-OPENSEARCH_INDEX = "health-data"
+OPENSEARCH_INDEX = "health-data"  # Alias in front of the current physical index
 S3_BUCKET = "stayfit-healthhq-uploads"
 
+# delete_by_query tuning: parallel slices and a per-second document throttle
+DELETE_SLICES = os.environ.get('DELETE_SLICES', 'auto')
+DELETE_REQUESTS_PER_SECOND = os.environ.get('DELETE_REQUESTS_PER_SECOND', '1000')
+
+# Documents are routed by user_id, so the index can grow past one shard
+HEALTH_INDEX_SHARDS = int(os.environ.get('HEALTH_INDEX_SHARDS', '3'))
+
+# Only the timestamped indices created by swap_empty_index may ever be dropped
+RETIRED_INDEX_PATTERN = re.compile(rf"^{re.escape(OPENSEARCH_INDEX)}-\d{{20}}$")
+
+# Per-user erasures are tracked in S3 so they can be polled and resumed across invocations
+ERASURE_PREFIX = "erasure-tasks"
+ERASURE_MAX_ATTEMPTS = int(os.environ.get('ERASURE_MAX_ATTEMPTS', '5'))
+# Every index holding per-user documents: uploads (alias), connector/indexer writes, rollups
+ERASURE_INDICES = [OPENSEARCH_INDEX, "health-data-index", ROLLUP_INDEX]
+# Emptied next to the alias by empty_all, so no rollup outlives the readings it summarizes
+SECONDARY_INDICES = [index for index in ERASURE_INDICES if index != OPENSEARCH_INDEX]
+
 def lambda_handler(event, context):
     """
-    AWS Lambda function to empty all health data from OpenSearch
+    AWS Lambda function to empty health data from OpenSearch
     Requires confirmation for safety
+
+    Actions:
+    - empty_all: swap the alias to a fresh index ("strategy": "swap", the default)
+      or delete every document in place ("strategy": "delete_by_query"); the
+      connector's health index and the rollups are emptied by delete_by_query
+    - delete_by_query: background delete of the documents matching "query"
+    - task_status: progress of a task_id returned by either action
+    - erase_user: background erasure of one user's documents, tracked by erasure_id
+    - erasure_status: progress of an erasure, resuming it if its task was interrupted
     """
     
     try:
+        # Retired-index cleanup is internal: only swap_empty_index's asynchronous
+        # self-invocation may trigger it, never an API Gateway request
+        if event.get('internal_action') == 'drop_indices':
+            if 'requestContext' in event or 'httpMethod' in event:
+                return create_response(403, {"error": "drop_indices is not available through the API"})
+            return {"dropped": drop_indices(event.get('indices', []))}
+        
         # Parse the incoming request
         if isinstance(event.get('body'), str):
             body = json.loads(event['body'])
@@ -30,92 +72,326 @@ def lambda_handler(event, context):
             body = event.get('body', {})
         
         logger.info(f"Empty request received: {body}")
+        action = body.get('action')
+        
+        if action == 'task_status':
+            return create_response(200, get_task_status(body.get('task_id', '')))
+        
+        if action == 'erasure_status':
+            erasure = load_erasure(body.get('erasure_id', ''))
+            if erasure is None:
+                return create_response(404, {"error": "Unknown erasure_id"})
+            return create_response(200, advance_erasure(erasure))
         
         # Validate request
-        if body.get('action') != 'empty_all':
-            return create_response(400, {"error": "Invalid action. Must be 'empty_all'"})
+        if action not in ('empty_all', 'delete_by_query', 'erase_user'):
+            return create_response(400, {"error": "Invalid action. Must be 'empty_all', 'delete_by_query', "
+                                                  "'erase_user', 'task_status' or 'erasure_status'"})
         
         if not body.get('confirm', False):
             return create_response(400, {"error": "Confirmation required. Set 'confirm': true"})
         
-        # Get current document count before deletion
-        current_count = get_document_count()
+        if action == 'erase_user':
+            if not body.get('user_id'):
+                return create_response(400, {"error": "A 'user_id' is required for erase_user"})
+            return create_response(202, start_erasure(body['user_id']))
+        
+        if action == 'delete_by_query':
+            if not isinstance(body.get('query'), dict):
+                return create_response(400, {"error": "A 'query' object is required for delete_by_query"})
+            result = start_delete_by_query(body['query'])
+            create_audit_log("DELETE_BY_QUERY", dict(result, query=body['query'], source="lambda_empty_function"))
+            return create_response(202, dict(result, operation="delete_by_query", timestamp=datetime.now().isoformat()))
         
-        # Perform the empty operation
-        deleted_count = empty_opensearch_data()
+        strategy = body.get('strategy', 'swap')
+        if strategy == 'swap':
+            result = swap_empty_index(context)
+            secondary = start_delete_by_query({"match_all": {}}, indices=SECONDARY_INDICES)
+            result["secondary_task_id"] = secondary["task_id"]
+            message = "Uploaded health data has been deleted; connector readings and rollups are being deleted"
+            status_code = 200
+        elif strategy == 'delete_by_query':
+            result = start_delete_by_query({"match_all": {}}, indices=ERASURE_INDICES)
+            message = "Deletion of all health data has started"
+            status_code = 202
+        else:
+            return create_response(400, {"error": "Invalid strategy. Must be 'swap' or 'delete_by_query'"})
         
         # Log the operation
-        logger.info(f"Empty operation completed. Deleted {deleted_count} documents")
+        logger.info(f"Empty operation ({strategy}) completed: {result}")
         
         # Create audit log entry
-        create_audit_log("EMPTY_ALL", {
-            "deleted_count": deleted_count,
-            "previous_count": current_count,
-            "timestamp": datetime.now().isoformat(),
-            "source": "lambda_empty_function"
-        })
+        create_audit_log("EMPTY_ALL", dict(result, strategy=strategy, timestamp=datetime.now().isoformat(),
+                                           source="lambda_empty_function"))
         
         # Return success response
-        return create_response(200, {
-            "message": "All health data has been successfully deleted from OpenSearch",
-            "deleted_count": deleted_count,
-            "previous_count": current_count,
-            "timestamp": datetime.now().isoformat(),
-            "operation": "empty_all"
-        })
+        return create_response(status_code, dict(result, message=message, strategy=strategy,
+                                                 timestamp=datetime.now().isoformat(), operation="empty_all"))
         
     except Exception as e:
         logger.error(f"Error emptying OpenSearch data: {str(e)}")
         return create_response(500, {"error": f"Internal server error: {str(e)}"})
 
-def get_document_count():
-    """Get current document count in OpenSearch"""
+def opensearch_request(method, path, body=None, params=None, timeout=30):
+    """Call the OpenSearch REST API and return the parsed JSON response"""
+    response = requests.request(
+        method,
+        f"{OPENSEARCH_ENDPOINT}/{path}",
+        json=body,
+        params=params,
+        headers={'Content-Type': 'application/json'},
+        timeout=timeout
+    )
+    if response.status_code >= 400:
+        raise Exception(f"OpenSearch {method} /{path} failed: {response.status_code} - {response.text}")
+    return response.json() if response.content else {}
+
+def index_params(indices, routing=None):
+    """Query parameters for a request over several indices, some of which may not exist yet"""
+    params = {"ignore_unavailable": "true", "allow_no_indices": "true"} if indices else {}
+    if routing:
+        params["routing"] = routing
+    return params or None
+
+def get_document_count(query=None, routing=None, indices=None, strict=False):
+    """Get current document count in OpenSearch; strict callers get the error instead of 0"""
     try:
-        # In a real implementation, you would query OpenSearch
-        # For now, we'll simulate getting the count
-        
-        # Simulate API call to OpenSearch
-        # response = opensearch_client.count(index=OPENSEARCH_INDEX)
-        # return response['count']
-        
-        # Simulated count for demo
-        simulated_count = 3542  # This would come from actual OpenSearch query
-        logger.info(f"Current document count: {simulated_count}")
-        return simulated_count
+        result = opensearch_request('POST', f"{','.join(indices or [OPENSEARCH_INDEX])}/_count",
+                                    {"query": query} if query else None, params=index_params(indices, routing))
+        count = result.get('count', 0)
+        logger.info(f"Current document count: {count}")
+        return count
         
     except Exception as e:
         logger.error(f"Error getting document count: {str(e)}")
+        if strict:
+            raise
         return 0
 
-def empty_opensearch_data():
-    """Empty all data from OpenSearch index"""
+def get_alias_indices():
+    """Physical indices currently behind the alias (empty if the alias does not exist)"""
+    response = requests.get(f"{OPENSEARCH_ENDPOINT}/_alias/{OPENSEARCH_INDEX}", timeout=10)
+    if response.status_code == 404:
+        return []
+    if response.status_code >= 400:
+        raise Exception(f"Alias lookup failed: {response.status_code} - {response.text}")
+    return sorted(response.json().keys())
+
+def swap_empty_index(context=None):
+    """Empty the index in O(1): point the alias at a fresh index and drop the old one asynchronously"""
+    previous_count = get_document_count()
+    old_indices = get_alias_indices()
+    
+    new_index = f"{OPENSEARCH_INDEX}-{datetime.utcnow().strftime('%Y%m%d%H%M%S%f')}"
+    opensearch_request('PUT', new_index, index_mapping)
+    
+    actions = [{"add": {"index": new_index, "alias": OPENSEARCH_INDEX, "is_write_index": True}}]
+    if old_indices:
+        actions += [{"remove": {"index": index, "alias": OPENSEARCH_INDEX}} for index in old_indices]
+    else:
+        # A concrete index still owns the alias name (pre-alias deployments); replace it atomically
+        legacy = requests.head(f"{OPENSEARCH_ENDPOINT}/{OPENSEARCH_INDEX}", timeout=10)
+        if legacy.status_code == 200:
+            actions.append({"remove_index": {"index": OPENSEARCH_INDEX}})
+    opensearch_request('POST', '_aliases', {"actions": actions})
+    
+    logger.info(f"Alias {OPENSEARCH_INDEX} now points to {new_index}; retiring {old_indices}")
+    if old_indices:
+        schedule_index_drop(old_indices, context)
+    
+    return {
+        "deleted_count": previous_count,
+        "previous_count": previous_count,
+        "new_index": new_index,
+        "retired_indices": old_indices,
+        # Completed once every retired index is gone
+        "task_id": "swap:" + ",".join(old_indices) if old_indices else None
+    }
+
+def schedule_index_drop(indices, context=None):
+    """Delete retired indices from an asynchronous invocation of this function"""
+    function_name = getattr(context, 'function_name', None)
+    if not function_name:
+        drop_indices(indices)
+        return
+    
+    lambda_client.invoke(
+        FunctionName=function_name,
+        InvocationType='Event',
+        Payload=json.dumps({"internal_action": "drop_indices", "indices": indices})
+    )
+
+def drop_indices(indices):
+    """Delete retired physical indices created by swap_empty_index, never the one behind the alias"""
+    live = set(get_alias_indices())
+    dropped = []
+    for index in indices:
+        if not isinstance(index, str) or not RETIRED_INDEX_PATTERN.match(index) or index in live:
+            logger.warning(f"Refusing to drop index {index}")
+            continue
+        try:
+            opensearch_request('DELETE', index, timeout=120)
+            dropped.append(index)
+        except Exception as e:
+            logger.error(f"Error dropping index {index}: {str(e)}")
+    logger.info(f"Dropped retired indices: {dropped}")
+    return dropped
+
+def start_delete_by_query(query, routing=None, indices=None, strict=False):
+    """Start a sliced, throttled delete_by_query in the background and return its task ID"""
+    matched_count = get_document_count(query, routing, indices, strict)
+    params = {
+        "slices": DELETE_SLICES,
+        "requests_per_second": DELETE_REQUESTS_PER_SECOND,
+        "conflicts": "proceed",
+        "wait_for_completion": "false"
+    }
+    # With routing, only the shard holding this routing key is scanned
+    params.update(index_params(indices, routing) or {})
+    result = opensearch_request('POST', f"{','.join(indices or [OPENSEARCH_INDEX])}/_delete_by_query",
+                                {"query": query}, params=params)
+    logger.info(f"Started delete_by_query task {result.get('task')} for {matched_count} documents")
+    return {"matched_count": matched_count, "task_id": result.get('task')}
+
+def get_task_status(task_id):
+    """Progress of a delete_by_query task or an index swap"""
+    if task_id.startswith('swap:'):
+        remaining = [index for index in task_id[len('swap:'):].split(',')
+                     if requests.head(f"{OPENSEARCH_ENDPOINT}/{index}", timeout=10).status_code != 404]
+        return {"task_id": task_id, "completed": not remaining, "remaining_indices": remaining}
+    
+    task = opensearch_request('GET', f"_tasks/{task_id}")
+    status = task.get('task', {}).get('status', {})
+    return {
+        "task_id": task_id,
+        "completed": task.get('completed', False),
+        "total": status.get('total', 0),
+        "deleted_count": status.get('deleted', 0),
+        "version_conflicts": status.get('version_conflicts', 0),
+        "failures": task.get('response', {}).get('failures', []),
+        "running_time_seconds": task.get('task', {}).get('running_time_in_nanos', 0) / 1e9
+    }
+
+def start_erasure(user_id):
+    """Start erasing a user's documents and persist the erasure record"""
+    now = time.time()
+    erasure = {
+        "erasure_id": str(uuid.uuid4()),
+        "user_id": user_id,
+        "status": "running",
+        "started_at": now,
+        "updated_at": now,
+        "attempts": 0,
+        "deleted_count": 0,
+        "elapsed_seconds": 0.0,
+        "task_id": None
+    }
+    run_erasure_attempt(erasure)
+    invalidate_user_caches(user_id)
+    create_audit_log("ERASE_USER_STARTED", {
+        "erasure_id": erasure["erasure_id"],
+        "user_id": user_id,
+        "matched_count": erasure["matched_count"],
+        "source": "lambda_empty_function"
+    })
+    return erasure
+
+def run_erasure_attempt(erasure, routed=True):
+    """Issue the user's delete_by_query over every user-data index (routed to the user's shard) and save the record"""
+    user_query = {"term": {"user_id": erasure["user_id"]}}
+    result = start_delete_by_query(user_query, routing=erasure["user_id"] if routed else None,
+                                   indices=ERASURE_INDICES, strict=True)
+    erasure["attempts"] += 1
+    erasure["task_id"] = result["task_id"]
+    erasure["routed"] = routed
+    erasure.setdefault("matched_count", result["matched_count"])
+    save_erasure(erasure)
+
+def advance_erasure(erasure):
+    """Poll the erasure's task, resume it if interrupted, and finish it once no documents remain"""
+    if erasure["status"] != "running":
+        return erasure
+    
     try:
-        # In a real implementation, you would use the OpenSearch client
-        # to delete all documents from the index
-        
-        # Method 1: Delete by query (delete all documents)
-        # delete_response = opensearch_client.delete_by_query(
-        #     index=OPENSEARCH_INDEX,
-        #     body={
-        #         "query": {
-        #             "match_all": {}
-        #         }
-        #     }
-        # )
-        
-        # Method 2: Delete and recreate index
-        # opensearch_client.indices.delete(index=OPENSEARCH_INDEX)
-        # opensearch_client.indices.create(index=OPENSEARCH_INDEX, body=index_mapping)
-        
-        # For demo purposes, simulate successful deletion
-        deleted_count = 3542  # This would come from actual OpenSearch response
-        
-        logger.info(f"Successfully deleted {deleted_count} documents from OpenSearch")
-        return deleted_count
-        
+        task = get_task_status(erasure["task_id"])
     except Exception as e:
-        logger.error(f"Error emptying OpenSearch data: {str(e)}")
-        raise e
+        # The task is gone (node restart, expired task record): pick up where it stopped
+        logger.warning(f"Erasure {erasure['erasure_id']} task {erasure['task_id']} unavailable: {str(e)}")
+        task = {"completed": True, "deleted_count": 0, "running_time_seconds": 0.0, "failures": ["task lost"]}
+    
+    if not task["completed"]:
+        erasure["progress"] = {"deleted_count": task["deleted_count"], "total": task["total"]}
+        erasure["updated_at"] = time.time()
+        save_erasure(erasure)
+        return erasure
+    
+    # Anything left (interrupted task, documents written without the routing key)
+    # is swept by an unrouted retry that checks every shard. An unverified erasure
+    # is never reported complete: on a count error the record stays running and
+    # the next status poll verifies again.
+    try:
+        remaining = get_document_count({"term": {"user_id": erasure["user_id"]}}, indices=ERASURE_INDICES,
+                                       strict=True)
+    except Exception as e:
+        erasure["last_error"] = f"Could not verify remaining documents: {str(e)}"
+        erasure["updated_at"] = time.time()
+        save_erasure(erasure)
+        return erasure
+    
+    erasure.pop("last_error", None)
+    erasure["deleted_count"] += task["deleted_count"]
+    erasure["elapsed_seconds"] += task["running_time_seconds"]
+    erasure.pop("progress", None)
+    
+    if remaining and erasure["attempts"] < ERASURE_MAX_ATTEMPTS:
+        logger.info(f"Resuming erasure {erasure['erasure_id']}: {remaining} documents remain")
+        run_erasure_attempt(erasure, routed=False)
+        return erasure
+    
+    erasure["status"] = "completed" if not remaining else "failed"
+    erasure["remaining_count"] = remaining
+    erasure["docs_per_second"] = (round(erasure["deleted_count"] / erasure["elapsed_seconds"], 1)
+                                  if erasure["elapsed_seconds"] else None)
+    erasure["updated_at"] = time.time()
+    save_erasure(erasure)
+    invalidate_user_caches(erasure["user_id"])
+    
+    create_audit_log("ERASE_USER", {
+        "erasure_id": erasure["erasure_id"],
+        "user_id": erasure["user_id"],
+        "status": erasure["status"],
+        "deleted_count": erasure["deleted_count"],
+        "remaining_count": remaining,
+        "attempts": erasure["attempts"],
+        "elapsed_seconds": erasure["elapsed_seconds"],
+        "docs_per_second": erasure["docs_per_second"],
+        "source": "lambda_empty_function"
+    })
+    return erasure
+
+def invalidate_user_caches(user_id):
+    """Stop connector and assistant caches serving results that include erased documents"""
+    bump_user_generation(user_id)
+    publish_ingest_event([user_id])
+
+def save_erasure(erasure):
+    """Persist an erasure record to S3"""
+    s3_client.put_object(
+        Bucket=S3_BUCKET,
+        Key=f"{ERASURE_PREFIX}/{erasure['erasure_id']}.json",
+        Body=json.dumps(erasure),
+        ContentType='application/json'
+    )
+
+def load_erasure(erasure_id):
+    """Load an erasure record from S3, or None if it does not exist"""
+    try:
+        uuid.UUID(erasure_id)
+        response = s3_client.get_object(Bucket=S3_BUCKET, Key=f"{ERASURE_PREFIX}/{erasure_id}.json")
+        return json.loads(response['Body'].read())
+    except Exception as e:
+        logger.error(f"Error loading erasure {erasure_id}: {str(e)}")
+        return None
 
 def create_audit_log(operation, details):
     """Create audit log entry for the operation"""
@@ -129,7 +405,9 @@ def create_audit_log(operation, details):
         }
         
         # Store audit log in S3
-        s3_key = f"audit-logs/{datetime.now().strftime('%Y/%m/%d')}/empty-{datetime.now().strftime('%H%M%S')}.json"
+        operation_name = operation.lower().replace('_', '-')
+        s3_key = (f"audit-logs/{datetime.now().strftime('%Y/%m/%d')}/"
+                  f"{operation_name}-{datetime.now().strftime('%H%M%S')}-{uuid.uuid4().hex[:8]}.json")
         
         s3_client.put_object(
             Bucket=S3_BUCKET,
@@ -156,11 +434,15 @@ def create_response(status_code, body):
         'body': json.dumps(body)
     }
 
-# Index mapping for recreation (if needed)
+# Index mapping for the fresh indices created by swap_empty_index
 index_mapping = {
     "mappings": {
+        # Writes must carry routing=<user_id>
+        "_routing": {"required": True},
         "properties": {
             "id": {"type": "keyword"},
+            "doc_id": {"type": "keyword"},
+            "user_id": {"type": "keyword"},
             "type": {"type": "keyword"},
             "sourceName": {"type": "keyword"},
             "sourceVersion": {"type": "keyword"},
@@ -179,7 +461,7 @@ index_mapping = {
         }
     },
     "settings": {
-        "number_of_shards": 1,
+        "number_of_shards": HEALTH_INDEX_SHARDS,
         "number_of_replicas": 1
     }
 }
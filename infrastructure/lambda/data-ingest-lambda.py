@@ -6,21 +6,26 @@ import csv
 import xml.etree.ElementTree as ET
 from io import BytesIO, StringIO
 import logging
+import os
 from datetime import datetime
 import uuid
+import requests
+from health_rollups import UPLOADS_ORIGIN, RollupAccumulator
+from hot_context import publish_ingest_event
+from query_cache import bump_user_generation
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Initialize AWS clients
-opensearch_client = boto3.client('opensearchserverless')
 s3_client = boto3.client('s3')
 
 # Configuration
 OPENSEARCH_ENDPOINT = "https://your-service.amazonaws.com"
 OPENSEARCH_INDEX = "health-data"
 S3_BUCKET = "stayfit-healthhq-uploads"
+BULK_BATCH_SIZE = int(os.environ.get('BULK_BATCH_SIZE', '500'))
 
 def lambda_handler(event, context):
     """
@@ -69,8 +74,9 @@ def lambda_handler(event, context):
         elif file_extension == 'json':
             records = process_json_file(file_data)
         
-        # Ingest records into OpenSearch
-        ingested_count = ingest_to_opensearch(records)
+        # Ingest records into OpenSearch, routed to the uploading user's shard
+        user_id = get_user_id(event)
+        ingested_count = ingest_to_opensearch(records, user_id)
         
         # Return success response
         return create_response(200, {
@@ -87,6 +93,16 @@ def lambda_handler(event, context):
         logger.error(f"Error processing file: {str(e)}")
         return create_response(500, {"error": f"Internal server error: {str(e)}"})
 
+def get_user_id(event):
+    """Resolve the uploading user from the authorizer claims, query string or headers"""
+    claims = (event.get('requestContext') or {}).get('authorizer', {}).get('claims', {})
+    if claims.get('sub'):
+        return claims['sub']
+    
+    query = event.get('queryStringParameters') or {}
+    headers = {key.lower(): value for key, value in (event.get('headers') or {}).items()}
+    return query.get('user_id') or headers.get('x-user-id') or 'anonymous'
+
 def parse_multipart_form_data(body, headers):
     """Parse multipart form data to extract file"""
     try:
@@ -250,31 +266,76 @@ def process_json_file(file_data):
     
     return records
 
-def ingest_to_opensearch(records):
-    """Ingest records into OpenSearch"""
+def ingest_to_opensearch(records, user_id):
+    """Ingest records into OpenSearch with the _bulk API, routed by user_id"""
     ingested_count = 0
+    # Uploads are timestamped at ingest, so their rollups are the only view by reading time
+    rollups = RollupAccumulator(origin=UPLOADS_ORIGIN)
     
     try:
-        # In a real implementation, you would use the OpenSearch client
-        # For now, we'll simulate the ingestion
-        
-        # Batch process records (simulate)
-        batch_size = 100
-        for i in range(0, len(records), batch_size):
-            batch = records[i:i + batch_size]
+        for i in range(0, len(records), BULK_BATCH_SIZE):
+            batch = records[i:i + BULK_BATCH_SIZE]
             
-            # Simulate successful ingestion
-            ingested_count += len(batch)
+            lines = []
+            for record in batch:
+                record["user_id"] = user_id
+                # Connector history paging tie-breaks on doc_id
+                record["doc_id"] = record["id"]
+                lines.append(json.dumps({"index": {"_index": OPENSEARCH_INDEX, "_id": record["id"], "routing": user_id}}))
+                lines.append(json.dumps(record))
             
-            logger.info(f"Ingested batch of {len(batch)} records")
+            response = requests.post(
+                f"{OPENSEARCH_ENDPOINT}/_bulk",
+                data="\n".join(lines) + "\n",
+                headers={'Content-Type': 'application/x-ndjson'},
+                timeout=60
+            )
+            if response.status_code != 200:
+                logger.error(f"Bulk request failed: {response.status_code} - {response.text}")
+                continue
+            
+            items = response.json().get('items', [])
+            succeeded = 0
+            for record, item in zip(batch, items):
+                if item.get('index', {}).get('status') in (200, 201):
+                    succeeded += 1
+                    # Only readings that were stored count towards the rollups
+                    rollups.add_record(record)
+            ingested_count += succeeded
+            
+            logger.info(f"Ingested batch of {succeeded}/{len(batch)} records")
         
         logger.info(f"Successfully ingested {ingested_count} records")
         
+        update_rollups(rollups, user_id)
+        
+        if ingested_count:
+            # Connector and assistant caches for this user are now stale
+            bump_user_generation(user_id)
+            publish_ingest_event([user_id])
+        
     except Exception as e:
         logger.error(f"Error ingesting to OpenSearch: {str(e)}")
     
     return ingested_count
 
+def update_rollups(rollups, user_id):
+    """Merge the upload's minute/hour/day buckets into the rollup index"""
+    lines = list(rollups.bulk_lines(user_id))
+    
+    # Two lines (action + script) per bucket
+    for i in range(0, len(lines), BULK_BATCH_SIZE * 2):
+        response = requests.post(
+            f"{OPENSEARCH_ENDPOINT}/_bulk",
+            data="\n".join(lines[i:i + BULK_BATCH_SIZE * 2]) + "\n",
+            headers={'Content-Type': 'application/x-ndjson'},
+            timeout=60
+        )
+        if response.status_code != 200 or response.json().get('errors'):
+            logger.error(f"Rollup update failed: {response.status_code} - {response.text[:500]}")
+    
+    logger.info(f"Updated {len(rollups)} rollup buckets for user {user_id}")
+
 def create_response(status_code, body):
     """Create HTTP response"""
     return {
@@ -0,0 +1,138 @@
+from typing import Any, Dict, List, Optional
+
+# Canned answers served by the health assistant while Bedrock is unavailable.
+#
+# Each template is a format string with a single {data_points} slot, filled
+# with str.format_map instead of searching and replacing the disclaimer in the
+# multi-paragraph text. The slot holds one bullet per reading type found in the
+# user's health context, or nothing when there are none; any type is
+# rendered, using READING_FORMATS for known types and the reading's own unit
+# and a humanized type name otherwise. The templates themselves hold only
+# general reference ranges, never figures about the user.
+
+FALLBACK_RESPONSES = {
+    "heart_rate": """I can share some general insights about heart rate patterns:
+
+A resting heart rate between 60 and 100 beats per minute is considered within the normal range for adults.
+
+Key insights about heart rate:
+• A consistent resting heart rate indicates good cardiovascular health
+• Factors like fitness level, age, and stress can influence heart rate
+• Regular monitoring helps identify trends over time
+
+{data_points}Remember to consult your healthcare provider for medical advice.""",
+
+    "activity": """Here are some general observations about activity:
+
+A common goal is 10,000 steps a day, but any regular movement is beneficial for health.
+
+Activity insights:
+• Consistent daily movement supports cardiovascular health
+• Regular walking contributes to overall fitness and well-being
+• Gradual increases in activity are easier to sustain
+
+Consider maintaining or gradually increasing your activity levels as comfortable.
+
+{data_points}Remember to consult your healthcare provider for medical advice.""",
+
+    "sleep": """Here are some general insights about sleep:
+
+Adults are generally recommended to sleep 7 to 9 hours a night for recovery and health.
+
+Sleep pattern observations:
+• Consistent sleep duration supports overall health
+• Quality sleep is essential for physical and mental well-being
+• Regular sleep patterns help maintain your body's natural rhythms
+
+{data_points}Remember to consult your healthcare provider for medical advice.""",
+
+    "general": """Thank you for your health question. While I'm experiencing high demand right now, I can share some general insights:
+
+Based on typical health data patterns:
+• Regular monitoring of health metrics helps identify trends
+• Consistent patterns in heart rate, activity, and sleep are positive indicators
+• Small, sustainable changes often lead to the best health outcomes
+
+Your engagement with health tracking shows a proactive approach to wellness, which is excellent for long-term health management.
+
+{data_points}For personalized medical advice and specific health concerns, please consult with your healthcare provider.
+
+Remember to consult your healthcare provider for medical advice."""
+}
+
+# Bullet label and default unit per reading type
+READING_FORMATS = {
+    "heart_rate": ("Heart rate", "bpm"),
+    "resting_heart_rate": ("Resting heart rate", "bpm"),
+    "heart_rate_variability": ("Heart rate variability", "ms"),
+    "steps": ("Daily steps", "steps"),
+    "distance": ("Distance", "km"),
+    "active_energy": ("Active energy", "kcal"),
+    "exercise_minutes": ("Exercise", "min"),
+    "sleep": ("Sleep duration", "hours"),
+    "weight": ("Weight", "kg"),
+    "blood_oxygen": ("Blood oxygen", "%")
+}
+
+# Reading types shown with each topical response; the general response shows every type
+RESPONSE_READING_TYPES = {
+    "heart_rate": {"heart_rate", "resting_heart_rate", "heart_rate_variability"},
+    "activity": {"steps", "distance", "active_energy", "exercise_minutes", "workout"},
+    "sleep": {"sleep", "sleep_duration", "sleep_quality"}
+}
+
+DATA_POINTS_HEADER = "Based on your recent data:\n"
+MAX_DATA_POINTS = 3
+
+
+def _format_value(value: Any) -> str:
+    if type(value) is int:
+        return f"{value:,}"
+    if type(value) is float:
+        return f"{int(value):,}" if value.is_integer() else f"{value:,.1f}"
+    return str(value)
+
+
+def format_data_point(reading: Dict[str, Any]) -> str:
+    """
+    One bullet for a reading of any type
+    """
+    data_type = reading.get('type') or 'reading'
+    label, default_unit = READING_FORMATS.get(data_type) or (data_type.replace('_', ' ').capitalize(), "")
+    unit = reading.get('unit') or default_unit
+    context = reading.get('context')
+    return (f"• {label}: {_format_value(reading.get('value'))}{' ' + unit if unit else ''}"
+            f"{f' ({context})' if context and context != unit else ''}\n")
+
+
+def render_data_points(response_type: str, health_context: Optional[List[Dict]],
+                       limit: int = MAX_DATA_POINTS) -> str:
+    """
+    Bullets for the first reading of each relevant type, most relevant first
+    """
+    if not health_context:
+        return ""
+
+    wanted = RESPONSE_READING_TYPES.get(response_type)
+    seen = set()
+    lines = []
+    for reading in health_context:
+        data_type = reading.get('type')
+        if data_type in seen or (wanted is not None and data_type not in wanted):
+            continue
+        seen.add(data_type)
+        lines.append(format_data_point(reading))
+        if len(lines) == limit:
+            break
+
+    if not lines:
+        return ""
+    return DATA_POINTS_HEADER + "".join(lines) + "\n"
+
+
+def render_fallback(response_type: str, health_context: Optional[List[Dict]] = None) -> str:
+    """
+    Render the fallback response for a topic with the user's own data points
+    """
+    template = FALLBACK_RESPONSES.get(response_type, FALLBACK_RESPONSES["general"])
+    return template.format_map({"data_points": render_data_points(response_type, health_context)})
@@ -0,0 +1,137 @@
+import re
+from typing import Dict, Iterable, List
+
+# Compiled multi-pattern keyword matcher for the health assistant guardrails.
+#
+# All keyword categories are merged once at import into a single keyword trie,
+# which is emitted as one prefix-factored regular expression. Matches must start
+# on a word boundary and, unless the keyword ends with "*" (a stem such as
+# "diagnos*"), end on one too, so "cure" no longer matches inside "secure".
+#
+# The single regex tries every keyword at every position, which is cheapest for
+# chat-sized messages but slower than literal substring search on long text.
+# Messages of LONG_MESSAGE_CHARS or more are instead scanned once per group of
+# keywords sharing a GROUP_PREFIX_CHARS prefix, with the prefix leading the
+# pattern so the regex engine skips ahead with its literal search. Both scans
+# find the same keywords; tests/benchmark_guardrail_matcher.py measures them.
+
+LONG_MESSAGE_CHARS = 1024
+GROUP_PREFIX_CHARS = 3
+
+# Keyword categories used by the health assistant lambdas
+HEALTH_ASSISTANT_CATEGORIES = {
+    # Blocked by the medical advice filter
+    "medical": [
+        "diagnos*", "prescri*", "medication*", "treatment*", "cure", "cures", "cured",
+        "medicine*", "drug*", "dosage*", "should i take"
+    ],
+    # Blocked by the harmful content filter
+    "harmful": [
+        "suicid*", "self-harm*", "kill myself", "end my life", "hurt myself"
+    ],
+    # Answered with emergency support resources
+    "emergency": [
+        "suicid*", "self-harm*", "kill myself", "emergency", "emergencies"
+    ],
+    # Answered with the medical disclaimer
+    "medical_disclaimer": [
+        "diagnos*", "prescri*", "treatment*", "medication*"
+    ],
+    # Fallback routing intents
+    "heart_rate": ["heart*", "pulse*", "bpm", "cardiac", "cardio*"],
+    "activity": ["step", "steps", "walk*", "activit*", "exercis*", "movement*"],
+    "sleep": ["sleep*", "rest", "resting", "rested", "restful", "tired*", "fatigue*"]
+}
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == "_"
+
+
+class KeywordMatcher:
+    """
+    Keyword trie compiled to regexes that classify text into categories in one pass per strategy
+    """
+
+    def __init__(self, categories: Dict[str, Iterable[str]]):
+        keywords: Dict[str, bool] = {}
+        keyword_categories: Dict[str, set] = {}
+        for category, category_keywords in categories.items():
+            for keyword in category_keywords:
+                pattern = keyword.rstrip("*").lower()
+                keywords[pattern] = keywords.get(pattern, False) or keyword.endswith("*")
+                keyword_categories.setdefault(pattern, set()).add(category)
+
+        # The scan reports the longest keyword at each position, so it also
+        # carries the categories of every shorter keyword that would have matched there
+        self._categories: Dict[str, List[str]] = {}
+        for pattern in keywords:
+            found = set()
+            for prefix, is_stem in keywords.items():
+                if pattern.startswith(prefix) and (
+                        is_stem or len(prefix) == len(pattern) or not _is_word_char(pattern[len(prefix)])):
+                    found |= keyword_categories[prefix]
+            self._categories[pattern] = sorted(found)
+
+        trie: Dict = {}
+        for pattern, is_stem in keywords.items():
+            node = trie
+            for char in pattern:
+                node = node.setdefault(char, {})
+            node[""] = is_stem
+
+        self._regex = re.compile(r"\b" + self._emit(trie))
+        # Each group checks its word boundary after the literal prefix, keeping the prefix first
+        self._group_regexes = [
+            re.compile(re.escape(prefix) + r"(?<!\w" + re.escape(prefix) + ")" + self._emit(node))
+            for prefix, node in self._groups(trie, "")
+        ]
+
+    def _groups(self, node: Dict, prefix: str):
+        # Subtries below each GROUP_PREFIX_CHARS prefix; shorter keywords form their own group
+        if len(prefix) >= GROUP_PREFIX_CHARS:
+            yield prefix, node
+            return
+        for char, child in sorted(node.items()):
+            if char:
+                yield from self._groups(child, prefix + char)
+        if "" in node and prefix:
+            yield prefix, {"": node[""]}
+
+    def _emit(self, node: Dict) -> str:
+        # Children first so the longest keyword wins; a keyword ending here comes last
+        alternatives = [re.escape(char) + self._emit(child) for char, child in sorted(node.items()) if char]
+        if "" in node:
+            alternatives.append("" if node[""] else r"(?!\w)")
+        if len(alternatives) == 1:
+            return alternatives[0]
+        return "(?:" + "|".join(alternatives) + ")"
+
+    def match(self, text: str) -> Dict[str, List[str]]:
+        """
+        Return the keywords matched in each category
+        """
+        text = text.lower()
+        if len(text) < LONG_MESSAGE_CHARS:
+            found = set(self._regex.findall(text))
+        else:
+            found = set()
+            for regex in self._group_regexes:
+                found.update(regex.findall(text))
+
+        matches: Dict[str, List[str]] = {}
+        for keyword in found:
+            for category in self._categories[keyword]:
+                matches.setdefault(category, []).append(keyword)
+        return matches
+
+
+# Compiled once per container
+HEALTH_ASSISTANT_MATCHER = KeywordMatcher(HEALTH_ASSISTANT_CATEGORIES)
+
+
+def classify_message(message: str) -> Dict[str, List[str]]:
+    """
+    Classify a user message into all health assistant keyword categories at once
+    """
+    return HEALTH_ASSISTANT_MATCHER.match(message or "")
@@ -0,0 +1,383 @@
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+# OpenSearch index definition and query bodies for the health index, shared by
+# the MCP connector, the indexer and the assistant lambdas so all of them
+# write, rank and filter readings the same way.
+#
+# Documents are routed by user_id: every write and every per-user read passes
+# routing=<user_id>, so a user's readings live on one shard and per-user
+# queries touch only that shard while the index itself can have many.
+
+# Embeddings are never needed in responses and dominate document size
+SOURCE_EXCLUDES = ["embeddings"]
+
+# Fields each read path uses; requests may narrow these but embeddings are never returned
+READ_FIELDS = {
+    "search": ["data_type", "value", "unit", "timestamp", "source", "metadata"],
+    "history": ["doc_id", "data_type", "value", "unit", "timestamp", "source", "metadata"],
+    "context": ["data_type", "value", "unit", "timestamp", "search_text"]
+}
+
+HEALTH_INDEX_SHARDS = int(os.environ.get('HEALTH_INDEX_SHARDS', '3'))
+
+HEALTH_INDEX_BODY = {
+    "mappings": {
+        # Reject writes that forget the routing key
+        "_routing": {"required": True},
+        "properties": {
+            "timestamp": {"type": "date"},
+            "user_id": {"type": "keyword"},
+            # Unique per document; the tiebreaker for search_after pagination
+            "doc_id": {"type": "keyword"},
+            "data_type": {"type": "keyword"},
+            "value": {"type": "float"},
+            "unit": {"type": "keyword"},
+            "source": {"type": "keyword"},
+            "device": {"type": "keyword"},
+            "location": {"type": "geo_point"},
+            "tags": {"type": "keyword"},
+            "metadata": {
+                "type": "object",
+                "properties": {
+                    "activity": {"type": "keyword"},
+                    "sleep_stage": {"type": "keyword"},
+                    "heart_rate_zone": {"type": "keyword"}
+                }
+            },
+            "embeddings": {
+                "type": "dense_vector",
+                "dims": 1536
+            },
+            # Set when the embedding call failed; the backfill job adds the vector later
+            "embedding_pending": {"type": "boolean"},
+            "embedding_attempts": {"type": "integer"},
+            "embedding_failed": {"type": "boolean"},
+            "indexed_at": {"type": "date"},
+            "search_text": {"type": "text", "analyzer": "standard"}
+        }
+    },
+    "settings": {
+        "number_of_shards": HEALTH_INDEX_SHARDS,
+        "number_of_replicas": 0,
+        "analysis": {
+            "analyzer": {
+                "health_analyzer": {
+                    "type": "custom",
+                    "tokenizer": "standard",
+                    "filter": ["lowercase", "stop"]
+                }
+            }
+        }
+    }
+}
+
+
+def readable_fields() -> List[str]:
+    """
+    Top-level mapped fields a client may ask for
+    """
+    return [field for field in HEALTH_INDEX_BODY["mappings"]["properties"] if field not in SOURCE_EXCLUDES]
+
+
+def project_fields(action: str, requested: Optional[List[str]] = None) -> List[str]:
+    """
+    Requested fields limited to readable ones, or the action's default field list
+    """
+    if requested:
+        allowed = set(readable_fields())
+        fields = [field for field in requested if field in allowed]
+        if fields:
+            return fields
+    return READ_FIELDS[action]
+
+
+def source_filter(fields: Optional[List[str]] = None) -> Dict[str, List[str]]:
+    """
+    _source filter returning only the given fields, never embeddings
+    """
+    source = {"excludes": SOURCE_EXCLUDES}
+    if fields:
+        source["includes"] = [field for field in fields if field not in SOURCE_EXCLUDES]
+    return source
+
+
+def to_columnar(rows: List[Dict[str, Any]], fields: List[str]) -> Dict[str, Any]:
+    """
+    Encode result rows as one array per field, so keys are sent once instead of per row
+    """
+    return {"fields": fields, "columns": {field: [row.get(field) for row in rows] for field in fields}}
+
+
+def routing_params(user_id: str) -> Dict[str, str]:
+    """
+    Query-string parameters that pin a request to the user's shard
+    """
+    return {"routing": user_id}
+
+
+def build_filter_clauses(filters: Optional[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """
+    Translate connector-style filters (data_type, date_range) into bool filter clauses
+    """
+    clauses = []
+    if not filters:
+        return clauses
+
+    if filters.get('data_type'):
+        clauses.append({"term": {"data_type": filters['data_type']}})
+    if filters.get('date_range'):
+        clauses.append({
+            "range": {
+                "timestamp": {
+                    "gte": filters['date_range'].get('start'),
+                    "lte": filters['date_range'].get('end')
+                }
+            }
+        })
+    return clauses
+
+
+def build_search_query(query: str, user_id: str, query_embedding: Optional[List[float]] = None,
+                       filters: Optional[Dict[str, Any]] = None, limit: int = 10,
+                       timeout_ms: Optional[int] = None, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    Hybrid keyword + vector search over one user's readings
+    """
+    should = [
+        # Keyword search
+        {
+            "multi_match": {
+                "query": query,
+                "fields": ["data_type^2", "search_text", "metadata.*"],
+                "type": "best_fields",
+                "boost": 2.0
+            }
+        }
+    ]
+    if query_embedding:
+        # Semantic search using embeddings; documents still waiting for a vector
+        # are left to the keyword clause, since cosineSimilarity fails without one
+        should.append({
+            "script_score": {
+                "query": {"exists": {"field": "embeddings"}},
+                "script": {
+                    "source": "cosineSimilarity(params.query_vector, 'embeddings') + 1.0",
+                    "params": {"query_vector": query_embedding}
+                },
+                "boost": 1.5
+            }
+        })
+
+    bool_query = {
+        "must": [{"term": {"user_id": user_id}}],
+        "should": should,
+        "minimum_should_match": 1
+    }
+    filter_clauses = build_filter_clauses(filters)
+    if filter_clauses:
+        bool_query["filter"] = filter_clauses
+
+    search_query = {
+        "size": limit,
+        "_source": source_filter(fields or READ_FIELDS["search"]),
+        "query": {"bool": bool_query},
+        "sort": [
+            {"_score": {"order": "desc"}},
+            {"timestamp": {"order": "desc"}}
+        ]
+    }
+    if timeout_ms is not None:
+        # Let OpenSearch return whatever it has gathered before the deadline
+        search_query["timeout"] = f"{max(timeout_ms, 1)}ms"
+    return search_query
+
+
+# Newest first, then a unique key so every page boundary is unambiguous
+HISTORY_SORT = [
+    {"timestamp": {"order": "desc"}},
+    {"doc_id": {"order": "asc", "missing": "_last"}}
+]
+
+
+def build_history_query(user_id: str, query: str = "", filters: Optional[Dict[str, Any]] = None,
+                        size: int = 100, fields: Optional[List[str]] = None) -> Dict[str, Any]:
+    """
+    One user's readings in time order, for search_after pagination
+    """
+    bool_query = {"filter": [{"term": {"user_id": user_id}}] + build_filter_clauses(filters)}
+    if query:
+        bool_query["must"] = [{
+            "multi_match": {
+                "query": query,
+                "fields": ["data_type^2", "search_text", "metadata.*"],
+                "type": "best_fields"
+            }
+        }]
+
+    return {
+        "size": size,
+        "_source": source_filter(fields or READ_FIELDS["history"]),
+        "query": {"bool": bool_query},
+        "sort": HISTORY_SORT,
+        "track_total_hits": False
+    }
+
+
+CALENDAR_INTERVALS = {
+    "minute": "minute", "1m": "minute",
+    "hour": "hour", "1h": "hour",
+    "day": "day", "1d": "day",
+    "week": "week", "1w": "week",
+    "month": "month", "1M": "month",
+    "quarter": "quarter", "1q": "quarter",
+    "year": "year", "1y": "year"
+}
+FIXED_INTERVAL_PATTERN = re.compile(r"^\d+(ms|s|m|h|d)$")
+
+
+def histogram_interval(interval: str) -> Dict[str, str]:
+    """
+    date_histogram interval parameter: calendar units where they exist, fixed durations otherwise
+    """
+    if interval in CALENDAR_INTERVALS:
+        return {"calendar_interval": CALENDAR_INTERVALS[interval]}
+    if FIXED_INTERVAL_PATTERN.match(interval):
+        return {"fixed_interval": interval}
+    raise ValueError(f"Unsupported interval: {interval}")
+
+
+def build_aggregation_query(user_id: str, data_types: Optional[List[str]] = None, interval: str = "day",
+                            time_zone: str = "UTC", start: Optional[str] = None, end: Optional[str] = None,
+                            percentiles: Optional[List[float]] = None, max_types: int = 50) -> Dict[str, Any]:
+    """
+    Per-type time series of value stats (and optional percentiles) over [start, end), without returning hits
+    """
+    filters = [{"term": {"user_id": user_id}}]
+    if data_types:
+        filters.append({"terms": {"data_type": data_types}})
+    if start or end:
+        # Half-open like the rollup buckets, so raw and rollup aggregations of a range agree
+        time_range = {key: value for key, value in (("gte", start), ("lt", end)) if value}
+        filters.append({"range": {"timestamp": time_range}})
+
+    histogram = dict(histogram_interval(interval), field="timestamp", time_zone=time_zone, min_doc_count=0)
+    if start and end:
+        # Emit empty buckets across the whole requested range
+        histogram["extended_bounds"] = {"min": start, "max": end}
+
+    bucket_aggs = {"stats": {"stats": {"field": "value"}}}
+    if percentiles:
+        bucket_aggs["percentiles"] = {"percentiles": {"field": "value", "percents": percentiles}}
+
+    return {
+        "size": 0,
+        "query": {"bool": {"filter": filters}},
+        "aggs": {
+            "by_type": {
+                "terms": {"field": "data_type", "size": max_types},
+                "aggs": {
+                    "series": {
+                        "date_histogram": histogram,
+                        "aggs": bucket_aggs
+                    }
+                }
+            }
+        }
+    }
+
+
+def build_search_text(document: Dict[str, Any]) -> str:
+    """
+    Text a reading is embedded from: its type, value, unit and metadata values
+    """
+    search_text = f"{document.get('data_type')} {document.get('value')} {document.get('unit', '')}"
+    if document.get('metadata'):
+        search_text += " " + " ".join(str(v) for v in document['metadata'].values())
+    return search_text
+
+
+def build_backfill_query(size: int = 100, user_id: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Documents indexed without a vector, oldest first, with just what re-embedding needs
+    """
+    filters = [{"term": {"embedding_pending": True}}]
+    if user_id:
+        filters.append({"term": {"user_id": user_id}})
+    return {
+        "size": size,
+        "_source": source_filter(["user_id", "search_text", "embedding_attempts"]),
+        "query": {"bool": {"filter": filters}},
+        "sort": [{"indexed_at": {"order": "asc"}}],
+        "track_total_hits": False
+    }
+
+
+def build_hot_context_query(user_id: str, window: str = "24h", max_types: int = 50) -> Dict[str, Any]:
+    """
+    Latest reading per data type plus value stats over a recent window, without returning hits
+    """
+    return {
+        "size": 0,
+        "query": {"bool": {"filter": [{"term": {"user_id": user_id}}]}},
+        "aggs": {
+            "by_type": {
+                "terms": {"field": "data_type", "size": max_types},
+                "aggs": {
+                    "latest": {
+                        "top_hits": {
+                            "size": 1,
+                            "sort": [{"timestamp": {"order": "desc"}}],
+                            "_source": source_filter(READ_FIELDS["context"])
+                        }
+                    },
+                    "recent": {
+                        "filter": {"range": {"timestamp": {"gte": f"now-{window}"}}},
+                        "aggs": {"stats": {"stats": {"field": "value"}}}
+                    }
+                }
+            }
+        }
+    }
+
+
+def _benchmark(hits: int = 100, rounds: int = 50):
+    """
+    Compare response size and JSON parse time: full _source vs projected vs columnar
+    """
+    import json
+    import random
+    import time
+
+    def hit(i: int, source: Dict[str, Any]) -> Dict[str, Any]:
+        return {"_index": "health-data-index", "_id": f"doc-{i}", "_score": 1.5, "_source": source}
+
+    documents = []
+    for i in range(hits):
+        documents.append({
+            "timestamp": f"2024-01-{i % 28 + 1:02d}T08:00:00", "user_id": "user-1", "doc_id": f"doc-{i}",
+            "data_type": "heart_rate", "value": 60 + i % 40, "unit": "bpm", "source": "apple_health",
+            "device": "watch", "tags": [], "metadata": {"activity": "rest"}, "indexed_at": "2024-01-29T00:00:00",
+            "search_text": f"heart_rate {60 + i % 40} bpm rest",
+            "embeddings": [random.random() for _ in range(1536)]
+        })
+
+    fields = READ_FIELDS["search"]
+    full = {"hits": {"hits": [hit(i, doc) for i, doc in enumerate(documents)]}}
+    projected = {"hits": {"hits": [hit(i, {f: doc[f] for f in fields}) for i, doc in enumerate(documents)]}}
+    rows = [dict({f: doc[f] for f in fields}, id=f"doc-{i}") for i, doc in enumerate(documents)]
+    columnar = to_columnar(rows, ["id"] + fields)
+
+    for name, payload in (("full _source", full), ("projected", projected),
+                          ("projected rows", {"results": rows}), ("columnar", columnar)):
+        encoded = json.dumps(payload)
+        start = time.perf_counter()
+        for _ in range(rounds):
+            json.loads(encoded)
+        parse_ms = (time.perf_counter() - start) * 1000 / rounds
+        print(f"{name:<15} {len(encoded):>10,} bytes  {parse_ms:8.3f} ms parse")
+
+
+if __name__ == "__main__":
+    _benchmark()
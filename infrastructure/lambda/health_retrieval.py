@@ -0,0 +1,191 @@
+import asyncio
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import boto3
+import requests
+
+from health_query import READ_FIELDS, build_hot_context_query, build_search_query, routing_params
+from hot_context import HotContextCache, ingest_event_user_ids, needs_history, parse_hot_context, snapshot_to_context
+
+# Configure logging
+logger = logging.getLogger()
+
+# Health-context retrieval for the assistant lambdas.
+#
+# Retrieval is two blocking stages, the Titan query embedding and the
+# OpenSearch query, run on a shared thread pool so the handler can overlap
+# them with guardrail evaluation. Each stage has its own deadline inside a
+# total budget: a late embedding degrades to a keyword-only query, and the
+# search itself asks OpenSearch to return partial hits before the budget ends.
+# Questions about current readings are answered from the per-user hot context
+# instead, which costs one aggregation query per user per TTL.
+
+OPENSEARCH_ENDPOINT = os.environ.get('OPENSEARCH_ENDPOINT', 'https://your-service.amazonaws.com')
+if not OPENSEARCH_ENDPOINT.startswith('http'):
+    OPENSEARCH_ENDPOINT = f"https://{OPENSEARCH_ENDPOINT}"
+HEALTH_INDEX = os.environ.get('HEALTH_INDEX', 'health-data-index')
+EMBEDDING_MODEL_ID = "amazon.titan-embed-text-v1"
+
+CONTEXT_BUDGET_MS = int(os.environ.get('CONTEXT_BUDGET_MS', '1500'))
+EMBEDDING_DEADLINE_MS = int(os.environ.get('EMBEDDING_DEADLINE_MS', '500'))
+CONTEXT_RESULT_LIMIT = int(os.environ.get('CONTEXT_RESULT_LIMIT', '10'))
+
+# Reused across invocations so stage threads are not recreated per request
+executor = ThreadPoolExecutor(max_workers=int(os.environ.get('RETRIEVAL_WORKERS', '4')))
+hot_context_cache = HotContextCache()
+_bedrock_runtime = None
+
+
+def _get_bedrock_runtime():
+    global _bedrock_runtime
+    if _bedrock_runtime is None:
+        _bedrock_runtime = boto3.client('bedrock-runtime')
+    return _bedrock_runtime
+
+
+def generate_query_embedding(text: str) -> Optional[List[float]]:
+    """
+    Embed the question with Titan; None if the call fails
+    """
+    try:
+        response = _get_bedrock_runtime().invoke_model(
+            modelId=EMBEDDING_MODEL_ID,
+            body=json.dumps({"inputText": text}),
+            contentType='application/json',
+            accept='application/json'
+        )
+        return json.loads(response['body'].read()).get('embedding') or None
+    except Exception as e:
+        logger.error(f"Error generating query embedding: {str(e)}")
+        return None
+
+
+def search_health_data(query: str, user_id: str, query_embedding: Optional[List[float]] = None,
+                       timeout_ms: int = CONTEXT_BUDGET_MS, limit: int = CONTEXT_RESULT_LIMIT) -> List[Dict]:
+    """
+    Query the health index for the user's readings most relevant to the question
+    """
+    search_query = build_search_query(query, user_id, query_embedding, limit=limit, timeout_ms=timeout_ms,
+                                      fields=READ_FIELDS["context"])
+
+    try:
+        response = requests.post(
+            f"{OPENSEARCH_ENDPOINT}/{HEALTH_INDEX}/_search",
+            json=search_query,
+            params=routing_params(user_id),
+            headers={'Content-Type': 'application/json'},
+            timeout=timeout_ms / 1000 + 0.25
+        )
+        if response.status_code != 200:
+            logger.error(f"Search failed: {response.status_code} - {response.text}")
+            return []
+
+        results = response.json()
+        if results.get('timed_out'):
+            logger.warning(f"Health data search timed out, using partial results for user {user_id}")
+
+        health_data = []
+        for hit in results.get('hits', {}).get('hits', []):
+            source = hit['_source']
+            health_data.append({
+                "type": source.get('data_type'),
+                "value": source.get('value'),
+                "unit": source.get('unit', ''),
+                "timestamp": source.get('timestamp'),
+                "context": source.get('search_text') or source.get('unit', ''),
+                "score": hit.get('_score', 0)
+            })
+
+        logger.info(f"Retrieved {len(health_data)} health data points for user {user_id}")
+        return health_data
+
+    except Exception as e:
+        logger.error(f"Error searching health data: {str(e)}")
+        return []
+
+
+def load_hot_context(user_id: str, timeout_ms: int = CONTEXT_BUDGET_MS) -> Optional[Dict]:
+    """
+    Fetch the user's latest reading per type and recent stats in one aggregation query
+    """
+    try:
+        response = requests.post(
+            f"{OPENSEARCH_ENDPOINT}/{HEALTH_INDEX}/_search",
+            json=build_hot_context_query(user_id),
+            params=routing_params(user_id),
+            headers={'Content-Type': 'application/json'},
+            timeout=timeout_ms / 1000
+        )
+        if response.status_code != 200:
+            logger.error(f"Hot context query failed: {response.status_code} - {response.text}")
+            return None
+        return parse_hot_context(response.json())
+    except Exception as e:
+        logger.error(f"Error loading hot context: {str(e)}")
+        return None
+
+
+def handle_ingest_event(event: Dict) -> Optional[int]:
+    """
+    Drop hot context for users named in an ingest event; None if the event is not one
+    """
+    user_ids = ingest_event_user_ids(event)
+    if user_ids is None:
+        return None
+    for user_id in user_ids:
+        hot_context_cache.invalidate(user_id)
+    logger.info(f"Invalidated hot context for {len(user_ids)} users")
+    return len(user_ids)
+
+
+async def retrieve_health_context(query: str, user_id: str, budget_ms: int = CONTEXT_BUDGET_MS) -> List[Dict]:
+    """
+    Embed and search within the latency budget, returning partial context rather than failing
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + budget_ms / 1000
+
+    if not needs_history(query):
+        snapshot = hot_context_cache.get(user_id)
+        if snapshot is None:
+            try:
+                snapshot = await asyncio.wait_for(
+                    loop.run_in_executor(executor, load_hot_context, user_id, budget_ms),
+                    timeout=budget_ms / 1000
+                )
+            except asyncio.TimeoutError:
+                logger.warning("Hot context load exceeded the context budget")
+                snapshot = None
+            if snapshot is not None:
+                hot_context_cache.put(user_id, snapshot)
+        if snapshot and snapshot["latest"]:
+            return snapshot_to_context(snapshot)
+        if deadline <= loop.time():
+            return []
+
+    try:
+        query_embedding = await asyncio.wait_for(
+            loop.run_in_executor(executor, generate_query_embedding, query),
+            timeout=min(EMBEDDING_DEADLINE_MS, budget_ms) / 1000
+        )
+    except asyncio.TimeoutError:
+        logger.warning("Query embedding missed its deadline, searching by keyword only")
+        query_embedding = None
+
+    remaining_ms = int((deadline - loop.time()) * 1000)
+    if remaining_ms <= 0:
+        return []
+
+    try:
+        # Leave headroom for OpenSearch to return partial hits before the hard deadline
+        return await asyncio.wait_for(
+            loop.run_in_executor(executor, search_health_data, query, user_id, query_embedding, int(remaining_ms * 0.8)),
+            timeout=remaining_ms / 1000
+        )
+    except asyncio.TimeoutError:
+        logger.warning(f"Health data search exceeded the {budget_ms} ms context budget")
+        return []
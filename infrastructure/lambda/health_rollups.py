@@ -0,0 +1,454 @@
+import hashlib
+import json
+import os
+import re
+from datetime import datetime, timezone
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from health_query import CALENDAR_INTERVALS, HEALTH_INDEX_SHARDS, histogram_interval
+
+# Downsampled rollups of numeric readings, maintained at ingest time.
+#
+# Wearables report heart rate and steps every few seconds, but charts and the
+# assistant usually want hourly or daily resolution. For every user, data type
+# and UTC bucket of each tier (minute, hour, day) a rollup document keeps
+# count/min/max/sum/avg. Writers upsert rollups with a script that merges the
+# new batch into the stored totals, so a bucket can be filled by many uploads.
+# Rollups are routed by user_id like the readings themselves. Readers choose
+# the coarsest tier whose buckets compose the requested interval and the
+# half-open range [start, end), and fall back to raw readings otherwise
+# (e.g. for percentiles, which cannot be merged from rollups).
+#
+# Rollups have one of two origins. "readings" rollups summarize the
+# connector's index, ROLLUP_SOURCE_INDEX, which is also the index raw
+# aggregations read, so both paths see the same readings and data_type names.
+# Readings indexed before a user's rollups existed are in no bucket, so readers
+# only use these rollups for a range recorded as covered: a per-user coverage
+# document, written by a rebuild from the source index, holds the reading time
+# from which that user's rollups are complete. Writers delete it when a rollup
+# update fails, and it is erased with the rollups.
+#
+# "uploads" rollups summarize Apple Health uploads, which data-ingest writes to
+# the upload index with HealthKit type names and string values, timestamped at
+# ingest time. That index cannot be aggregated by reading time, so these
+# rollups are the only aggregate view of uploads: data-ingest maintains them
+# for every upload, with types mapped to the connector's data_type names, and
+# readers serve them without a raw fallback or coverage check. Uploads made
+# before upload rollups existed are not in them.
+#
+# Upserts are not idempotent: replaying the same batch counts it twice, just
+# as re-uploading a file indexes its readings twice.
+
+ROLLUP_INDEX = os.environ.get('HEALTH_ROLLUP_INDEX', 'health-rollups')
+# The connector's HEALTH_INDEX, which its raw aggregations read
+ROLLUP_SOURCE_INDEX = "health-data-index"
+
+TIERS = ["minute", "hour", "day"]
+TIER_SECONDS = {"minute": 60, "hour": 3600, "day": 86400}
+TIER_FIXED_INTERVALS = {"minute": "1m", "hour": "1h", "day": "1d"}
+COVERAGE_TIER = "coverage"
+READINGS_ORIGIN = "readings"
+UPLOADS_ORIGIN = "uploads"
+ORIGINS = [READINGS_ORIGIN, UPLOADS_ORIGIN]
+
+# HealthKit type identifiers of uploads and the connector data_type they roll up into
+UPLOAD_DATA_TYPES = {
+    "HKQuantityTypeIdentifierHeartRate": "heart_rate",
+    "HKQuantityTypeIdentifierRestingHeartRate": "resting_heart_rate",
+    "HKQuantityTypeIdentifierHeartRateVariabilitySDNN": "heart_rate_variability",
+    "HKQuantityTypeIdentifierStepCount": "steps",
+    "HKQuantityTypeIdentifierDistanceWalkingRunning": "distance",
+    "HKQuantityTypeIdentifierActiveEnergyBurned": "active_energy",
+    "HKQuantityTypeIdentifierAppleExerciseTime": "exercise_minutes",
+    "HKQuantityTypeIdentifierBodyMass": "weight",
+    "HKQuantityTypeIdentifierOxygenSaturation": "blood_oxygen",
+    "HKQuantityTypeIdentifierRespiratoryRate": "respiratory_rate",
+    "HKQuantityTypeIdentifierBodyTemperature": "body_temperature"
+}
+HEALTHKIT_PREFIXES = ("HKQuantityTypeIdentifier", "HKCategoryTypeIdentifier")
+
+ROLLUP_INDEX_BODY = {
+    "mappings": {
+        "_routing": {"required": True},
+        "properties": {
+            "user_id": {"type": "keyword"},
+            "data_type": {"type": "keyword"},
+            "tier": {"type": "keyword"},
+            "origin": {"type": "keyword"},
+            "bucket": {"type": "date"},
+            "count": {"type": "long"},
+            "min": {"type": "double"},
+            "max": {"type": "double"},
+            "sum": {"type": "double"},
+            "avg": {"type": "double"},
+            "covered_from": {"type": "date"},
+            "updated_at": {"type": "date"}
+        }
+    },
+    "settings": {
+        "number_of_shards": HEALTH_INDEX_SHARDS,
+        "number_of_replicas": 0
+    }
+}
+
+MERGE_SCRIPT = (
+    "ctx._source.count += params.count; "
+    "ctx._source.sum += params.sum; "
+    "ctx._source.min = Math.min(ctx._source.min, params.min); "
+    "ctx._source.max = Math.max(ctx._source.max, params.max); "
+    "ctx._source.avg = ctx._source.sum / ctx._source.count; "
+    "ctx._source.updated_at = params.updated_at"
+)
+
+# Seconds per interval unit; calendar units of a day or more only need to divide by days
+INTERVAL_UNIT_SECONDS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600, "d": 86400}
+CALENDAR_SECONDS = {"minute": 60, "hour": 3600, "day": 86400, "week": 86400, "month": 86400,
+                    "quarter": 86400, "year": 86400}
+# Date-math rounding units ("now-7d/d") and the finest tier they align to
+DATE_MATH_ROUNDING = {"m": "minute", "h": "hour", "H": "hour", "d": "day", "w": "day", "M": "day", "y": "day"}
+UTC_ZONES = {"UTC", "Etc/UTC", "GMT", "Z", "+00:00", "-00:00"}
+OFFSET_PATTERN = re.compile(r"^[+-](\d{2}):?(\d{2})$")
+
+RECORD_TIME_FORMATS = ["%Y-%m-%d %H:%M:%S %z", "%Y-%m-%d %H:%M:%S"]
+
+
+def parse_record_time(value: Any) -> Optional[datetime]:
+    """
+    Parse Apple Health ("2024-01-15 08:30:00 -0800") or ISO timestamps into aware UTC datetimes
+    """
+    if not value or not isinstance(value, str):
+        return None
+    parsed = None
+    for time_format in RECORD_TIME_FORMATS:
+        try:
+            parsed = datetime.strptime(value, time_format)
+            break
+        except ValueError:
+            continue
+    if parsed is None:
+        try:
+            parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+        except ValueError:
+            return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+def bucket_start(moment: datetime, tier: str) -> datetime:
+    """
+    Start of the UTC bucket of the given tier containing moment
+    """
+    seconds = TIER_SECONDS[tier]
+    epoch = int(moment.timestamp())
+    return datetime.fromtimestamp(epoch - epoch % seconds, tz=timezone.utc)
+
+
+def canonical_data_type(record_type: Optional[str]) -> Optional[str]:
+    """
+    Connector data_type for an uploaded record type ("HKQuantityTypeIdentifierStepCount" -> "steps")
+    """
+    if not record_type or record_type in UPLOAD_DATA_TYPES:
+        return UPLOAD_DATA_TYPES.get(record_type, record_type)
+    for prefix in HEALTHKIT_PREFIXES:
+        if record_type.startswith(prefix):
+            name = record_type[len(prefix):]
+            return re.sub(r"(?<!^)(?=[A-Z])", "_", name).lower()
+    return record_type
+
+
+def rollup_doc_id(user_id: str, data_type: str, tier: str, bucket: datetime,
+                  origin: str = READINGS_ORIGIN) -> str:
+    # Readings rollups keep the ids they had before uploads were rolled up
+    prefix = user_id if origin == READINGS_ORIGIN else f"{user_id}_{origin}"
+    return hashlib.md5(f"{prefix}_{data_type}_{tier}_{bucket.isoformat()}".encode()).hexdigest()
+
+
+def origin_filter(origin: str) -> Dict[str, Any]:
+    """
+    Bool clause matching rollups of one origin; readings rollups written before origins existed have none
+    """
+    if origin == READINGS_ORIGIN:
+        return {"bool": {"must_not": [{"terms": {"origin": [o for o in ORIGINS if o != READINGS_ORIGIN]}}]}}
+    return {"term": {"origin": origin}}
+
+
+def coverage_doc_id(user_id: str) -> str:
+    return hashlib.md5(f"{user_id}_{COVERAGE_TIER}".encode()).hexdigest()
+
+
+def coverage_document(user_id: str, covered_from: Optional[datetime] = None) -> Dict[str, Any]:
+    """
+    Coverage record: the user's rollups hold every reading at or after covered_from (None for all of them)
+    """
+    return {
+        "user_id": user_id,
+        "tier": COVERAGE_TIER,
+        "covered_from": covered_from.isoformat() if covered_from else None,
+        "updated_at": datetime.now(timezone.utc).isoformat()
+    }
+
+
+def range_covered(coverage: Optional[Dict[str, Any]], start: Optional[str]) -> bool:
+    """
+    True if a coverage record vouches for rollups over a range beginning at start
+    """
+    if not coverage:
+        return False
+    if not coverage.get('covered_from'):
+        return True
+    # Relative bounds ("now-7d/d") cannot be compared without the reader's clock
+    moment = parse_record_time(start) if start and not start.startswith("now") else None
+    covered_from = parse_record_time(coverage['covered_from'])
+    return moment is not None and covered_from is not None and moment >= covered_from
+
+
+def coverage_delete_lines(user_ids: List[str], index: str = ROLLUP_INDEX) -> Iterator[str]:
+    """
+    NDJSON _bulk lines that withdraw the users' coverage records, sending readers back to raw readings
+    """
+    for user_id in user_ids:
+        yield json.dumps({"delete": {"_index": index, "_id": coverage_doc_id(user_id), "routing": user_id}})
+
+
+class RollupAccumulator:
+    """
+    Per-bucket count/min/max/sum for a batch of readings, ready to merge into the rollup index
+    """
+
+    def __init__(self, tiers: Optional[List[str]] = None, origin: str = READINGS_ORIGIN):
+        self.tiers = tiers or TIERS
+        self.origin = origin
+        self._buckets: Dict[Tuple[str, str, datetime], List[float]] = {}
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def add(self, data_type: str, moment: Any, value: Any) -> bool:
+        """
+        Add one reading; returns False for readings without a numeric value or parseable time
+        """
+        if isinstance(moment, str):
+            moment = parse_record_time(moment)
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            return False
+        if not data_type or moment is None or value != value:
+            return False
+
+        for tier in self.tiers:
+            key = (tier, data_type, bucket_start(moment, tier))
+            stats = self._buckets.get(key)
+            if stats is None:
+                self._buckets[key] = [1, value, value, value]
+            else:
+                stats[0] += 1
+                stats[1] = min(stats[1], value)
+                stats[2] = max(stats[2], value)
+                stats[3] += value
+        return True
+
+    def add_record(self, record: Dict[str, Any]) -> bool:
+        """
+        Add an ingested record (Apple Health Record, CSV/JSON row or connector document)
+        """
+        data_type = record.get('data_type') or canonical_data_type(record.get('type'))
+        moment = record.get('startDate') or record.get('date') or record.get('timestamp')
+        return self.add(data_type, moment, record.get('value'))
+
+    def bulk_lines(self, user_id: str, index: str = ROLLUP_INDEX) -> Iterator[str]:
+        """
+        NDJSON _bulk lines that upsert every accumulated bucket into the rollup index
+        """
+        updated_at = datetime.now(timezone.utc).isoformat()
+        for (tier, data_type, bucket), (count, low, high, total) in self._buckets.items():
+            params = {"count": count, "min": low, "max": high, "sum": total, "updated_at": updated_at}
+            yield json.dumps({"update": {
+                "_index": index,
+                "_id": rollup_doc_id(user_id, data_type, tier, bucket, self.origin),
+                "routing": user_id,
+                "retry_on_conflict": 3
+            }})
+            yield json.dumps({
+                "script": {"source": MERGE_SCRIPT, "lang": "painless", "params": params},
+                "upsert": dict(params, user_id=user_id, data_type=data_type, tier=tier, origin=self.origin,
+                               bucket=bucket.isoformat(), avg=total / count)
+            })
+
+
+def build_rebuild_query(user_id: str, tier: str, since: Optional[datetime] = None,
+                        after: Optional[Dict[str, Any]] = None, page_size: int = 1000) -> Dict[str, Any]:
+    """
+    One page of a user's per-type buckets of one tier, aggregated from the source index
+    """
+    filters = [{"term": {"user_id": user_id}}]
+    if since:
+        filters.append({"range": {"timestamp": {"gte": since.isoformat()}}})
+    composite = {
+        "size": page_size,
+        "sources": [
+            {"data_type": {"terms": {"field": "data_type"}}},
+            {"bucket": {"date_histogram": {"field": "timestamp", "fixed_interval": TIER_FIXED_INTERVALS[tier]}}}
+        ]
+    }
+    if after:
+        composite["after"] = after
+    return {
+        "size": 0,
+        "query": {"bool": {"filter": filters}},
+        "aggs": {"buckets": {"composite": composite, "aggs": {"stats": {"stats": {"field": "value"}}}}}
+    }
+
+
+def rebuild_bulk_lines(results: Dict[str, Any], user_id: str, tier: str,
+                       index: str = ROLLUP_INDEX) -> Iterator[str]:
+    """
+    NDJSON _bulk lines that overwrite rollup buckets with a build_rebuild_query page
+    """
+    updated_at = datetime.now(timezone.utc).isoformat()
+    for bucket in results.get('aggregations', {}).get('buckets', {}).get('buckets', []):
+        stats = bucket.get('stats', {})
+        if not stats.get('count'):
+            continue
+        data_type = bucket['key']['data_type']
+        start = datetime.fromtimestamp(bucket['key']['bucket'] / 1000, tz=timezone.utc)
+        yield json.dumps({"index": {
+            "_index": index,
+            "_id": rollup_doc_id(user_id, data_type, tier, start),
+            "routing": user_id
+        }})
+        yield json.dumps({
+            "user_id": user_id, "data_type": data_type, "tier": tier, "origin": READINGS_ORIGIN,
+            "bucket": start.isoformat(),
+            "count": stats['count'], "min": stats['min'], "max": stats['max'], "sum": stats['sum'],
+            "avg": stats['avg'], "updated_at": updated_at
+        })
+
+
+def interval_seconds(interval: str) -> Optional[float]:
+    """
+    Length of a histogram interval in seconds, or None if it is not a supported interval
+    """
+    if interval in CALENDAR_INTERVALS:
+        return CALENDAR_SECONDS[CALENDAR_INTERVALS[interval]]
+    match = re.match(r"^(\d+)(ms|s|m|h|d)$", interval)
+    if not match:
+        return None
+    return int(match.group(1)) * INTERVAL_UNIT_SECONDS[match.group(2)]
+
+
+def zone_offset_whole_hours(time_zone: str) -> bool:
+    """
+    True if the zone's UTC offset is a whole number of hours all year
+    """
+    match = OFFSET_PATTERN.match(time_zone)
+    if match:
+        return match.group(2) == "00"
+    try:
+        from zoneinfo import ZoneInfo
+        zone = ZoneInfo(time_zone)
+    except Exception:
+        return False
+    year = datetime.now(timezone.utc).year
+    # January and July cover both sides of daylight saving time
+    return all(datetime(year, month, 1, tzinfo=zone).utcoffset().total_seconds() % 3600 == 0
+               for month in (1, 7))
+
+
+def bound_aligned(bound: Optional[str], tier: str) -> bool:
+    """
+    True if a range bound falls on a bucket boundary of the tier
+    """
+    if not bound:
+        return True
+    if bound.startswith("now"):
+        rounding = bound.rsplit("/", 1)[1] if "/" in bound else None
+        rounded_tier = DATE_MATH_ROUNDING.get(rounding)
+        return rounded_tier is not None and TIERS.index(rounded_tier) >= TIERS.index(tier)
+    moment = parse_record_time(bound)
+    return moment is not None and int(moment.timestamp()) % TIER_SECONDS[tier] == 0
+
+
+def choose_rollup_tier(interval: str, time_zone: str = "UTC", start: Optional[str] = None,
+                       end: Optional[str] = None) -> Optional[str]:
+    """
+    Coarsest tier whose buckets compose the requested interval and range exactly, or None for raw readings
+    """
+    seconds = interval_seconds(interval)
+    if seconds is None:
+        return None
+
+    for tier in reversed(TIERS):
+        if seconds < TIER_SECONDS[tier] or seconds % TIER_SECONDS[tier]:
+            continue
+        # Day buckets are UTC days; hour buckets only line up with whole-hour offsets
+        if tier == "day" and time_zone not in UTC_ZONES:
+            continue
+        if tier == "hour" and time_zone not in UTC_ZONES and not zone_offset_whole_hours(time_zone):
+            continue
+        if bound_aligned(start, tier) and bound_aligned(end, tier):
+            return tier
+    return None
+
+
+def build_rollup_aggregation_query(user_id: str, tier: str, data_types: Optional[List[str]] = None,
+                                   interval: str = "day", time_zone: str = "UTC", start: Optional[str] = None,
+                                   end: Optional[str] = None, max_types: int = 50,
+                                   origin: str = READINGS_ORIGIN) -> Dict[str, Any]:
+    """
+    Per-type time series re-bucketed from one rollup tier; same shape as build_aggregation_query
+    """
+    filters = [{"term": {"user_id": user_id}}, {"term": {"tier": tier}}, origin_filter(origin)]
+    if data_types:
+        filters.append({"terms": {"data_type": data_types}})
+    if start or end:
+        bucket_range = {key: value for key, value in (("gte", start), ("lt", end)) if value}
+        filters.append({"range": {"bucket": bucket_range}})
+
+    histogram = dict(histogram_interval(interval), field="bucket", time_zone=time_zone, min_doc_count=0)
+    if start and end:
+        histogram["extended_bounds"] = {"min": start, "max": end}
+
+    return {
+        "size": 0,
+        "query": {"bool": {"filter": filters}},
+        "aggs": {
+            "by_type": {
+                "terms": {"field": "data_type", "size": max_types},
+                "aggs": {
+                    "series": {
+                        "date_histogram": histogram,
+                        "aggs": {
+                            "count": {"sum": {"field": "count"}},
+                            "min": {"min": {"field": "min"}},
+                            "max": {"max": {"field": "max"}},
+                            "sum": {"sum": {"field": "sum"}}
+                        }
+                    }
+                }
+            }
+        }
+    }
+
+
+def parse_rollup_series(results: Dict[str, Any]) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    Flatten a build_rollup_aggregation_query response into {data_type: [bucket, ...]}
+    """
+    series = {}
+    for type_bucket in results.get('aggregations', {}).get('by_type', {}).get('buckets', []):
+        points = []
+        for bucket in type_bucket.get('series', {}).get('buckets', []):
+            count = int(bucket.get('count', {}).get('value') or 0)
+            total = bucket.get('sum', {}).get('value') if count else None
+            points.append({
+                "bucket": bucket.get('key_as_string', bucket.get('key')),
+                "count": count,
+                "min": bucket.get('min', {}).get('value') if count else None,
+                "max": bucket.get('max', {}).get('value') if count else None,
+                "avg": total / count if count else None,
+                "sum": total
+            })
+        series[type_bucket['key']] = points
+    return series
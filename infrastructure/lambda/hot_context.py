@@ -0,0 +1,163 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+# Configure logging
+logger = logging.getLogger()
+
+# Per-user hot health context for the assistant lambdas.
+#
+# Most assistant turns ask about the user's current vitals, which change far
+# more slowly than users ask questions. The hot context holds the latest
+# reading per data type plus short rolling stats, loaded with one aggregation
+# query and kept per container until its TTL expires or an ingest event for
+# the user arrives. Questions about longer history still go to full search.
+#
+# Ingest events are EventBridge events (source INGEST_EVENT_SOURCE) published
+# by the indexing path. An event reaches whichever container handles it, so
+# the TTL bounds staleness in the others.
+
+HOT_CONTEXT_TTL_SECONDS = int(os.environ.get('HOT_CONTEXT_TTL_SECONDS', '300'))
+HOT_CONTEXT_WINDOW = os.environ.get('HOT_CONTEXT_WINDOW', '24h')
+HEALTH_EVENT_BUS_NAME = os.environ.get('HEALTH_EVENT_BUS_NAME')
+
+INGEST_EVENT_SOURCE = "stayfithq.health-data"
+INGEST_EVENT_DETAIL_TYPE = "HealthDataIngested"
+
+# Questions that need more than the latest readings and recent stats
+HISTORY_PATTERN = re.compile(
+    r"\b(week|weeks|month|months|year|years|trend|trends|history|historical|since|ago|compare|compared|"
+    r"over time|last \d+|past \d+|progress|changed?)\b", re.I
+)
+
+_events_client = None
+
+
+def needs_history(question: str) -> bool:
+    """
+    Return True if the question reaches beyond the hot window
+    """
+    return HISTORY_PATTERN.search(question) is not None
+
+
+class HotContextCache:
+    """
+    Per-container LRU of user hot-context snapshots with TTL expiry
+    """
+
+    def __init__(self, ttl_seconds: int = HOT_CONTEXT_TTL_SECONDS, max_users: int = 1000):
+        self.ttl_seconds = ttl_seconds
+        self.max_users = max_users
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None or entry["loaded_at"] + self.ttl_seconds < time.time():
+                self._entries.pop(user_id, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return entry
+
+    def put(self, user_id: str, snapshot: Dict[str, Any]):
+        with self._lock:
+            self._entries[user_id] = snapshot
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_users:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+    @property
+    def hit_rate(self) -> float:
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def parse_hot_context(results: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Turn a build_hot_context_query response into a snapshot
+    """
+    latest = {}
+    aggregates = {}
+    for bucket in results.get('aggregations', {}).get('by_type', {}).get('buckets', []):
+        data_type = bucket['key']
+        hits = bucket.get('latest', {}).get('hits', {}).get('hits', [])
+        if hits:
+            source = hits[0]['_source']
+            latest[data_type] = {
+                "value": source.get('value'),
+                "unit": source.get('unit', ''),
+                "timestamp": source.get('timestamp'),
+                "context": source.get('search_text') or source.get('unit', '')
+            }
+        stats = bucket.get('recent', {}).get('stats', {})
+        if stats.get('count'):
+            aggregates[data_type] = {key: stats[key] for key in ("count", "min", "max", "avg")}
+
+    return {"latest": latest, "aggregates": aggregates, "loaded_at": time.time()}
+
+
+def snapshot_to_context(snapshot: Dict[str, Any], window: str = HOT_CONTEXT_WINDOW) -> List[Dict]:
+    """
+    Health-context items (as returned by search) for the latest readings and window stats
+    """
+    items = []
+    for data_type, reading in snapshot["latest"].items():
+        items.append(dict(reading, type=data_type, score=1.0))
+        stats = snapshot["aggregates"].get(data_type)
+        if stats and stats["count"] > 1:
+            items.append({
+                "type": data_type,
+                "value": round(stats["avg"], 1),
+                "unit": reading.get('unit', ''),
+                "timestamp": reading.get('timestamp'),
+                "context": (f"{window} average of {stats['count']} readings, "
+                            f"min {stats['min']:g}, max {stats['max']:g}"),
+                "score": 0.8
+            })
+    return items
+
+
+def ingest_event_user_ids(event: Dict[str, Any]) -> Optional[List[str]]:
+    """
+    User IDs named by an ingest event, or None if the event is not one
+    """
+    if event.get('source') != INGEST_EVENT_SOURCE or event.get('detail-type') != INGEST_EVENT_DETAIL_TYPE:
+        return None
+    detail = event.get('detail') or {}
+    return detail.get('user_ids') or ([detail['user_id']] if detail.get('user_id') else [])
+
+
+def publish_ingest_event(user_ids: List[str]):
+    """
+    Announce new readings so assistant containers drop their hot context (no-op without a bus)
+    """
+    global _events_client
+    if not HEALTH_EVENT_BUS_NAME or not user_ids:
+        return
+
+    try:
+        if _events_client is None:
+            import boto3
+            _events_client = boto3.client('events')
+        _events_client.put_events(Entries=[{
+            "EventBusName": HEALTH_EVENT_BUS_NAME,
+            "Source": INGEST_EVENT_SOURCE,
+            "DetailType": INGEST_EVENT_DETAIL_TYPE,
+            "Detail": json.dumps({"user_ids": sorted(set(user_ids))})
+        }])
+    except Exception as e:
+        logger.error(f"Error publishing ingest event: {str(e)}")
@@ -0,0 +1,267 @@
+import logging
+import os
+import re
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, List, Optional, Tuple
+
+from bedrock_prompt import strip_cache_points
+from circuit_breaker import CircuitBreaker
+from telemetry import telemetry
+from token_usage import estimate_tokens
+
+# Configure logging
+logger = logging.getLogger()
+
+# Routing of Claude requests across Bedrock model IDs.
+#
+# The router holds an ordered list of interchangeable Anthropic models (they
+# all accept the same messages request body). Short factual questions go to
+# the fast model first; everything else follows the configured order, with
+# models whose recent p95 latency is over budget moved behind healthy ones.
+# Each model has its own circuit breaker, and a throttled, failing (5xx) or
+# timed-out call fails over to the next candidate before the caller degrades
+# to canned text. Client errors such as ValidationException or
+# AccessDeniedException would fail the same way on every model, so they are
+# re-raised without counting against the breaker.
+# Request bodies may carry prompt cache points; models that do not support
+# prompt caching reject them, so they receive the body without cache points.
+# Every attempt is exported as a BedrockRouting telemetry event.
+
+DEFAULT_MODEL_IDS = "anthropic.claude-3-5-sonnet-20240620-v1:0,anthropic.claude-3-haiku-20240307-v1:0"
+DEFAULT_FAST_MODEL_ID = "anthropic.claude-3-haiku-20240307-v1:0"
+
+BEDROCK_MODEL_IDS = [model_id.strip() for model_id in
+                     os.environ.get('BEDROCK_MODEL_IDS', DEFAULT_MODEL_IDS).split(',') if model_id.strip()]
+BEDROCK_FAST_MODEL_ID = os.environ.get('BEDROCK_FAST_MODEL_ID', DEFAULT_FAST_MODEL_ID)
+SHORT_QUESTION_TOKENS = int(os.environ.get('ROUTER_SHORT_QUESTION_TOKENS', '24'))
+SLOW_P95_MS = float(os.environ.get('ROUTER_SLOW_P95_MS', '6000'))
+LATENCY_WINDOW = int(os.environ.get('ROUTER_LATENCY_WINDOW', '100'))
+# Model ID fragments of the Claude models that accept cache_control on Bedrock
+DEFAULT_PROMPT_CACHING_MODELS = "claude-3-5-haiku,claude-3-7-sonnet,claude-sonnet-4,claude-opus-4,claude-haiku-4"
+PROMPT_CACHING_MODELS = [fragment.strip() for fragment in
+                         os.environ.get('BEDROCK_PROMPT_CACHING_MODELS', DEFAULT_PROMPT_CACHING_MODELS).split(',')
+                         if fragment.strip()]
+
+FACTUAL_PATTERN = re.compile(
+    r"^\s*(what|what's|whats|how many|how much|how long|when|which|did i|was my|is my|were my)\b", re.I
+)
+OPEN_ENDED_PATTERN = re.compile(r"\b(why|explain|should|recommend|improve|compare|plan|advice)\b", re.I)
+
+# Bedrock error codes worth retrying on another model
+RETRYABLE_ERROR_CODES = {
+    "ThrottlingException", "TooManyRequestsException", "ServiceUnavailableException",
+    "InternalServerException", "ModelTimeoutException", "ModelNotReadyException", "ModelStreamErrorException"
+}
+# botocore connection and timeout errors (matched by name so botocore stays an optional import)
+TIMEOUT_ERROR_NAMES = {
+    "ReadTimeoutError", "ConnectTimeoutError", "EndpointConnectionError", "ConnectionClosedError"
+}
+
+
+class AllModelsUnavailableError(Exception):
+    """
+    Raised when every candidate model failed or was skipped by its breaker
+    """
+
+
+def is_short_factual_question(message: str, max_tokens: int = SHORT_QUESTION_TOKENS) -> bool:
+    """
+    Return True for brief lookups like "what was my resting heart rate yesterday?"
+    """
+    return (estimate_tokens(message) <= max_tokens
+            and FACTUAL_PATTERN.match(message) is not None
+            and OPEN_ENDED_PATTERN.search(message) is None)
+
+
+def supports_prompt_caching(model_id: str, caching_models: Optional[List[str]] = None) -> bool:
+    """
+    True if the model ID (or cross-region inference profile ID) names a model with prompt caching
+    """
+    fragments = PROMPT_CACHING_MODELS if caching_models is None else caching_models
+    return any(fragment in model_id for fragment in fragments)
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    True for throttling, 5xx and timeouts; False for client errors that no other model would accept either
+    """
+    response = getattr(error, 'response', None)
+    if isinstance(response, dict):
+        code = response.get('Error', {}).get('Code')
+        status = response.get('ResponseMetadata', {}).get('HTTPStatusCode') or 0
+        return code in RETRYABLE_ERROR_CODES or status == 429 or status >= 500
+    return isinstance(error, (TimeoutError, ConnectionError)) or type(error).__name__ in TIMEOUT_ERROR_NAMES
+
+
+class ModelStats:
+    """
+    Rolling latency window and call counters for one model
+    """
+
+    def __init__(self, window_size: int = LATENCY_WINDOW):
+        self._latencies = deque(maxlen=window_size)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.errors = 0
+
+    def record(self, latency_ms: float, failed: bool):
+        with self._lock:
+            self.calls += 1
+            if failed:
+                self.errors += 1
+            else:
+                self._latencies.append(latency_ms)
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        with self._lock:
+            if not self._latencies:
+                return None
+            ordered = sorted(self._latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "calls": self.calls,
+            "errors": self.errors,
+            "p50_ms": self.percentile(0.5),
+            "p95_ms": self.percentile(0.95)
+        }
+
+
+class ModelRouter:
+    """
+    Ordered, latency-aware failover across Bedrock model IDs
+    """
+
+    def __init__(self, model_ids: Optional[List[str]] = None, fast_model_id: Optional[str] = BEDROCK_FAST_MODEL_ID,
+                 client: Any = None, slow_p95_ms: float = SLOW_P95_MS,
+                 breaker_options: Optional[Dict[str, Any]] = None, caching_models: Optional[List[str]] = None):
+        self.model_ids = list(model_ids or BEDROCK_MODEL_IDS)
+        self.fast_model_id = fast_model_id
+        self.slow_p95_ms = slow_p95_ms
+        self.caching_models = PROMPT_CACHING_MODELS if caching_models is None else caching_models
+        self._client = client
+        all_models = self.model_ids + ([fast_model_id] if fast_model_id and fast_model_id not in self.model_ids else [])
+        self.breakers = {model_id: CircuitBreaker(f"bedrock:{model_id}", **(breaker_options or {}))
+                         for model_id in all_models}
+        self.stats = {model_id: ModelStats() for model_id in all_models}
+
+    @property
+    def client(self):
+        if self._client is None:
+            import boto3
+            self._client = boto3.client('bedrock-runtime')
+        return self._client
+
+    def route(self, user_message: str) -> Tuple[str, List[str]]:
+        """
+        Return the route name and the ordered candidate model IDs for a message
+        """
+        ordered = list(self.model_ids)
+        route = "default"
+        if self.fast_model_id and is_short_factual_question(user_message):
+            route = "fast"
+            ordered = [self.fast_model_id] + [model_id for model_id in ordered if model_id != self.fast_model_id]
+        elif self.fast_model_id and self.fast_model_id not in ordered:
+            # A smaller model's answer still beats the canned fallback
+            ordered.append(self.fast_model_id)
+
+        # Keep the preferred order among healthy models; over-budget models go last
+        healthy = [model_id for model_id in ordered if not self._is_slow(model_id)]
+        return route, healthy + [model_id for model_id in ordered if model_id not in healthy]
+
+    def invoke(self, body: str, user_message: str, stream: bool = False) -> Tuple[str, Dict[str, Any]]:
+        """
+        Invoke the first available model, failing over on throttling, 5xx and timeouts
+
+        Returns the model ID used and the raw Bedrock response. For streaming
+        calls the recorded latency is the time until the stream opened. Other
+        errors are re-raised from the first model that returns them.
+        """
+        route, candidates = self.route(user_message)
+        operation = self.client.invoke_model_with_response_stream if stream else self.client.invoke_model
+        attempt = 0
+        last_error = None
+        uncached_body = None
+
+        for model_id in candidates:
+            # Ask the breaker only when the model is actually about to be called,
+            # so a half-open probe slot is not claimed by a model we never try
+            if not self.breakers[model_id].allow_request():
+                continue
+
+            model_body = body
+            if not supports_prompt_caching(model_id, self.caching_models):
+                if uncached_body is None:
+                    uncached_body = strip_cache_points(body)
+                model_body = uncached_body
+
+            call_start = time.perf_counter()
+            try:
+                response = operation(
+                    modelId=model_id,
+                    body=model_body,
+                    contentType='application/json',
+                    accept='application/json'
+                )
+            except Exception as e:
+                if not is_retryable_error(e):
+                    self.breakers[model_id].release()
+                    logger.error(f"Bedrock model {model_id} rejected the request: {str(e)}")
+                    raise
+                latency_ms = (time.perf_counter() - call_start) * 1000
+                self._record(model_id, route, attempt, latency_ms, failed=True)
+                logger.warning(f"Bedrock model {model_id} failed, trying next candidate: {str(e)}")
+                last_error = e
+                attempt += 1
+                continue
+
+            latency_ms = (time.perf_counter() - call_start) * 1000
+            self._record(model_id, route, attempt, latency_ms, failed=False)
+            return model_id, response
+
+        raise AllModelsUnavailableError(f"No Bedrock model available after {attempt} attempts: {last_error}")
+
+    def snapshot(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Per-model breaker state and latency percentiles
+        """
+        return {
+            model_id: dict(self.stats[model_id].snapshot(), state=self.breakers[model_id].state)
+            for model_id in self.stats
+        }
+
+    def _is_slow(self, model_id: str) -> bool:
+        p95 = self.stats[model_id].percentile(0.95)
+        return p95 is not None and p95 > self.slow_p95_ms
+
+    def _record(self, model_id: str, route: str, attempt: int, latency_ms: float, failed: bool):
+        breaker = self.breakers[model_id]
+        if failed:
+            breaker.record_failure(latency_ms)
+        else:
+            breaker.record_success(latency_ms)
+
+        stats = self.stats[model_id]
+        stats.record(latency_ms, failed)
+        metrics = {
+            "LatencyMs": latency_ms,
+            "Error": int(failed),
+            "Failover": int(attempt > 0)
+        }
+        units = {"LatencyMs": "Milliseconds"}
+        for name, fraction in (("P50LatencyMs", 0.5), ("P95LatencyMs", 0.95)):
+            value = stats.percentile(fraction)
+            if value is not None:
+                metrics[name] = value
+                units[name] = "Milliseconds"
+
+        telemetry.record(
+            "BedrockRouting",
+            metrics=metrics,
+            dimensions={"Model": model_id, "Route": route},
+            properties={"attempt": attempt, "circuit_state": breaker.state},
+            units=units
+        )
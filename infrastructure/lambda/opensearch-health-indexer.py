@@ -1,11 +1,16 @@
 import json
 import boto3
+import hashlib
 import logging
 from datetime import datetime
 import requests
 from requests.auth import HTTPBasicAuth
 import os
-from typing import Dict, List, Any
+from typing import Dict, List, Any, Optional
+from health_query import HEALTH_INDEX_BODY, READ_FIELDS, build_search_text, routing_params, source_filter
+from health_rollups import RollupAccumulator, coverage_delete_lines
+from hot_context import publish_ingest_event
+from query_cache import bump_user_generation
 
 # Configure logging
 logger = logging.getLogger()
@@ -58,14 +63,33 @@ def index_health_data(health_data: Dict[str, Any]) -> Dict[str, Any]:
             "metadata": health_data.get('metadata', {}),
             "indexed_at": datetime.utcnow().isoformat()
         }
+        document['search_text'] = build_search_text(document)
+        # Same id scheme as the MCP connector; history paging tie-breaks on doc_id
+        document['doc_id'] = hashlib.md5(
+            f"{document['user_id']}_{document['timestamp']}_{document['data_type']}".encode()
+        ).hexdigest()
         
-        # Generate embeddings for semantic search
-        embeddings = generate_embeddings(json.dumps(document))
-        document['embeddings'] = embeddings
+        # Generate embeddings for semantic search; without one the document is
+        # indexed vectorless and flagged for the connector's backfill action,
+        # which re-embeds the same search_text
+        embeddings = generate_embeddings(document['search_text'])
+        if embeddings:
+            document['embeddings'] = embeddings
+        else:
+            document['embedding_pending'] = True
         
         # Index the document
         response = index_document(document)
         
+        # Every reading in the health index feeds the connector's rollups;
+        # overwriting an existing reading would count it twice
+        if response.get('result') == 'created':
+            update_rollups(document)
+        
+        # Connector and assistant caches for this user are now stale
+        bump_user_generation(document['user_id'])
+        publish_ingest_event([document['user_id']])
+        
         logger.info(f"Indexed health data: {document['data_type']} for user {document['user_id']}")
         
         return {
@@ -78,9 +102,9 @@ def index_health_data(health_data: Dict[str, Any]) -> Dict[str, Any]:
         logger.error(f"Error in index_health_data: {str(e)}")
         raise
 
-def generate_embeddings(text: str) -> List[float]:
+def generate_embeddings(text: str) -> Optional[List[float]]:
     """
-    Generate embeddings using Amazon Bedrock Titan Embeddings
+    Generate embeddings using Amazon Bedrock Titan Embeddings, or None if the call failed
     """
     try:
         request_body = {
@@ -95,14 +119,14 @@ def generate_embeddings(text: str) -> List[float]:
         )
         
         response_body = json.loads(response['body'].read())
-        embeddings = response_body.get('embedding', [])
+        embeddings = response_body.get('embedding') or None
         
-        logger.info(f"Generated embeddings with dimension: {len(embeddings)}")
+        logger.info(f"Generated embeddings with dimension: {len(embeddings or [])}")
         return embeddings
         
     except Exception as e:
         logger.error(f"Error generating embeddings: {str(e)}")
-        return []
+        return None
 
 def index_document(document: Dict[str, Any]) -> Dict[str, Any]:
     """
@@ -112,8 +136,8 @@ def index_document(document: Dict[str, Any]) -> Dict[str, Any]:
         # Create index if it doesn't exist
         create_index_if_not_exists()
         
-        # Index the document
-        url = f"{OPENSEARCH_ENDPOINT}/{HEALTH_INDEX}/_doc"
+        # Index the document under its doc_id
+        url = f"{OPENSEARCH_ENDPOINT}/{HEALTH_INDEX}/_doc/{document['doc_id']}"
         
         headers = {
             'Content-Type': 'application/json'
@@ -121,9 +145,10 @@ def index_document(document: Dict[str, Any]) -> Dict[str, Any]:
         
         # Use AWS SigV4 authentication (in production)
         # For now, using basic auth or IAM roles
-        response = requests.post(
+        response = requests.put(
             url,
             json=document,
+            params=routing_params(document['user_id']),
             headers=headers,
             timeout=30
         )
@@ -137,6 +162,37 @@ def index_document(document: Dict[str, Any]) -> Dict[str, Any]:
         logger.error(f"Error indexing document: {str(e)}")
         raise
 
+def update_rollups(document: Dict[str, Any]):
+    """
+    Merge a newly indexed reading into its user's minute/hour/day rollup buckets
+    """
+    rollups = RollupAccumulator()
+    if not rollups.add_record(document):
+        return
+    lines = list(rollups.bulk_lines(document['user_id']))
+    
+    try:
+        response = requests.post(
+            f"{OPENSEARCH_ENDPOINT}/_bulk",
+            data="\n".join(lines) + "\n",
+            headers={'Content-Type': 'application/x-ndjson'},
+            timeout=30
+        )
+        if response.status_code != 200 or response.json().get('errors'):
+            raise Exception(f"{response.status_code} - {response.text[:500]}")
+    except Exception as e:
+        logger.error(f"Error updating rollups: {str(e)}")
+        # The rollups now miss this reading; aggregations use raw readings until the next rebuild
+        try:
+            requests.post(
+                f"{OPENSEARCH_ENDPOINT}/_bulk",
+                data="\n".join(coverage_delete_lines([document['user_id']])) + "\n",
+                headers={'Content-Type': 'application/x-ndjson'},
+                timeout=30
+            ).raise_for_status()
+        except Exception as coverage_error:
+            logger.error(f"Error clearing rollup coverage: {str(coverage_error)}")
+
 def create_index_if_not_exists():
     """
     Create the health data index if it doesn't exist
@@ -147,29 +203,10 @@ def create_index_if_not_exists():
         response = requests.head(url, timeout=10)
         
         if response.status_code == 404:
-            # Create the index with proper mapping
-            index_mapping = {
-                "mappings": {
-                    "properties": {
-                        "timestamp": {"type": "date"},
-                        "user_id": {"type": "keyword"},
-                        "data_type": {"type": "keyword"},
-                        "value": {"type": "float"},
-                        "unit": {"type": "keyword"},
-                        "source": {"type": "keyword"},
-                        "metadata": {"type": "object"},
-                        "indexed_at": {"type": "date"},
-                        "embeddings": {
-                            "type": "dense_vector",
-                            "dims": 1536
-                        }
-                    }
-                }
-            }
-            
+            # Create the index with the shared user-routed mapping
             create_response = requests.put(
                 url,
-                json=index_mapping,
+                json=HEALTH_INDEX_BODY,
                 headers={'Content-Type': 'application/json'},
                 timeout=30
             )
@@ -190,33 +227,41 @@ def search_health_data(query: str, user_id: str, limit: int = 10) -> List[Dict[s
         # Generate query embeddings
         query_embeddings = generate_embeddings(query)
         
+        should = [
+            {
+                "multi_match": {
+                    "query": query,
+                    "fields": ["data_type", "metadata.*"],
+                    "boost": 2.0
+                }
+            }
+        ]
+        if query_embeddings:
+            # Vector scoring only when the query embedding succeeded, and only
+            # over documents that already have a vector
+            should.append({
+                "script_score": {
+                    "query": {"exists": {"field": "embeddings"}},
+                    "script": {
+                        "source": "cosineSimilarity(params.query_vector, 'embeddings') + 1.0",
+                        "params": {"query_vector": query_embeddings}
+                    },
+                    "boost": 1.0
+                }
+            })
+        else:
+            logger.warning("Query embedding failed, searching by keyword only")
+        
         # Construct search query
         search_query = {
             "size": limit,
+            "_source": source_filter(READ_FIELDS["search"]),
             "query": {
                 "bool": {
                     "must": [
                         {"term": {"user_id": user_id}}
                     ],
-                    "should": [
-                        {
-                            "multi_match": {
-                                "query": query,
-                                "fields": ["data_type", "metadata.*"],
-                                "boost": 2.0
-                            }
-                        },
-                        {
-                            "script_score": {
-                                "query": {"match_all": {}},
-                                "script": {
-                                    "source": "cosineSimilarity(params.query_vector, 'embeddings') + 1.0",
-                                    "params": {"query_vector": query_embeddings}
-                                },
-                                "boost": 1.0
-                            }
-                        }
-                    ]
+                    "should": should
                 }
             },
             "sort": [
@@ -229,6 +274,7 @@ def search_health_data(query: str, user_id: str, limit: int = 10) -> List[Dict[s
         response = requests.post(
             url,
             json=search_query,
+            params=routing_params(user_id),
             headers={'Content-Type': 'application/json'},
             timeout=30
         )
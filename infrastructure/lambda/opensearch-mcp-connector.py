@@ -1,3 +1,4 @@
+import base64
 import json
 import boto3
 import logging
@@ -5,8 +6,20 @@ from datetime import datetime
 import requests
 from requests.auth import HTTPBasicAuth
 import os
-from typing import Dict, List, Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Any, Optional
 import hashlib
+from health_query import (HEALTH_INDEX_BODY, build_aggregation_query, build_backfill_query, build_history_query,
+                          build_search_query, build_search_text, project_fields, routing_params, to_columnar)
+from health_rollups import (ORIGINS, READINGS_ORIGIN, ROLLUP_INDEX, ROLLUP_INDEX_BODY, TIERS, UPLOADS_ORIGIN,
+                            RollupAccumulator, bucket_start, build_rebuild_query, build_rollup_aggregation_query,
+                            choose_rollup_tier, coverage_delete_lines, coverage_doc_id, coverage_document,
+                            origin_filter, parse_record_time, parse_rollup_series, range_covered,
+                            rebuild_bulk_lines)
+from hot_context import ingest_event_user_ids, publish_ingest_event
+from query_cache import (QUERY_CACHE_TABLE, DynamoDBQueryCacheTier, QueryResultCache, cache_key,
+                         normalize_query_text)
+from telemetry import telemetry
 
 # Configure logging
 logger = logging.getLogger()
@@ -16,22 +29,60 @@ logger.setLevel(logging.INFO)
 OPENSEARCH_ENDPOINT = "https://your-service.amazonaws.com"
 HEALTH_INDEX = "health-data-index"
 
+# Cursor pagination: point-in-time lifetime between pages and the page size cap
+PIT_KEEP_ALIVE = os.environ.get('PIT_KEEP_ALIVE', '2m')
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', '500'))
+
+# Aggregation defaults. Percentiles are opt-in because they need raw readings instead of rollups.
+DEFAULT_AGGREGATE_INTERVAL = os.environ.get('DEFAULT_AGGREGATE_INTERVAL', 'day')
+DEFAULT_PERCENTILES = []
+
+# Search and aggregate results, cached until the user's data generation changes
+query_cache = QueryResultCache(
+    shared_tier=DynamoDBQueryCacheTier(QUERY_CACHE_TABLE) if QUERY_CACHE_TABLE else None
+)
+
+# Batch action: sub-request cap and concurrent Titan calls per batch
+BATCH_MAX_ITEMS = int(os.environ.get('BATCH_MAX_ITEMS', '50'))
+embedding_executor = ThreadPoolExecutor(max_workers=int(os.environ.get('EMBEDDING_WORKERS', '8')))
+
+# Documents re-embedded per backfill invocation
+BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', '100'))
+# Failed embedding attempts after which a document is marked embedding_failed and skipped
+BACKFILL_MAX_ATTEMPTS = int(os.environ.get('BACKFILL_MAX_ATTEMPTS', '5'))
+
 # Initialize AWS clients
 bedrock_runtime = boto3.client('bedrock-runtime', region_name='your-aws-region')
 
+@telemetry.flush_after
 def lambda_handler(event, context):
     """
     OpenSearch MCP connector for health data search and indexing
     """
     try:
+        # Ingest events from other writers invalidate this container's cached results
+        user_ids = ingest_event_user_ids(event)
+        if user_ids is not None:
+            for user_id in user_ids:
+                query_cache.invalidate_user(user_id)
+            return {"invalidated": len(user_ids)}
+        
         # Parse the incoming request
         body = json.loads(event.get('body', '{}'))
         action = body.get('action', 'search')
         
         if action == 'search':
             return handle_search_request(body)
+        elif action == 'aggregate':
+            return handle_aggregate_request(body)
         elif action == 'index':
             return handle_index_request(body)
+        elif action == 'batch':
+            return handle_batch_request(body)
+        elif action == 'backfill':
+            return handle_backfill_request(body)
+        elif action == 'rebuild_rollups':
+            return handle_rebuild_rollups_request(body)
         elif action == 'health_check':
             return handle_health_check()
         else:
@@ -52,22 +103,279 @@ def handle_search_request(body: Dict) -> Dict:
     user_id = body.get('user_id', 'anonymous')
     filters = body.get('filters', {})
     limit = body.get('limit', 10)
+    fields = project_fields('search', body.get('fields'))
     
-    logger.info(f"Searching health data for user {user_id}: {query}")
+    # Whole-history reads page through a point-in-time snapshot instead of a large limit
+    if body.get('cursor') or body.get('paginate'):
+        return handle_paginated_search(body)
     
-    # Ensure index exists
-    ensure_index_exists()
+    # Identical requests (dashboard refreshes) skip both the embedding call and the search
+    key = search_cache_key(query, filters, limit, fields)
+    search_results, generation = query_cache.lookup(user_id, key)
+    cached = search_results is not None
+    record_query_cache("search", cached)
     
-    # Perform semantic search
-    search_results = perform_semantic_search(query, user_id, filters, limit)
+    if not cached:
+        logger.info(f"Searching health data for user {user_id}: {query}")
+        
+        # Ensure index exists
+        ensure_index_exists()
+        
+        # Perform semantic search
+        search_results = perform_semantic_search(query, user_id, filters, limit, fields)
+        
+        # An empty list may be a search error that was logged and swallowed; don't pin it
+        if search_results:
+            query_cache.put(user_id, key, search_results, generation)
     
-    return create_response(200, {
-        "results": search_results,
+    return create_response(200, dict(encode_results(search_results, fields, body.get('format')), **{
         "total": len(search_results),
         "query": query,
+        "cached": cached,
+        "timestamp": datetime.utcnow().isoformat()
+    }))
+
+def search_cache_key(query: str, filters: Dict, limit: int, fields: List[str]) -> str:
+    """
+    Cache key of a search request, insensitive to query case and spacing
+    """
+    return cache_key("search", normalize_query_text(query), filters, limit, fields)
+
+def handle_paginated_search(body: Dict) -> Dict:
+    """
+    Return one page of a user's readings in time order with an opaque continuation cursor
+    """
+    user_id = body.get('user_id', 'anonymous')
+    
+    if body.get('cursor'):
+        try:
+            state = decode_cursor(body['cursor'])
+        except ValueError:
+            return create_response(400, {"error": "Invalid cursor"})
+        if state['user_id'] != user_id:
+            return create_response(403, {"error": "Cursor belongs to a different user"})
+    else:
+        try:
+            page_size = max(1, min(int(body.get('page_size', 100)), MAX_PAGE_SIZE))
+        except (TypeError, ValueError):
+            return create_response(400, {"error": "page_size must be a number"})
+        ensure_index_exists()
+        state = {
+            "user_id": user_id,
+            "query": body.get('query', ''),
+            "filters": body.get('filters', {}),
+            "page_size": page_size,
+            "fields": project_fields('history', body.get('fields')),
+            "pit_id": open_point_in_time(user_id),
+            "search_after": None
+        }
+    
+    fields = state['fields']
+    search_query = build_history_query(state['user_id'], state['query'], state['filters'], state['page_size'], fields)
+    search_query["pit"] = {"id": state['pit_id'], "keep_alive": PIT_KEEP_ALIVE}
+    if state['search_after']:
+        search_query["search_after"] = state['search_after']
+    
+    # Point-in-time searches name no index; the PIT already pins the index and routing
+    response = requests.post(
+        f"{OPENSEARCH_ENDPOINT}/_search",
+        json=search_query,
+        headers={'Content-Type': 'application/json'},
+        timeout=30
+    )
+    if response.status_code == 404:
+        return create_response(410, {"error": "Cursor expired, restart pagination without a cursor"})
+    if response.status_code != 200:
+        raise Exception(f"Paginated search failed: {response.status_code} - {response.text}")
+    
+    results = response.json()
+    hits = results.get('hits', {}).get('hits', [])
+    
+    next_cursor = None
+    if len(hits) == state['page_size']:
+        # OpenSearch may refresh the PIT ID on each search
+        state['pit_id'] = results.get('pit_id', state['pit_id'])
+        state['search_after'] = hits[-1]['sort']
+        next_cursor = encode_cursor(state)
+    else:
+        close_point_in_time(results.get('pit_id', state['pit_id']))
+    
+    results = [format_search_hit(hit, fields) for hit in hits]
+    return create_response(200, dict(encode_results(results, fields, body.get('format')), **{
+        "total": len(hits),
+        "next_cursor": next_cursor,
+        "query": state['query'],
+        "timestamp": datetime.utcnow().isoformat()
+    }))
+
+def open_point_in_time(user_id: str) -> str:
+    """
+    Open a point-in-time on the user's shard so pages see one consistent snapshot
+    """
+    params = dict(routing_params(user_id), keep_alive=PIT_KEEP_ALIVE)
+    response = requests.post(
+        f"{OPENSEARCH_ENDPOINT}/{HEALTH_INDEX}/_search/point_in_time",
+        params=params,
+        timeout=10
+    )
+    if response.status_code != 200:
+        raise Exception(f"Failed to open point in time: {response.status_code} - {response.text}")
+    return response.json()['pit_id']
+
+def close_point_in_time(pit_id: str):
+    """
+    Release a point-in-time once the last page has been read
+    """
+    try:
+        requests.delete(
+            f"{OPENSEARCH_ENDPOINT}/_search/point_in_time",
+            json={"pit_id": [pit_id]},
+            headers={'Content-Type': 'application/json'},
+            timeout=10
+        )
+    except Exception as e:
+        logger.warning(f"Error closing point in time: {str(e)}")
+
+def encode_cursor(state: Dict) -> str:
+    """
+    Serialize pagination state into an opaque URL-safe token
+    """
+    return base64.urlsafe_b64encode(json.dumps(state, separators=(',', ':')).encode()).decode().rstrip('=')
+
+def decode_cursor(cursor: str) -> Dict:
+    """
+    Parse a token produced by encode_cursor
+    
+    Cursors come back from clients, so the page size and fields are limited
+    again exactly as for a new request.
+    """
+    try:
+        state = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+        if not all(key in state for key in ('user_id', 'pit_id', 'page_size', 'search_after')):
+            raise ValueError("Missing cursor fields")
+        state['page_size'] = max(1, min(int(state['page_size']), MAX_PAGE_SIZE))
+        fields = state.get('fields')
+        state['fields'] = project_fields('history', fields if isinstance(fields, list) else None)
+        return state
+    except (TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor: {str(e)}")
+
+def handle_aggregate_request(body: Dict) -> Dict:
+    """
+    Return per-type time series (count, min, max, avg, sum, percentiles) for a user's readings
+    
+    Served from the coarsest rollup tier that covers the interval and range
+    exactly, if the user's rollups are recorded as covering the range;
+    percentiles, unaligned and uncovered requests aggregate raw readings.
+    With origin "uploads" the series come from the Apple Health upload
+    rollups, which have no raw fallback, so such requests must be rollup-aligned.
+    """
+    user_id = body.get('user_id', 'anonymous')
+    data_types = body.get('data_types') or ([body['data_type']] if body.get('data_type') else [])
+    interval = body.get('interval', DEFAULT_AGGREGATE_INTERVAL)
+    time_zone = body.get('time_zone', 'UTC')
+    date_range = body.get('date_range') or {}
+    percentiles = body.get('percentiles', DEFAULT_PERCENTILES)
+    origin = body.get('origin', READINGS_ORIGIN)
+    if not isinstance(date_range, dict) or not all(
+            isinstance(date_range.get(bound), (str, type(None))) for bound in ('start', 'end')):
+        return create_response(400, {"error": "'date_range' must be an object with 'start' and/or 'end' dates"})
+    if origin not in ORIGINS:
+        return create_response(400, {"error": f"'origin' must be one of {ORIGINS}"})
+    
+    start, end = date_range.get('start'), date_range.get('end')
+    if origin == UPLOADS_ORIGIN:
+        tier = choose_rollup_tier(interval, time_zone, start, end)
+        if percentiles or body.get('tier') == 'raw' or not tier:
+            return create_response(400, {"error": "Uploads are aggregated from rollups only: percentiles are "
+                                                  "unavailable and the interval and range must align to "
+                                                  "minute, hour or day buckets"})
+    else:
+        tier = None if percentiles or body.get('tier') == 'raw' else choose_rollup_tier(interval, time_zone, start, end)
+        if tier and not range_covered(load_rollup_coverage(user_id), start):
+            tier = None
+    
+    try:
+        if tier:
+            index = ROLLUP_INDEX
+            aggregation_query = build_rollup_aggregation_query(
+                user_id, tier, sorted(data_types), interval, time_zone, start, end, origin=origin
+            )
+        else:
+            index = HEALTH_INDEX
+            aggregation_query = build_aggregation_query(
+                user_id, sorted(data_types), interval, time_zone, start, end, percentiles
+            )
+    except ValueError as e:
+        return create_response(400, {"error": str(e)})
+    
+    key = cache_key("aggregate", index, aggregation_query)
+    series, generation = query_cache.lookup(user_id, key)
+    cached = series is not None
+    record_query_cache("aggregate", cached)
+    
+    if not cached:
+        logger.info(f"Aggregating health data for user {user_id} by {interval} from {tier or 'raw'} readings")
+        ensure_index_exists()
+        
+        response = requests.post(
+            f"{OPENSEARCH_ENDPOINT}/{index}/_search",
+            params=routing_params(user_id),
+            json=aggregation_query,
+            headers={'Content-Type': 'application/json'},
+            timeout=30
+        )
+        if response.status_code != 200:
+            raise Exception(f"Aggregation failed: {response.status_code} - {response.text}")
+        
+        results = response.json()
+        series = parse_rollup_series(results) if tier else parse_aggregation_series(results)
+        query_cache.put(user_id, key, series, generation)
+    
+    return create_response(200, {
+        "series": series,
+        "interval": interval,
+        "time_zone": time_zone,
+        "tier": tier or "raw",
+        "origin": origin,
+        "cached": cached,
         "timestamp": datetime.utcnow().isoformat()
     })
 
+def parse_aggregation_series(results: Dict) -> Dict[str, List[Dict]]:
+    """
+    Flatten a build_aggregation_query response into {data_type: [bucket, ...]}
+    """
+    series = {}
+    for type_bucket in results.get('aggregations', {}).get('by_type', {}).get('buckets', []):
+        points = []
+        for bucket in type_bucket.get('series', {}).get('buckets', []):
+            stats = bucket.get('stats', {})
+            point = {
+                "bucket": bucket.get('key_as_string', bucket.get('key')),
+                "count": stats.get('count', bucket.get('doc_count', 0)),
+                "min": stats.get('min'),
+                "max": stats.get('max'),
+                "avg": stats.get('avg'),
+                "sum": stats.get('sum')
+            }
+            if 'percentiles' in bucket:
+                point["percentiles"] = bucket['percentiles'].get('values', {})
+            points.append(point)
+        series[type_bucket['key']] = points
+    return series
+
+def record_query_cache(action: str, hit: bool):
+    """
+    Export query cache hit/miss and the container's running hit rate
+    """
+    telemetry.record(
+        "QueryCache",
+        metrics={"CacheHit": int(hit), "CacheHitRate": query_cache.hit_rate},
+        dimensions={"Action": action},
+        properties={"shared_hits": query_cache.shared_hits}
+    )
+
 def handle_index_request(body: Dict) -> Dict:
     """
     Handle health data indexing requests
@@ -83,12 +391,386 @@ def handle_index_request(body: Dict) -> Dict:
     # Index the health data
     result = index_health_data(health_data, user_id)
     
+    # New generation for this user's cached results; other containers hear it from the event
+    query_cache.bump(user_id)
+    publish_ingest_event([user_id])
+    
     return create_response(200, {
         "indexed": True,
         "document_id": result.get('document_id'),
         "timestamp": datetime.utcnow().isoformat()
     })
 
+def handle_batch_request(body: Dict) -> Dict:
+    """
+    Run a list of search and index sub-requests with one _msearch and one _bulk
+    
+    Query and document embeddings are generated in one concurrent, de-duplicated
+    pass. Results come back in request order, each with its own status, so one
+    failing item does not fail the batch.
+    """
+    items = body.get('requests')
+    if not isinstance(items, list) or not items:
+        return create_response(400, {"error": "'requests' must be a non-empty list"})
+    if len(items) > BATCH_MAX_ITEMS:
+        return create_response(400, {"error": f"A batch holds at most {BATCH_MAX_ITEMS} requests"})
+    
+    results = [None] * len(items)
+    searches = []
+    documents = []
+    for position, item in enumerate(items):
+        if not isinstance(item, dict):
+            results[position] = {"status": 400, "error": "Each request must be an object"}
+            continue
+        item_action = item.get('action', 'search')
+        user_id = item.get('user_id', body.get('user_id', 'anonymous'))
+        
+        if item_action == 'search' and not (item.get('cursor') or item.get('paginate')):
+            fields = project_fields('search', item.get('fields'))
+            search = {
+                "position": position,
+                "user_id": user_id,
+                "query": item.get('query', ''),
+                "filters": item.get('filters', {}),
+                "limit": item.get('limit', 10),
+                "fields": fields,
+                "format": item.get('format')
+            }
+            search["key"] = search_cache_key(search["query"], search["filters"], search["limit"], fields)
+            cached_results, search["generation"] = query_cache.lookup(user_id, search["key"])
+            record_query_cache("search", cached_results is not None)
+            if cached_results is not None:
+                results[position] = search_item_result(search, cached_results, cached=True)
+            else:
+                searches.append(search)
+        elif item_action == 'index':
+            doc_id, document = build_health_document(item.get('data', {}), user_id)
+            documents.append({"position": position, "doc_id": doc_id, "document": document})
+        else:
+            results[position] = {"status": 400, "error": f"Unsupported batch action: {item_action}"}
+    
+    if searches or documents:
+        ensure_index_exists()
+        embeddings = generate_embeddings_batch(
+            [search["query"] for search in searches] + [entry["document"]["search_text"] for entry in documents]
+        )
+        if searches:
+            run_batch_searches(searches, embeddings, results)
+        if documents:
+            run_batch_index(documents, embeddings, results)
+    
+    logger.info(f"Batch of {len(items)}: {len(searches)} searches, {len(documents)} index operations")
+    return create_response(200, {
+        "results": results,
+        "total": len(results),
+        "timestamp": datetime.utcnow().isoformat()
+    })
+
+def search_item_result(search: Dict, search_results: List[Dict], cached: bool) -> Dict:
+    """
+    Per-item batch result for a search, shaped like a single search response
+    """
+    return dict(encode_results(search_results, search["fields"], search["format"]), **{
+        "status": 200,
+        "total": len(search_results),
+        "query": search["query"],
+        "cached": cached
+    })
+
+def run_batch_searches(searches: List[Dict], embeddings: Dict[str, List[float]], results: List):
+    """
+    Execute uncached searches as one _msearch, each routed to its user's shard
+    """
+    lines = []
+    for search in searches:
+        search_query = build_search_query(
+            search["query"], search["user_id"], embeddings.get(search["query"]), search["filters"],
+            search["limit"], fields=search["fields"]
+        )
+        lines.append(json.dumps({"index": HEALTH_INDEX, **routing_params(search["user_id"])}))
+        lines.append(json.dumps(search_query))
+    
+    try:
+        response = requests.post(
+            f"{OPENSEARCH_ENDPOINT}/_msearch",
+            data="\n".join(lines) + "\n",
+            headers={'Content-Type': 'application/x-ndjson'},
+            timeout=30
+        )
+        if response.status_code != 200:
+            raise Exception(f"Multi-search failed: {response.status_code} - {response.text}")
+        responses = response.json().get('responses', [])
+    except Exception as e:
+        logger.error(f"Error in batch search: {str(e)}")
+        for search in searches:
+            results[search["position"]] = {"status": 502, "error": str(e)}
+        return
+    
+    for search, search_response in zip(searches, responses):
+        if 'error' in search_response:
+            error = search_response['error']
+            results[search["position"]] = {
+                "status": search_response.get('status', 500),
+                "error": error.get('reason', str(error)) if isinstance(error, dict) else str(error)
+            }
+            continue
+        hits = search_response.get('hits', {}).get('hits', [])
+        search_results = [format_search_hit(hit, search["fields"]) for hit in hits]
+        if search_results:
+            query_cache.put(search["user_id"], search["key"], search_results, search["generation"])
+        results[search["position"]] = search_item_result(search, search_results, cached=False)
+
+def run_batch_index(documents: List[Dict], embeddings: Dict[str, List[float]], results: List):
+    """
+    Index documents with one routed _bulk request, then update rollups and caches for their users
+    """
+    lines = []
+    for entry in documents:
+        document = entry["document"]
+        attach_embeddings(document, embeddings.get(document['search_text']))
+        lines.append(json.dumps({"index": {
+            "_index": HEALTH_INDEX, "_id": entry["doc_id"], **routing_params(document['user_id'])
+        }}))
+        lines.append(json.dumps(document))
+    
+    try:
+        response = requests.post(
+            f"{OPENSEARCH_ENDPOINT}/_bulk",
+            data="\n".join(lines) + "\n",
+            headers={'Content-Type': 'application/x-ndjson'},
+            timeout=60
+        )
+        if response.status_code != 200:
+            raise Exception(f"Bulk index failed: {response.status_code} - {response.text}")
+        bulk_items = response.json().get('items', [])
+    except Exception as e:
+        logger.error(f"Error in batch index: {str(e)}")
+        for entry in documents:
+            results[entry["position"]] = {"status": 502, "error": str(e)}
+        return
+    
+    created = []
+    user_ids = set()
+    for entry, bulk_item in zip(documents, bulk_items):
+        outcome = bulk_item.get('index', {})
+        if outcome.get('status') in (200, 201):
+            results[entry["position"]] = {
+                "status": outcome['status'],
+                "indexed": True,
+                "document_id": entry["doc_id"]
+            }
+            user_ids.add(entry["document"]['user_id'])
+            if outcome.get('result') == 'created':
+                created.append(entry["document"])
+        else:
+            error = outcome.get('error', {})
+            results[entry["position"]] = {
+                "status": outcome.get('status', 500),
+                "error": error.get('reason', str(error)) if isinstance(error, dict) else str(error)
+            }
+    
+    update_rollups(created)
+    for user_id in user_ids:
+        query_cache.bump(user_id)
+    publish_ingest_event(sorted(user_ids))
+
+def handle_backfill_request(body: Dict) -> Dict:
+    """
+    Embed documents that were indexed while Bedrock was failing
+    
+    Processes up to BACKFILL_BATCH_SIZE pending documents, optionally for one
+    user; "remaining" tells a scheduler to invoke again. Meant to run from an
+    EventBridge schedule with input {"body": "{\"action\": \"backfill\"}"}.
+    """
+    try:
+        size = body.get('size')
+        size = BACKFILL_BATCH_SIZE if size is None else max(1, min(int(size), BACKFILL_BATCH_SIZE))
+    except (TypeError, ValueError):
+        return create_response(400, {"error": "size must be a number"})
+    
+    response = requests.post(
+        f"{OPENSEARCH_ENDPOINT}/{HEALTH_INDEX}/_search",
+        json=build_backfill_query(size, body.get('user_id')),
+        params=routing_params(body['user_id']) if body.get('user_id') else None,
+        headers={'Content-Type': 'application/json'},
+        timeout=30
+    )
+    if response.status_code != 200:
+        raise Exception(f"Backfill search failed: {response.status_code} - {response.text}")
+    hits = response.json().get('hits', {}).get('hits', [])
+    
+    embeddings = generate_embeddings_batch([hit['_source']['search_text'] for hit in hits
+                                            if hit['_source'].get('search_text')])
+    lines = []
+    embedded = []
+    user_ids = set()
+    abandoned = 0
+    for hit in hits:
+        source = hit['_source']
+        user_id = hit.get('_routing') or source.get('user_id')
+        vector = embeddings.get(source['search_text']) if source.get('search_text') else None
+        if vector:
+            user_ids.add(user_id)
+            update = {"embeddings": vector, "embedding_pending": False}
+        else:
+            # Count the attempt; give up on documents that keep failing so they stop heading the queue
+            attempts = int(source.get('embedding_attempts') or 0) + 1
+            update = {"embedding_attempts": attempts}
+            if not source.get('search_text') or attempts >= BACKFILL_MAX_ATTEMPTS:
+                update.update(embedding_pending=False, embedding_failed=True)
+                abandoned += 1
+        embedded.append(bool(vector))
+        lines.append(json.dumps({"update": {"_index": hit['_index'], "_id": hit['_id'], **routing_params(user_id)}}))
+        lines.append(json.dumps({"doc": update}))
+    
+    backfilled = 0
+    if lines:
+        bulk_response = requests.post(
+            f"{OPENSEARCH_ENDPOINT}/_bulk",
+            data="\n".join(lines) + "\n",
+            headers={'Content-Type': 'application/x-ndjson'},
+            timeout=60
+        )
+        if bulk_response.status_code != 200:
+            raise Exception(f"Backfill update failed: {bulk_response.status_code} - {bulk_response.text}")
+        bulk_items = bulk_response.json().get('items', [])
+        backfilled = sum(1 for was_embedded, item in zip(embedded, bulk_items)
+                         if was_embedded and item.get('update', {}).get('status') == 200)
+    
+    # Rankings change once vectors exist; other containers and the assistant learn from the event
+    for user_id in user_ids:
+        query_cache.bump(user_id)
+    publish_ingest_event(sorted(user_ids))
+    
+    logger.info(f"Backfilled embeddings for {backfilled}/{len(hits)} documents")
+    return create_response(200, {
+        "processed": len(hits),
+        "backfilled": backfilled,
+        "failed": len(hits) - backfilled,
+        "abandoned": abandoned,
+        "remaining": len(hits) == size,
+        "timestamp": datetime.utcnow().isoformat()
+    })
+
+def handle_rebuild_rollups_request(body: Dict) -> Dict:
+    """
+    Rebuild a user's rollups from their raw readings and record the coverage
+    
+    Replaces every bucket from "since" (rounded down to a UTC day; the whole
+    history by default) with totals aggregated from the health index. Readers
+    use raw readings until the rebuild completes. Readings indexed for the
+    user while it runs may be missed, so run it between uploads.
+    """
+    user_id = body.get('user_id')
+    if not user_id:
+        return create_response(400, {"error": "A 'user_id' is required for rebuild_rollups"})
+    since = None
+    if body.get('since'):
+        since = parse_record_time(body['since'])
+        if since is None:
+            return create_response(400, {"error": "Invalid 'since' timestamp"})
+        since = bucket_start(since, "day")
+    
+    ensure_index_exists()
+    clear_rollup_coverage([user_id])
+    
+    bucket_filters = [{"term": {"user_id": user_id}}, {"terms": {"tier": TIERS}}, origin_filter(READINGS_ORIGIN)]
+    if since:
+        bucket_filters.append({"range": {"bucket": {"gte": since.isoformat()}}})
+    response = requests.post(
+        f"{OPENSEARCH_ENDPOINT}/{ROLLUP_INDEX}/_delete_by_query",
+        params=dict(routing_params(user_id), conflicts="proceed", refresh="true"),
+        json={"query": {"bool": {"filter": bucket_filters}}},
+        headers={'Content-Type': 'application/json'},
+        timeout=300
+    )
+    if response.status_code != 200:
+        raise Exception(f"Rollup delete failed: {response.status_code} - {response.text}")
+    
+    buckets = 0
+    for tier in TIERS:
+        after = None
+        while True:
+            response = requests.post(
+                f"{OPENSEARCH_ENDPOINT}/{HEALTH_INDEX}/_search",
+                params=routing_params(user_id),
+                json=build_rebuild_query(user_id, tier, since, after),
+                headers={'Content-Type': 'application/json'},
+                timeout=60
+            )
+            if response.status_code != 200:
+                raise Exception(f"Rollup rebuild search failed: {response.status_code} - {response.text}")
+            results = response.json()
+            lines = list(rebuild_bulk_lines(results, user_id, tier))
+            if lines:
+                bulk_response = requests.post(
+                    f"{OPENSEARCH_ENDPOINT}/_bulk",
+                    data="\n".join(lines) + "\n",
+                    headers={'Content-Type': 'application/x-ndjson'},
+                    timeout=60
+                )
+                if bulk_response.status_code != 200 or bulk_response.json().get('errors'):
+                    raise Exception(f"Rollup rebuild write failed: {bulk_response.status_code} - "
+                                    f"{bulk_response.text[:500]}")
+                buckets += len(lines) // 2
+            after = results.get('aggregations', {}).get('buckets', {}).get('after_key')
+            if not after:
+                break
+    
+    coverage = coverage_document(user_id, since)
+    response = requests.put(
+        f"{OPENSEARCH_ENDPOINT}/{ROLLUP_INDEX}/_doc/{coverage_doc_id(user_id)}",
+        params=routing_params(user_id),
+        json=coverage,
+        headers={'Content-Type': 'application/json'},
+        timeout=30
+    )
+    if response.status_code not in [200, 201]:
+        raise Exception(f"Recording rollup coverage failed: {response.status_code} - {response.text}")
+    
+    logger.info(f"Rebuilt {buckets} rollup buckets for user {user_id}")
+    return create_response(200, {
+        "user_id": user_id,
+        "buckets": buckets,
+        "covered_from": coverage["covered_from"],
+        "timestamp": datetime.utcnow().isoformat()
+    })
+
+def load_rollup_coverage(user_id: str) -> Optional[Dict]:
+    """
+    The user's rollup coverage record, or None (also on errors, which sends readers to raw readings)
+    """
+    try:
+        response = requests.get(
+            f"{OPENSEARCH_ENDPOINT}/{ROLLUP_INDEX}/_doc/{coverage_doc_id(user_id)}",
+            params=routing_params(user_id),
+            timeout=10
+        )
+        if response.status_code == 200:
+            return response.json().get('_source')
+        if response.status_code != 404:
+            logger.error(f"Rollup coverage lookup failed: {response.status_code} - {response.text}")
+    except Exception as e:
+        logger.error(f"Error loading rollup coverage: {str(e)}")
+    return None
+
+def clear_rollup_coverage(user_ids: List[str]):
+    """
+    Withdraw coverage for users whose rollups may be incomplete
+    """
+    lines = list(coverage_delete_lines(user_ids))
+    if not lines:
+        return
+    response = requests.post(
+        f"{OPENSEARCH_ENDPOINT}/_bulk",
+        params={"refresh": "true"},
+        data="\n".join(lines) + "\n",
+        headers={'Content-Type': 'application/x-ndjson'},
+        timeout=30
+    )
+    if response.status_code != 200:
+        raise Exception(f"Clearing rollup coverage failed: {response.status_code} - {response.text}")
+
 def handle_health_check() -> Dict:
     """
     Check OpenSearch cluster health
@@ -120,143 +802,52 @@ def handle_health_check() -> Dict:
 
 def ensure_index_exists():
     """
-    Ensure the health data index exists with proper mapping
+    Ensure the health data and rollup indices exist with proper mappings
     """
     try:
-        # Check if index exists
-        index_url = f"{OPENSEARCH_ENDPOINT}/{HEALTH_INDEX}"
-        response = requests.head(index_url, timeout=10)
-        
-        if response.status_code == 404:
-            # Create the index with mapping
-            index_mapping = {
-                "mappings": {
-                    "properties": {
-                        "timestamp": {"type": "date"},
-                        "user_id": {"type": "keyword"},
-                        "data_type": {"type": "keyword"},
-                        "value": {"type": "float"},
-                        "unit": {"type": "keyword"},
-                        "source": {"type": "keyword"},
-                        "device": {"type": "keyword"},
-                        "location": {"type": "geo_point"},
-                        "tags": {"type": "keyword"},
-                        "metadata": {
-                            "type": "object",
-                            "properties": {
-                                "activity": {"type": "keyword"},
-                                "sleep_stage": {"type": "keyword"},
-                                "heart_rate_zone": {"type": "keyword"}
-                            }
-                        },
-                        "embeddings": {
-                            "type": "dense_vector",
-                            "dims": 1536
-                        },
-                        "indexed_at": {"type": "date"},
-                        "search_text": {"type": "text", "analyzer": "standard"}
-                    }
-                },
-                "settings": {
-                    "number_of_shards": 1,
-                    "number_of_replicas": 0,
-                    "analysis": {
-                        "analyzer": {
-                            "health_analyzer": {
-                                "type": "custom",
-                                "tokenizer": "standard",
-                                "filter": ["lowercase", "stop"]
-                            }
-                        }
-                    }
-                }
-            }
-            
-            create_response = requests.put(
-                index_url,
-                json=index_mapping,
-                headers={'Content-Type': 'application/json'},
-                timeout=30
-            )
+        for index_name, index_body in ((HEALTH_INDEX, HEALTH_INDEX_BODY), (ROLLUP_INDEX, ROLLUP_INDEX_BODY)):
+            # Check if index exists
+            index_url = f"{OPENSEARCH_ENDPOINT}/{index_name}"
+            response = requests.head(index_url, timeout=10)
             
-            if create_response.status_code in [200, 201]:
-                logger.info(f"Created OpenSearch index: {HEALTH_INDEX}")
-            else:
-                logger.error(f"Failed to create index: {create_response.text}")
+            if response.status_code == 404:
+                # Create the index with the shared user-routed mapping
+                create_response = requests.put(
+                    index_url,
+                    json=index_body,
+                    headers={'Content-Type': 'application/json'},
+                    timeout=30
+                )
+                
+                if create_response.status_code in [200, 201]:
+                    logger.info(f"Created OpenSearch index: {index_name}")
+                else:
+                    logger.error(f"Failed to create index: {create_response.text}")
                 
     except Exception as e:
         logger.error(f"Error ensuring index exists: {str(e)}")
 
-def perform_semantic_search(query: str, user_id: str, filters: Dict, limit: int) -> List[Dict]:
+def perform_semantic_search(query: str, user_id: str, filters: Dict, limit: int,
+                            fields: List[str] = None) -> List[Dict]:
     """
     Perform semantic search using embeddings and keyword matching
     """
     try:
         # Generate query embeddings
         query_embeddings = generate_embeddings(query)
+        if query_embeddings is None:
+            logger.warning("Query embedding failed, searching by keyword only")
         
-        # Build search query
-        search_query = {
-            "size": limit,
-            "query": {
-                "bool": {
-                    "must": [
-                        {"term": {"user_id": user_id}}
-                    ],
-                    "should": [
-                        # Keyword search
-                        {
-                            "multi_match": {
-                                "query": query,
-                                "fields": ["data_type^2", "search_text", "metadata.*"],
-                                "type": "best_fields",
-                                "boost": 2.0
-                            }
-                        },
-                        # Semantic search using embeddings
-                        {
-                            "script_score": {
-                                "query": {"match_all": {}},
-                                "script": {
-                                    "source": "cosineSimilarity(params.query_vector, 'embeddings') + 1.0",
-                                    "params": {"query_vector": query_embeddings}
-                                },
-                                "boost": 1.5
-                            }
-                        }
-                    ],
-                    "minimum_should_match": 1
-                }
-            },
-            "sort": [
-                {"_score": {"order": "desc"}},
-                {"timestamp": {"order": "desc"}}
-            ]
-        }
-        
-        # Add filters
-        if filters:
-            filter_clauses = []
-            if filters.get('data_type'):
-                filter_clauses.append({"term": {"data_type": filters['data_type']}})
-            if filters.get('date_range'):
-                filter_clauses.append({
-                    "range": {
-                        "timestamp": {
-                            "gte": filters['date_range'].get('start'),
-                            "lte": filters['date_range'].get('end')
-                        }
-                    }
-                })
-            
-            if filter_clauses:
-                search_query["query"]["bool"]["filter"] = filter_clauses
+        # Build the hybrid keyword + vector query shared with the assistant lambdas
+        # (without an embedding it has no vector clause to score)
+        search_query = build_search_query(query, user_id, query_embeddings, filters, limit, fields=fields)
         
         # Execute search
         search_url = f"{OPENSEARCH_ENDPOINT}/{HEALTH_INDEX}/_search"
         response = requests.post(
             search_url,
             json=search_query,
+            params=routing_params(user_id),
             headers={'Content-Type': 'application/json'},
             timeout=30
         )
@@ -266,20 +857,7 @@ def perform_semantic_search(query: str, user_id: str, filters: Dict, limit: int)
             hits = results.get('hits', {}).get('hits', [])
             
             # Format results
-            formatted_results = []
-            for hit in hits:
-                source = hit['_source']
-                formatted_results.append({
-                    "id": hit['_id'],
-                    "score": hit.get('_score', 0),
-                    "data_type": source.get('data_type'),
-                    "value": source.get('value'),
-                    "unit": source.get('unit'),
-                    "timestamp": source.get('timestamp'),
-                    "source": source.get('source'),
-                    "metadata": source.get('metadata', {}),
-                    "relevance": "high" if hit.get('_score', 0) > 2.0 else "medium"
-                })
+            formatted_results = [format_search_hit(hit, fields) for hit in hits]
             
             logger.info(f"Found {len(formatted_results)} results for query: {query}")
             return formatted_results
@@ -292,43 +870,42 @@ def perform_semantic_search(query: str, user_id: str, filters: Dict, limit: int)
         logger.error(f"Error in semantic search: {str(e)}")
         return []
 
+def format_search_hit(hit: Dict, fields: List[str] = None) -> Dict:
+    """
+    Shape a search hit for MCP clients, limited to the projected fields
+    """
+    source = hit.get('_source', {})
+    score = hit.get('_score') or 0
+    result = {"id": hit['_id'], "score": score}
+    for field in fields or project_fields('search'):
+        result[field] = source.get(field, {} if field == 'metadata' else None)
+    result["relevance"] = "high" if score > 2.0 else "medium"
+    return result
+
+def encode_results(results: List[Dict], fields: List[str], response_format: str = None) -> Dict:
+    """
+    Results as a list of objects, or one array per field when the client asks for "columnar"
+    """
+    if response_format == 'columnar':
+        return to_columnar(results, ["id", "score"] + fields + ["relevance"])
+    return {"results": results}
+
 def index_health_data(health_data: Dict, user_id: str) -> Dict:
     """
     Index health data with embeddings
     """
     try:
-        # Prepare document
-        document = {
-            "timestamp": health_data.get('timestamp', datetime.utcnow().isoformat()),
-            "user_id": user_id,
-            "data_type": health_data.get('type', 'unknown'),
-            "value": health_data.get('value'),
-            "unit": health_data.get('unit', ''),
-            "source": health_data.get('source', 'manual'),
-            "device": health_data.get('device', ''),
-            "tags": health_data.get('tags', []),
-            "metadata": health_data.get('metadata', {}),
-            "indexed_at": datetime.utcnow().isoformat()
-        }
-        
-        # Create search text
-        search_text = f"{document['data_type']} {document['value']} {document['unit']}"
-        if document['metadata']:
-            search_text += " " + " ".join(str(v) for v in document['metadata'].values())
-        document['search_text'] = search_text
+        doc_id, document = build_health_document(health_data, user_id)
         
         # Generate embeddings
-        embeddings = generate_embeddings(search_text)
-        document['embeddings'] = embeddings
-        
-        # Generate document ID
-        doc_id = hashlib.md5(f"{user_id}_{document['timestamp']}_{document['data_type']}".encode()).hexdigest()
+        attach_embeddings(document, generate_embeddings(document['search_text']))
         
         # Index document
         index_url = f"{OPENSEARCH_ENDPOINT}/{HEALTH_INDEX}/_doc/{doc_id}"
         response = requests.put(
             index_url,
             json=document,
+            params=routing_params(user_id),
             headers={'Content-Type': 'application/json'},
             timeout=30
         )
@@ -336,6 +913,10 @@ def index_health_data(health_data: Dict, user_id: str) -> Dict:
         if response.status_code in [200, 201]:
             result = response.json()
             logger.info(f"Indexed health data: {document['data_type']} for user {user_id}")
+            
+            # Overwriting an existing reading would count it twice in the rollups
+            if result.get('result') == 'created':
+                update_rollups([document])
             return {"document_id": doc_id, "result": result.get('result')}
         else:
             raise Exception(f"Indexing failed: {response.status_code} - {response.text}")
@@ -344,9 +925,72 @@ def index_health_data(health_data: Dict, user_id: str) -> Dict:
         logger.error(f"Error indexing health data: {str(e)}")
         raise
 
-def generate_embeddings(text: str) -> List[float]:
+def build_health_document(health_data: Dict, user_id: str) -> tuple:
     """
-    Generate embeddings using Amazon Bedrock Titan Embeddings
+    Build a reading's document (without embeddings) and its deterministic ID
+    """
+    # Prepare document
+    document = {
+        "timestamp": health_data.get('timestamp', datetime.utcnow().isoformat()),
+        "user_id": user_id,
+        "data_type": health_data.get('type', 'unknown'),
+        "value": health_data.get('value'),
+        "unit": health_data.get('unit', ''),
+        "source": health_data.get('source', 'manual'),
+        "device": health_data.get('device', ''),
+        "tags": health_data.get('tags', []),
+        "metadata": health_data.get('metadata', {}),
+        "indexed_at": datetime.utcnow().isoformat()
+    }
+    
+    # Create search text
+    document['search_text'] = build_search_text(document)
+    
+    # Generate document ID
+    doc_id = hashlib.md5(f"{user_id}_{document['timestamp']}_{document['data_type']}".encode()).hexdigest()
+    document['doc_id'] = doc_id
+    return doc_id, document
+
+def update_rollups(documents: List[Dict]):
+    """
+    Merge newly created readings into their users' minute/hour/day rollup buckets
+    """
+    rollups_by_user = {}
+    for document in documents:
+        rollups_by_user.setdefault(document['user_id'], RollupAccumulator()).add_record(document)
+    lines = [line for user_id, rollups in rollups_by_user.items() for line in rollups.bulk_lines(user_id)]
+    if not lines:
+        return
+    
+    try:
+        response = requests.post(
+            f"{OPENSEARCH_ENDPOINT}/_bulk",
+            data="\n".join(lines) + "\n",
+            headers={'Content-Type': 'application/x-ndjson'},
+            timeout=30
+        )
+        if response.status_code != 200 or response.json().get('errors'):
+            raise Exception(f"{response.status_code} - {response.text[:500]}")
+    except Exception as e:
+        logger.error(f"Error updating rollups: {str(e)}")
+        # Some buckets may now miss these readings; aggregate from raw until the next rebuild
+        try:
+            clear_rollup_coverage(list(rollups_by_user))
+        except Exception as coverage_error:
+            logger.error(f"Error clearing rollup coverage: {str(coverage_error)}")
+
+def attach_embeddings(document: Dict, embeddings: Optional[List[float]]):
+    """
+    Store the vector, or flag the document for the backfill job when embedding failed
+    """
+    if embeddings:
+        document['embeddings'] = embeddings
+    else:
+        document['embedding_pending'] = True
+
+def generate_embeddings(text: str) -> Optional[List[float]]:
+    """
+    Generate embeddings using Amazon Bedrock Titan Embeddings, or None if the call failed
     """
     try:
         request_body = {
@@ -361,14 +1005,22 @@ def generate_embeddings(text: str) -> List[float]:
         )
         
         response_body = json.loads(response['body'].read())
-        embeddings = response_body.get('embedding', [])
+        embeddings = response_body.get('embedding') or None
         
-        logger.debug(f"Generated embeddings with dimension: {len(embeddings)}")
+        logger.debug(f"Generated embeddings with dimension: {len(embeddings or [])}")
         return embeddings
         
     except Exception as e:
+        # A zero vector would score every document equally; callers degrade instead
         logger.error(f"Error generating embeddings: {str(e)}")
-        return [0.0] * 1536  # Return zero vector as fallback
+        return None
+
+def generate_embeddings_batch(texts: List[str]) -> Dict[str, Optional[List[float]]]:
+    """
+    Embed each distinct text once, with the Titan calls running concurrently (None for failures)
+    """
+    distinct = list(dict.fromkeys(texts))
+    return dict(zip(distinct, embedding_executor.map(generate_embeddings, distinct)))
 
 def create_response(status_code: int, body: Dict[str, Any]) -> Dict[str, Any]:
     """
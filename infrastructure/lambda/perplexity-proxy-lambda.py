@@ -5,17 +5,22 @@ import logging
 from datetime import datetime, timedelta
 import hashlib
 import os
+import time
+from response_streaming import SSE_DONE, create_streaming_response, format_sse_event
+from secrets_cache import get_secret
+from telemetry import telemetry
+from token_usage import estimate_message_tokens, extract_usage
 
 # Configure logging
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 # Initialize AWS clients
-ssm_client = boto3.client('ssm')
 dynamodb = boto3.resource('dynamodb')
 
 # Configuration
 PERPLEXITY_API_URL = "https://api.perplexity.ai/chat/completions"
+PERPLEXITY_API_KEY_PARAMETER = '/stayfit/perplexity/api-key'
 CACHE_TABLE_NAME = "perplexity-cache"
 RATE_LIMIT_TABLE_NAME = "perplexity-rate-limits"
 
@@ -23,11 +28,17 @@ RATE_LIMIT_TABLE_NAME = "perplexity-rate-limits"
 RATE_LIMIT_PER_MINUTE = 60
 RATE_LIMIT_PER_HOUR = 1000
 RATE_LIMIT_PER_DAY = 10000
+TOKEN_LIMIT_PER_MINUTE = int(os.environ.get('TOKEN_LIMIT_PER_MINUTE', '200000'))
+TOKEN_LIMIT_PER_HOUR = int(os.environ.get('TOKEN_LIMIT_PER_HOUR', '1000000'))
+TOKEN_LIMIT_PER_DAY = int(os.environ.get('TOKEN_LIMIT_PER_DAY', '2000000'))
 
+@telemetry.flush_after
 def lambda_handler(event, context):
     """
     AWS Lambda function to proxy requests to Perplexity AI API
     Includes rate limiting, caching, and token management
+    Set "stream": true in the body to receive the answer as a server-sent events body;
+    the completion is always requested whole, since API Gateway returns the body in one piece
     """
     
     try:
@@ -38,6 +49,7 @@ def lambda_handler(event, context):
             body = event.get('body', {})
         
         logger.info(f"Perplexity request received: {body.get('model', 'unknown')}")
+        stream = bool(body.get('stream', False))
         
         # Validate request
         if not body.get('messages'):
@@ -45,7 +57,7 @@ def lambda_handler(event, context):
         
         # Check rate limits
         client_id = get_client_id(event)
-        if not check_rate_limits(client_id):
+        if not check_rate_limits(client_id, estimate_message_tokens(body.get('messages'))):
             return create_response(429, {"error": "Rate limit exceeded"})
         
         # Check cache first
@@ -53,10 +65,12 @@ def lambda_handler(event, context):
         cached_response = get_cached_response(cache_key)
         if cached_response:
             logger.info("Returning cached response")
+            if stream:
+                return create_streaming_response(completion_sse_frames(cached_response, cached=True))
             return create_response(200, cached_response)
         
         # Get API key from Parameter Store
-        api_key = "your_api_key_here"()
+        api_key = get_perplexity_api_key()
         if not api_key:
             return create_response(500, {"error": "API key not configured"})
         
@@ -93,6 +107,7 @@ def lambda_handler(event, context):
             perplexity_request["messages"].insert(0, system_message)
         
         # Make request to Perplexity API
+        request_start = time.perf_counter()
         response = requests.post(
             PERPLEXITY_API_URL,
             headers=headers,
@@ -100,20 +115,24 @@ def lambda_handler(event, context):
             timeout=30
         )
         
-        # Update rate limits
-        update_rate_limits(client_id)
-        
         if response.status_code == 200:
             response_data = response.json()
+            # Without incremental delivery the client's first token arrives with the whole answer
+            first_token_ms = (time.perf_counter() - request_start) * 1000
+            logger.info(f"Perplexity time to first token: {first_token_ms:.0f} ms")
             
             # Cache the response
             cache_response(cache_key, response_data)
             
-            # Log usage
-            log_usage(client_id, perplexity_request, response_data)
+            # Log usage and update rate limits with the tokens consumed
+            usage = log_usage(client_id, perplexity_request, response_data, first_token_ms)
+            update_rate_limits(client_id, usage["total_tokens"])
             
+            if stream:
+                return create_streaming_response(completion_sse_frames(response_data))
             return create_response(200, response_data)
         else:
+            update_rate_limits(client_id)
             logger.error(f"Perplexity API error: {response.status_code} - {response.text}")
             return create_response(response.status_code, {"error": f"Perplexity API error: {response.text}"})
         
@@ -127,17 +146,28 @@ def lambda_handler(event, context):
         logger.error(f"Error processing Perplexity request: {str(e)}")
         return create_response(500, {"error": f"Internal server error: {str(e)}"})
 
+def completion_sse_frames(completion, cached=False):
+    """Frame a whole completion as a single SSE chunk followed by [DONE]"""
+    choice = completion.get("choices", [{}])[0]
+    chunk = {
+        "id": completion.get("id", ""),
+        "model": completion.get("model"),
+        "object": "chat.completion.chunk",
+        "choices": [{
+            "index": 0,
+            "finish_reason": choice.get("finish_reason", "stop"),
+            "delta": {"role": "assistant", "content": choice.get("message", {}).get("content", "")}
+        }],
+        "citations": completion.get("citations", [])
+    }
+    if cached:
+        chunk["cached"] = True
+    yield format_sse_event(chunk)
+    yield SSE_DONE
+
 def get_perplexity_api_key():
-    """Get Perplexity API key from AWS Parameter Store"""
-    try:
-        response = ssm_client.get_parameter(
-            Name='/stayfit/perplexity/api-key',
-            WithDecryption=True
-        )
-        return response['Parameter']['Value']
-    except Exception as e:
-        logger.error(f"Error getting API key: {str(e)}")
-        return None
+    """Get Perplexity API key from AWS Parameter Store (cached per container)"""
+    return get_secret(PERPLEXITY_API_KEY_PARAMETER)
 
 def get_client_id(event):
     """Extract client ID from request for rate limiting"""
@@ -145,28 +175,34 @@ def get_client_id(event):
     source_ip = event.get('requestContext', {}).get('identity', {}).get('sourceIp', 'unknown')
     return hashlib.md5(source_ip.encode()).hexdigest()
 
-def check_rate_limits(client_id):
-    """Check if client has exceeded rate limits"""
+def check_rate_limits(client_id, estimated_tokens=0):
+    """Check if client has exceeded request or token rate limits"""
     try:
         table = dynamodb.Table(RATE_LIMIT_TABLE_NAME)
         now = datetime.now()
         
         # Check minute limit
         minute_key = f"{client_id}:{now.strftime('%Y-%m-%d-%H-%M')}"
-        minute_response = table.get_item(Key={'id': minute_key})
-        if minute_response.get('Item', {}).get('count', 0) >= RATE_LIMIT_PER_MINUTE:
+        minute_item = table.get_item(Key={'id': minute_key}).get('Item', {})
+        if minute_item.get('count', 0) >= RATE_LIMIT_PER_MINUTE:
+            return False
+        if minute_item.get('tokens', 0) + estimated_tokens > TOKEN_LIMIT_PER_MINUTE:
             return False
         
         # Check hour limit
         hour_key = f"{client_id}:{now.strftime('%Y-%m-%d-%H')}"
-        hour_response = table.get_item(Key={'id': hour_key})
-        if hour_response.get('Item', {}).get('count', 0) >= RATE_LIMIT_PER_HOUR:
+        hour_item = table.get_item(Key={'id': hour_key}).get('Item', {})
+        if hour_item.get('count', 0) >= RATE_LIMIT_PER_HOUR:
+            return False
+        if hour_item.get('tokens', 0) + estimated_tokens > TOKEN_LIMIT_PER_HOUR:
             return False
         
         # Check day limit
         day_key = f"{client_id}:{now.strftime('%Y-%m-%d')}"
-        day_response = table.get_item(Key={'id': day_key})
-        if day_response.get('Item', {}).get('count', 0) >= RATE_LIMIT_PER_DAY:
+        day_item = table.get_item(Key={'id': day_key}).get('Item', {})
+        if day_item.get('count', 0) >= RATE_LIMIT_PER_DAY:
+            return False
+        if day_item.get('tokens', 0) + estimated_tokens > TOKEN_LIMIT_PER_DAY:
             return False
         
         return True
@@ -175,8 +211,8 @@ def check_rate_limits(client_id):
         logger.error(f"Error checking rate limits: {str(e)}")
         return True  # Allow request if rate limit check fails
 
-def update_rate_limits(client_id):
-    """Update rate limit counters"""
+def update_rate_limits(client_id, tokens=0):
+    """Update request and token rate limit counters"""
     try:
         table = dynamodb.Table(RATE_LIMIT_TABLE_NAME)
         now = datetime.now()
@@ -185,10 +221,11 @@ def update_rate_limits(client_id):
         minute_key = f"{client_id}:{now.strftime('%Y-%m-%d-%H-%M')}"
         table.update_item(
             Key={'id': minute_key},
-            UpdateExpression='ADD #count :inc SET #ttl = :ttl',
-            ExpressionAttributeNames={'#count': 'count', '#ttl': 'ttl'},
+            UpdateExpression='ADD #count :inc, #tokens :tokens SET #ttl = :ttl',
+            ExpressionAttributeNames={'#count': 'count', '#tokens': 'tokens', '#ttl': 'ttl'},
             ExpressionAttributeValues={
                 ':inc': 1,
+                ':tokens': tokens,
                 ':ttl': int((now + timedelta(minutes=2)).timestamp())
             }
         )
@@ -197,10 +234,11 @@ def update_rate_limits(client_id):
         hour_key = f"{client_id}:{now.strftime('%Y-%m-%d-%H')}"
         table.update_item(
             Key={'id': hour_key},
-            UpdateExpression='ADD #count :inc SET #ttl = :ttl',
-            ExpressionAttributeNames={'#count': 'count', '#ttl': 'ttl'},
+            UpdateExpression='ADD #count :inc, #tokens :tokens SET #ttl = :ttl',
+            ExpressionAttributeNames={'#count': 'count', '#tokens': 'tokens', '#ttl': 'ttl'},
             ExpressionAttributeValues={
                 ':inc': 1,
+                ':tokens': tokens,
                 ':ttl': int((now + timedelta(hours=2)).timestamp())
             }
         )
@@ -209,10 +247,11 @@ def update_rate_limits(client_id):
         day_key = f"{client_id}:{now.strftime('%Y-%m-%d')}"
         table.update_item(
             Key={'id': day_key},
-            UpdateExpression='ADD #count :inc SET #ttl = :ttl',
-            ExpressionAttributeNames={'#count': 'count', '#ttl': 'ttl'},
+            UpdateExpression='ADD #count :inc, #tokens :tokens SET #ttl = :ttl',
+            ExpressionAttributeNames={'#count': 'count', '#tokens': 'tokens', '#ttl': 'ttl'},
             ExpressionAttributeValues={
                 ':inc': 1,
+                ':tokens': tokens,
                 ':ttl': int((now + timedelta(days=2)).timestamp())
             }
         )
@@ -272,24 +311,40 @@ def cache_response(cache_key, response_data):
     except Exception as e:
         logger.error(f"Error caching response: {str(e)}")
 
-def log_usage(client_id, request_data, response_data):
-    """Log API usage for monitoring and billing"""
+def log_usage(client_id, request_data, response_data, first_token_ms=None):
+    """Buffer API usage for monitoring and billing (flushed at the end of the invocation)"""
+    usage = extract_usage(
+        response_data,
+        prompt_messages=request_data.get("messages"),
+        completion_text=response_data.get("choices", [{}])[0].get("message", {}).get("content", "")
+    )
+    
     try:
-        usage_data = {
-            "client_id": client_id,
-            "timestamp": datetime.now().isoformat(),
-            "model": request_data.get("model"),
-            "input_tokens": len(str(request_data.get("messages", ""))),
-            "output_tokens": len(str(response_data.get("choices", [{}])[0].get("message", {}).get("content", ""))),
-            "citations_count": len(response_data.get("citations", [])),
-            "request_id": response_data.get("id", "")
+        metrics = {
+            "InputTokens": usage["input_tokens"],
+            "OutputTokens": usage["output_tokens"],
+            "Citations": len(response_data.get("citations", []))
         }
-        
-        # Log to CloudWatch (automatically done by Lambda)
-        logger.info(f"Usage: {json.dumps(usage_data)}")
+        units = {}
+        if first_token_ms is not None:
+            metrics["TimeToFirstTokenMs"] = first_token_ms
+            units["TimeToFirstTokenMs"] = "Milliseconds"
+        telemetry.record(
+            "PerplexityUsage",
+            metrics=metrics,
+            dimensions={"Model": request_data.get("model")},
+            properties={
+                "client_id": client_id,
+                "request_id": response_data.get("id", ""),
+                "token_source": usage["source"]
+            },
+            units=units
+        )
         
     except Exception as e:
         logger.error(f"Error logging usage: {str(e)}")
+    
+    return usage
 
 def create_response(status_code, body):
     """Create HTTP response"""
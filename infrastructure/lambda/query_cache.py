@@ -0,0 +1,240 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional, Tuple
+
+# Configure logging
+logger = logging.getLogger()
+
+# Query result cache for the MCP connector.
+#
+# Results are cached under the normalized request and the user's data
+# generation: a counter that is bumped whenever the user's readings are
+# indexed or erased. Bumping it makes every older entry for the user
+# unreachable in O(1), without scanning keys; stale entries age out of the LRU
+# and the TTL. The in-container tier is always on. An optional DynamoDB tier
+# (QUERY_CACHE_TABLE) shares both entries and generations across containers
+# and with the ingest and erasure lambdas. Without it, other containers learn
+# about new data from HealthDataIngested events, and the TTL bounds staleness.
+#
+# A reader stores its result under the generation it looked up before running
+# the query, not the one current when it finishes: if an ingest bumps the
+# generation in between, the possibly stale result lands in the old generation
+# where no later lookup will find it.
+
+QUERY_CACHE_TTL_SECONDS = int(os.environ.get('QUERY_CACHE_TTL_SECONDS', '300'))
+QUERY_CACHE_MAX_ENTRIES = int(os.environ.get('QUERY_CACHE_MAX_ENTRIES', '2000'))
+# How long a container trusts its copy of a shared generation before re-reading it
+QUERY_CACHE_GENERATION_REFRESH_SECONDS = float(os.environ.get('QUERY_CACHE_GENERATION_REFRESH_SECONDS', '5'))
+QUERY_CACHE_TABLE = os.environ.get('QUERY_CACHE_TABLE')
+
+
+def normalize_query_text(text: str) -> str:
+    """
+    Lowercase and collapse whitespace so trivially different queries share an entry
+    """
+    return " ".join(str(text or "").lower().split())
+
+
+def cache_key(*parts: Any) -> str:
+    """
+    Stable key for a combination of request parameters
+    """
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+
+class DynamoDBQueryCacheTier:
+    """
+    Shared tier: generation items ("generation#<user>") and entry items with a TTL attribute
+    """
+
+    def __init__(self, table_name: str):
+        self.table_name = table_name
+        self._table = None
+
+    def _get_table(self):
+        if self._table is None:
+            import boto3
+            self._table = boto3.resource('dynamodb').Table(self.table_name)
+        return self._table
+
+    def generation(self, user_id: str) -> int:
+        item = self._get_table().get_item(Key={'id': f"generation#{user_id}"}).get('Item')
+        return int(item['generation']) if item else 0
+
+    def bump(self, user_id: str) -> int:
+        response = self._get_table().update_item(
+            Key={'id': f"generation#{user_id}"},
+            UpdateExpression="ADD generation :one",
+            ExpressionAttributeValues={':one': 1},
+            ReturnValues="UPDATED_NEW"
+        )
+        return int(response['Attributes']['generation'])
+
+    def get(self, entry_key: str) -> Optional[Any]:
+        item = self._get_table().get_item(Key={'id': f"entry#{entry_key}"}).get('Item')
+        if not item or int(item.get('ttl', 0)) < time.time():
+            return None
+        return json.loads(item['value'])
+
+    def put(self, entry_key: str, value: Any, ttl_seconds: int):
+        self._get_table().put_item(Item={
+            'id': f"entry#{entry_key}",
+            'value': json.dumps(value, default=str),
+            'ttl': int(time.time() + ttl_seconds)
+        })
+
+
+class QueryResultCache:
+    """
+    Generation-scoped result cache with an in-container LRU and an optional shared tier
+    """
+
+    def __init__(self, ttl_seconds: int = QUERY_CACHE_TTL_SECONDS, max_entries: int = QUERY_CACHE_MAX_ENTRIES,
+                 shared_tier: Any = None,
+                 generation_refresh_seconds: float = QUERY_CACHE_GENERATION_REFRESH_SECONDS):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.shared_tier = shared_tier
+        self.generation_refresh_seconds = generation_refresh_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        # user_id -> (generation, read_at)
+        self._generations: Dict[str, tuple] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def generation(self, user_id: str) -> int:
+        """
+        The user's current data generation
+        """
+        with self._lock:
+            known = self._generations.get(user_id)
+        if known is not None and (self.shared_tier is None
+                                  or time.monotonic() - known[1] < self.generation_refresh_seconds):
+            return known[0]
+        if self.shared_tier is None:
+            return 0
+
+        try:
+            generation = self.shared_tier.generation(user_id)
+        except Exception as e:
+            logger.error(f"Error reading shared query cache generation: {str(e)}")
+            # Without a trustworthy generation, a fresh one keeps old entries out of reach
+            return -1
+        with self._lock:
+            self._generations[user_id] = (generation, time.monotonic())
+        return generation
+
+    def bump(self, user_id: str) -> int:
+        """
+        Invalidate every cached result for the user after their data changed
+        """
+        generation = None
+        if self.shared_tier is not None:
+            try:
+                generation = self.shared_tier.bump(user_id)
+            except Exception as e:
+                logger.error(f"Error bumping shared query cache generation: {str(e)}")
+
+        with self._lock:
+            if generation is None:
+                known = self._generations.get(user_id)
+                generation = (known[0] if known else 0) + 1
+            self._generations[user_id] = (generation, time.monotonic())
+        return generation
+
+    def invalidate_user(self, user_id: str):
+        """
+        React to a change made elsewhere: re-read the shared generation, or bump the local one
+        """
+        if self.shared_tier is not None:
+            with self._lock:
+                self._generations.pop(user_id, None)
+        else:
+            self.bump(user_id)
+
+    def lookup(self, user_id: str, key: str) -> Tuple[Optional[Any], int]:
+        """
+        Return the cached value (or None) and the generation to pass to put on a miss
+        """
+        generation = self.generation(user_id)
+        if generation < 0:
+            self.misses += 1
+            return None, generation
+        entry_key = f"{user_id}#{generation}#{key}"
+
+        with self._lock:
+            cached = self._entries.get(entry_key)
+            if cached is not None and cached[0] >= time.monotonic():
+                self._entries.move_to_end(entry_key)
+                self.hits += 1
+                return cached[1], generation
+
+        value = None
+        if self.shared_tier is not None:
+            try:
+                value = self.shared_tier.get(entry_key)
+            except Exception as e:
+                logger.error(f"Error reading shared query cache: {str(e)}")
+
+        if value is None:
+            self.misses += 1
+            return None, generation
+        self.hits += 1
+        self.shared_hits += 1
+        self._put_local(entry_key, value)
+        return value, generation
+
+    def put(self, user_id: str, key: str, value: Any, generation: int):
+        """
+        Cache a result computed after lookup returned this generation
+        """
+        if generation < 0:
+            return
+        entry_key = f"{user_id}#{generation}#{key}"
+        self._put_local(entry_key, value)
+
+        if self.shared_tier is not None:
+            try:
+                self.shared_tier.put(entry_key, value, self.ttl_seconds)
+            except Exception as e:
+                logger.error(f"Error writing shared query cache: {str(e)}")
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {
+            "hits": self.hits,
+            "shared_hits": self.shared_hits,
+            "misses": self.misses,
+            "hit_rate": self.hit_rate,
+            "entries": len(self._entries)
+        }
+
+    def _put_local(self, entry_key: str, value: Any):
+        with self._lock:
+            self._entries[entry_key] = (time.monotonic() + self.ttl_seconds, value)
+            self._entries.move_to_end(entry_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def bump_user_generation(user_id: str, table_name: Optional[str] = QUERY_CACHE_TABLE):
+    """
+    Invalidate a user's cached query results from a writer that holds no cache (no-op without a shared table)
+    """
+    if not table_name:
+        return
+    try:
+        DynamoDBQueryCacheTier(table_name).bump(user_id)
+    except Exception as e:
+        logger.error(f"Error bumping query cache generation: {str(e)}")
@@ -0,0 +1,232 @@
+import hashlib
+import json
+import logging
+import math
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+# Configure logging
+logger = logging.getLogger()
+
+# Semantic response cache for the health assistant.
+#
+# Answers are cached per user under a fingerprint of the health-context
+# snapshot they were generated from. A lookup embeds the normalized question
+# and returns a cached answer when a stored question for the same user and the
+# same context is similar enough. The default embedding is a local hashed
+# n-gram vector, so a lookup never costs a model call; any embedding callable
+# (e.g. Titan) can be plugged in instead.
+#
+# Similarity alone cannot tell "steps yesterday" from "steps today", so a hit
+# also requires both questions to contain exactly the same numbers and the
+# same time and comparison words.
+
+EMBEDDING_DIMENSIONS = 256
+WORD_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Words that change which readings a question is about, so they must match exactly
+DISCRIMINATING_WORDS = {
+    "today", "tonight", "yesterday", "tomorrow", "now", "current", "currently", "latest", "recent", "recently",
+    "last", "this", "next", "previous", "past", "ago", "since", "before", "after",
+    "morning", "afternoon", "evening", "night", "hour", "hours", "day", "days", "daily",
+    "week", "weeks", "weekly", "weekend", "month", "months", "monthly", "year", "years", "yearly",
+    "monday", "tuesday", "wednesday", "thursday", "friday", "saturday", "sunday",
+    "high", "higher", "highest", "low", "lower", "lowest", "max", "maximum", "min", "minimum", "peak",
+    "average", "avg", "mean", "total", "more", "less", "most", "least", "best", "worst", "better", "worse",
+    "above", "below", "over", "under", "increase", "increased", "decrease", "decreased", "up", "down",
+    "trend", "compare", "compared", "vs", "versus", "change", "changed"
+}
+
+
+def normalize_question(question: str) -> str:
+    """
+    Lowercase, drop punctuation and collapse whitespace
+    """
+    return " ".join(WORD_PATTERN.findall(question.lower()))
+
+
+def question_signature(question: str) -> List[str]:
+    """
+    Numbers and time/comparison words of a normalized question, which a cache hit must share
+    """
+    return sorted({word for word in question.split()
+                   if word in DISCRIMINATING_WORDS or any(char.isdigit() for char in word)})
+
+
+def embed_question(question: str) -> List[float]:
+    """
+    Embed a normalized question as an L2-normalized hashed word and character-trigram vector
+    """
+    vector = [0.0] * EMBEDDING_DIMENSIONS
+    words = question.split()
+    features = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+    for word in words:
+        padded = f" {word} "
+        features.extend(padded[i:i + 3] for i in range(len(padded) - 2))
+
+    for feature in features:
+        digest = hashlib.md5(feature.encode()).digest()
+        index = int.from_bytes(digest[:4], "little") % EMBEDDING_DIMENSIONS
+        vector[index] += 1.0 if digest[4] & 1 else -1.0
+
+    norm = math.sqrt(sum(value * value for value in vector)) or 1.0
+    return [value / norm for value in vector]
+
+
+def cosine_similarity(a: List[float], b: List[float]) -> float:
+    """
+    Cosine similarity of two L2-normalized vectors
+    """
+    return sum(x * y for x, y in zip(a, b))
+
+
+def context_fingerprint(health_context: List[Dict[str, Any]]) -> str:
+    """
+    Stable hash of a health-context snapshot
+    """
+    canonical = json.dumps(health_context, sort_keys=True, default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+class InMemoryCacheTier:
+    """
+    Per-container LRU of cache entries scoped by user and context fingerprint
+    """
+
+    def __init__(self, max_entries_per_user: int = 50, max_users: int = 1000):
+        self.max_entries_per_user = max_entries_per_user
+        self.max_users = max_users
+        self._users: "OrderedDict[str, List[Dict[str, Any]]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def candidates(self, user_id: str, context_hash: str) -> List[Dict[str, Any]]:
+        with self._lock:
+            entries = self._users.get(user_id)
+            if entries is None:
+                return []
+            self._users.move_to_end(user_id)
+            return [entry for entry in entries if entry["context_hash"] == context_hash]
+
+    def put(self, user_id: str, entry: Dict[str, Any]):
+        with self._lock:
+            entries = self._users.setdefault(user_id, [])
+            self._users.move_to_end(user_id)
+            entries.append(entry)
+            del entries[:-self.max_entries_per_user]
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+
+class DynamoDBCacheTier:
+    """
+    Persistent tier: one item per (user, context fingerprint) holding recent entries
+    """
+
+    def __init__(self, table_name: str, max_entries: int = 20):
+        self.table_name = table_name
+        self.max_entries = max_entries
+        self._table = None
+
+    def _get_table(self):
+        if self._table is None:
+            import boto3
+            self._table = boto3.resource('dynamodb').Table(self.table_name)
+        return self._table
+
+    def candidates(self, user_id: str, context_hash: str) -> List[Dict[str, Any]]:
+        response = self._get_table().get_item(Key={'user_id': user_id, 'context_hash': context_hash})
+        item = response.get('Item')
+        return json.loads(item['entries']) if item else []
+
+    def put(self, user_id: str, entry: Dict[str, Any]):
+        entries = self.candidates(user_id, entry["context_hash"]) + [entry]
+        entries = entries[-self.max_entries:]
+        self._get_table().put_item(Item={
+            'user_id': user_id,
+            'context_hash': entry["context_hash"],
+            'entries': json.dumps(entries),
+            'ttl': int(max(e["expires_at"] for e in entries))
+        })
+
+
+class SemanticResponseCache:
+    """
+    Two-tier semantic cache returning answers for near-duplicate questions
+    """
+
+    def __init__(self, similarity_threshold: float = 0.92, ttl_seconds: int = 3600,
+                 memory_tier: Optional[InMemoryCacheTier] = None, persistent_tier: Any = None,
+                 embedder: Callable[[str], List[float]] = embed_question):
+        self.similarity_threshold = similarity_threshold
+        self.ttl_seconds = ttl_seconds
+        self.memory_tier = memory_tier or InMemoryCacheTier()
+        self.persistent_tier = persistent_tier
+        self.embedder = embedder
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def lookup(self, user_id: str, question: str, context_hash: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the most similar unexpired entry above the threshold with the same signature, if any
+        """
+        normalized = normalize_question(question)
+        embedding = self.embedder(normalized)
+        signature = question_signature(normalized)
+        entry = self._best_match(self.memory_tier.candidates(user_id, context_hash), embedding, signature)
+
+        if entry is None and self.persistent_tier is not None:
+            try:
+                entry = self._best_match(self.persistent_tier.candidates(user_id, context_hash), embedding,
+                                         signature)
+                if entry is not None:
+                    self.memory_tier.put(user_id, entry)
+            except Exception as e:
+                logger.error(f"Error reading persistent response cache: {str(e)}")
+
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def store(self, user_id: str, question: str, context_hash: str, answer: str, usage: Optional[Dict[str, Any]] = None):
+        """
+        Cache an answer with the token usage it cost to generate
+        """
+        usage = usage or {}
+        entry = {
+            "question": normalize_question(question),
+            "embedding": self.embedder(normalize_question(question)),
+            "context_hash": context_hash,
+            "answer": answer,
+            "input_tokens": usage.get("input_tokens", 0),
+            "output_tokens": usage.get("output_tokens", 0),
+            "expires_at": time.time() + self.ttl_seconds
+        }
+        self.memory_tier.put(user_id, entry)
+
+        if self.persistent_tier is not None:
+            try:
+                self.persistent_tier.put(user_id, entry)
+            except Exception as e:
+                logger.error(f"Error writing persistent response cache: {str(e)}")
+
+    def _best_match(self, entries: List[Dict[str, Any]], embedding: List[float],
+                    signature: List[str]) -> Optional[Dict[str, Any]]:
+        now = time.time()
+        best, best_score = None, self.similarity_threshold
+        for entry in entries:
+            if entry["expires_at"] <= now or question_signature(entry["question"]) != signature:
+                continue
+            score = cosine_similarity(entry["embedding"], embedding)
+            if score >= best_score:
+                best, best_score = entry, score
+        return best
@@ -0,0 +1,44 @@
+import json
+from typing import Any, Dict, Iterable, Optional
+
+# Server-sent events framing for handlers that accept "stream": true.
+#
+# Python Lambdas have no response-streaming writer, and API Gateway buffers
+# Lambda proxy responses, so the frames are not delivered incrementally: the
+# handler produces every frame and returns them as one text/event-stream body.
+# This only gives SSE clients the chunked message format they expect; it does
+# not lower the time until the client sees the first token.
+
+SSE_HEADERS = {
+    'Content-Type': 'text/event-stream',
+    'Cache-Control': 'no-cache',
+    'Connection': 'keep-alive',
+    'X-Accel-Buffering': 'no',
+    'Access-Control-Allow-Origin': '*',
+    'Access-Control-Allow-Headers': 'Content-Type, Authorization',
+    'Access-Control-Allow-Methods': 'POST, OPTIONS'
+}
+
+SSE_DONE = "data: [DONE]\n\n"
+
+
+def format_sse_event(data: Any, event: Optional[str] = None) -> str:
+    """
+    Format a payload as a single server-sent event frame
+    """
+    payload = data if isinstance(data, str) else json.dumps(data)
+    frame = f"event: {event}\n" if event else ""
+    for line in payload.splitlines() or [""]:
+        frame += f"data: {line}\n"
+    return frame + "\n"
+
+
+def create_streaming_response(frames: Iterable[str], status_code: int = 200) -> Dict[str, Any]:
+    """
+    Drain a frame generator into one text/event-stream API Gateway response
+    """
+    return {
+        'statusCode': status_code,
+        'headers': SSE_HEADERS,
+        'body': "".join(frames)
+    }
@@ -0,0 +1,135 @@
+import boto3
+import logging
+import os
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+# Configure logging
+logger = logging.getLogger()
+
+# Container-scoped cache for SSM SecureString parameters.
+#
+# The first lookup of a parameter fetches it synchronously; later lookups are
+# served from memory. Once a value enters the refresh-ahead window before its
+# TTL a background thread re-fetches it, and if SSM is throttled or unavailable
+# the last-known-good value keeps being served.
+
+SECRETS_CACHE_TTL_SECONDS = int(os.environ.get('SECRETS_CACHE_TTL_SECONDS', '900'))
+SECRETS_CACHE_REFRESH_AHEAD_SECONDS = int(os.environ.get('SECRETS_CACHE_REFRESH_AHEAD_SECONDS', '120'))
+SECRETS_CACHE_RETRY_SECONDS = int(os.environ.get('SECRETS_CACHE_RETRY_SECONDS', '30'))
+
+
+class SecretsCache:
+    """
+    Memoize secrets per container with asynchronous refresh-ahead
+    """
+
+    def __init__(self, fetcher: Optional[Callable[[str], str]] = None,
+                 ttl_seconds: int = SECRETS_CACHE_TTL_SECONDS,
+                 refresh_ahead_seconds: int = SECRETS_CACHE_REFRESH_AHEAD_SECONDS,
+                 retry_seconds: int = SECRETS_CACHE_RETRY_SECONDS):
+        self._fetcher = fetcher or self._fetch_ssm_parameter
+        self._ttl = ttl_seconds
+        self._refresh_at = max(ttl_seconds - refresh_ahead_seconds, 0)
+        self._retry = retry_seconds
+        self._entries: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._ssm_client = None
+
+    def get(self, name: str) -> Optional[str]:
+        """
+        Return the secret, fetching it on first use and refreshing it ahead of expiry
+        """
+        entry = self._entries.get(name)
+        now = time.monotonic()
+
+        if entry is None:
+            return self._fetch_and_store(name)
+
+        # A refresh is already in flight or backing off: never wait for it
+        if entry['refreshing'] or now < entry['retry_after']:
+            return entry['value']
+
+        age = now - entry['fetched_at']
+        if age >= self._ttl:
+            # Expired: block on a fresh fetch, falling back to the stale value
+            return self._refresh(name)
+
+        if age >= self._refresh_at:
+            self._refresh_in_background(name)
+
+        return entry['value']
+
+    def invalidate(self, name: str):
+        """
+        Drop a cached secret so the next lookup fetches it again
+        """
+        with self._lock:
+            self._entries.pop(name, None)
+
+    def _claim_refresh(self, name: str) -> Optional[Dict]:
+        """
+        Mark the entry as refreshing; returns None if it is gone or another caller already claimed it
+        """
+        with self._lock:
+            entry = self._entries.get(name)
+            if entry is None or entry['refreshing']:
+                return None
+            entry['refreshing'] = True
+            return entry
+
+    def _refresh(self, name: str) -> Optional[str]:
+        entry = self._entries.get(name)
+        if self._claim_refresh(name) is None:
+            return entry['value'] if entry else self._fetch_and_store(name)
+        return self._fetch_and_store(name)
+
+    def _refresh_in_background(self, name: str):
+        if self._claim_refresh(name) is None:
+            return
+        threading.Thread(target=self._fetch_and_store, args=(name,), daemon=True).start()
+
+    def _fetch_and_store(self, name: str) -> Optional[str]:
+        # The network call runs without the lock; it is only taken to swap the result in
+        try:
+            value = self._fetcher(name)
+        except Exception as e:
+            with self._lock:
+                entry = self._entries.get(name)
+                if entry is None:
+                    logger.error(f"Error fetching secret {name}: {str(e)}")
+                    return None
+
+                # Serve last-known-good and back off before retrying
+                logger.warning(f"Serving cached secret {name} after refresh failure: {str(e)}")
+                entry['retry_after'] = time.monotonic() + self._retry
+                entry['refreshing'] = False
+                return entry['value']
+
+        with self._lock:
+            self._entries[name] = {
+                'value': value,
+                'fetched_at': time.monotonic(),
+                'retry_after': 0.0,
+                'refreshing': False
+            }
+        return value
+
+    def _fetch_ssm_parameter(self, name: str) -> str:
+        if self._ssm_client is None:
+            self._ssm_client = boto3.client('ssm')
+
+        response = self._ssm_client.get_parameter(Name=name, WithDecryption=True)
+        return response['Parameter']['Value']
+
+
+# Shared per-container instance
+secrets_cache = SecretsCache()
+
+
+def get_secret(name: str) -> Optional[str]:
+    """
+    Get a secret from the shared container cache
+    """
+    return secrets_cache.get(name)
@@ -0,0 +1,205 @@
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+from token_usage import estimate_tokens
+
+# Configure logging
+logger = logging.getLogger()
+
+# Multi-turn session memory for the health assistant.
+#
+# A session keeps its most recent turns verbatim and folds older turns into a
+# rolling extractive summary, so the history sent with each prompt is bounded
+# in both tokens and bytes however long the conversation runs. Sessions are
+# keyed by user and session ID and live in a pluggable backend: an in-memory
+# LRU with TTL, or a DynamoDB table with a TTL attribute.
+#
+# Only an explicit session of an identified user is remembered. Requests that
+# omit the session ID or come from the anonymous user get no memory at all,
+# since a shared default key would leak one caller's conversation to another.
+
+SESSION_RECENT_TURNS = int(os.environ.get('SESSION_RECENT_TURNS', '6'))
+SESSION_MAX_TOKENS = int(os.environ.get('SESSION_MAX_TOKENS', '1500'))
+SESSION_SUMMARY_MAX_TOKENS = int(os.environ.get('SESSION_SUMMARY_MAX_TOKENS', '300'))
+SESSION_MAX_BYTES = int(os.environ.get('SESSION_MAX_BYTES', '16384'))
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', '3600'))
+
+SENTENCE_PATTERN = re.compile(r"(.+?[.!?])(\s|$)", re.S)
+
+ANONYMOUS_USER_IDS = {"", "anonymous"}
+
+
+def _first_sentence(text: str, limit: int) -> str:
+    text = " ".join(text.split())
+    match = SENTENCE_PATTERN.match(text)
+    sentence = match.group(1) if match else text
+    return sentence if len(sentence) <= limit else sentence[:limit - 3].rstrip() + "..."
+
+
+class InMemorySessionBackend:
+    """
+    Per-container LRU of sessions with TTL expiry
+    """
+
+    def __init__(self, max_sessions: int = 1000, ttl_seconds: int = SESSION_TTL_SECONDS):
+        self.max_sessions = max_sessions
+        self.ttl_seconds = ttl_seconds
+        self._sessions: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                return None
+            if session["updated_at"] + self.ttl_seconds < time.time():
+                del self._sessions[key]
+                return None
+            self._sessions.move_to_end(key)
+            return session
+
+    def save(self, key: str, session: Dict[str, Any]):
+        with self._lock:
+            self._sessions[key] = session
+            self._sessions.move_to_end(key)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+
+class DynamoDBSessionBackend:
+    """
+    DynamoDB-backed sessions; expiry is delegated to the table's TTL attribute
+    """
+
+    def __init__(self, table_name: str, ttl_seconds: int = SESSION_TTL_SECONDS):
+        self.table_name = table_name
+        self.ttl_seconds = ttl_seconds
+        self._table = None
+
+    def _get_table(self):
+        if self._table is None:
+            import boto3
+            self._table = boto3.resource('dynamodb').Table(self.table_name)
+        return self._table
+
+    def load(self, key: str) -> Optional[Dict[str, Any]]:
+        item = self._get_table().get_item(Key={'id': key}).get('Item')
+        if not item or int(item.get('ttl', 0)) < time.time():
+            return None
+        return json.loads(item['session'])
+
+    def save(self, key: str, session: Dict[str, Any]):
+        self._get_table().put_item(Item={
+            'id': key,
+            'session': json.dumps(session),
+            'ttl': int(session["updated_at"] + self.ttl_seconds)
+        })
+
+
+class SessionStore:
+    """
+    Bounded conversation memory: recent turns verbatim, older turns as a rolling summary
+    """
+
+    def __init__(self, backend: Any = None, recent_turns: int = SESSION_RECENT_TURNS,
+                 max_tokens: int = SESSION_MAX_TOKENS, summary_max_tokens: int = SESSION_SUMMARY_MAX_TOKENS,
+                 max_bytes: int = SESSION_MAX_BYTES):
+        self.backend = backend or InMemorySessionBackend()
+        self.recent_turns = recent_turns
+        self.max_tokens = max_tokens
+        self.summary_max_tokens = summary_max_tokens
+        self.max_bytes = max_bytes
+
+    @staticmethod
+    def session_key(user_id: str, session_id: str) -> str:
+        return f"{user_id}:{session_id}"
+
+    @staticmethod
+    def is_tracked(user_id: Optional[str], session_id: Optional[str]) -> bool:
+        """
+        True when the request names its own session and comes from an identified user
+        """
+        return bool(session_id) and bool(user_id) and user_id not in ANONYMOUS_USER_IDS
+
+    def load(self, user_id: str, session_id: str) -> Dict[str, Any]:
+        """
+        Return the session, or a new empty one (always empty for untracked requests)
+        """
+        if not self.is_tracked(user_id, session_id):
+            return {"summary": [], "turns": [], "updated_at": time.time()}
+        try:
+            session = self.backend.load(self.session_key(user_id, session_id))
+        except Exception as e:
+            logger.error(f"Error loading session {session_id}: {str(e)}")
+            session = None
+        return session or {"summary": [], "turns": [], "updated_at": time.time()}
+
+    def append_turn(self, user_id: str, session_id: str, session: Dict[str, Any], user_message: str, ai_response: str):
+        """
+        Record a question/answer exchange, then compact and persist the session
+        """
+        if not self.is_tracked(user_id, session_id):
+            return
+        session["turns"].extend([
+            {"role": "user", "content": user_message},
+            {"role": "assistant", "content": ai_response}
+        ])
+        self._compact(session)
+        session["updated_at"] = time.time()
+
+        try:
+            self.backend.save(self.session_key(user_id, session_id), session)
+        except Exception as e:
+            logger.error(f"Error saving session {session_id}: {str(e)}")
+
+    @staticmethod
+    def history_messages(session: Dict[str, Any]) -> List[Dict[str, str]]:
+        """
+        Recent turns as Claude messages (always starting with a user turn)
+        """
+        return [{"role": turn["role"], "content": turn["content"]} for turn in session["turns"]]
+
+    @staticmethod
+    def summary_text(session: Dict[str, Any]) -> str:
+        """
+        Rolling summary of turns no longer kept verbatim
+        """
+        if not session["summary"]:
+            return ""
+        return "Earlier in this conversation:\n" + "\n".join(f"- {line}" for line in session["summary"])
+
+    def _compact(self, session: Dict[str, Any]):
+        turns = session["turns"]
+
+        # Fold exchanges beyond the verbatim window, or over the token cap, into the summary
+        while len(turns) > 2 and (len(turns) > self.recent_turns or self._turn_tokens(turns) > self.max_tokens):
+            question, answer = turns.pop(0), turns.pop(0)
+            session["summary"].append(
+                f"User asked: {_first_sentence(question['content'], 120)} "
+                f"Assistant: {_first_sentence(answer['content'], 160)}"
+            )
+
+        summary = session["summary"]
+        while summary and sum(estimate_tokens(line) for line in summary) > self.summary_max_tokens:
+            summary.pop(0)
+
+        # Hard byte cap on the serialized session
+        while len(json.dumps(session).encode()) > self.max_bytes:
+            if summary:
+                summary.pop(0)
+            elif len(turns) > 2:
+                del turns[:2]
+            else:
+                turns[-1]["content"] = turns[-1]["content"][:len(turns[-1]["content"]) // 2]
+                if not turns[-1]["content"]:
+                    break
+
+    @staticmethod
+    def _turn_tokens(turns: List[Dict[str, str]]) -> int:
+        return sum(estimate_tokens(turn["content"]) for turn in turns)
@@ -0,0 +1,100 @@
+import json
+import logging
+import os
+import sys
+import time
+from functools import wraps
+from typing import Any, Callable, Dict, List, Optional
+
+# Configure logging
+logger = logging.getLogger()
+
+# Buffered telemetry for the Lambda handlers.
+#
+# Events are appended to an in-memory buffer on the request path (no
+# serialization, no logging calls) and written once per invocation as
+# CloudWatch Embedded Metric Format records. Any callable that accepts a list
+# of EMF records can replace the default stdout sink.
+
+TELEMETRY_NAMESPACE = os.environ.get('TELEMETRY_NAMESPACE', 'StayFitHQ')
+TELEMETRY_MAX_BUFFERED_EVENTS = int(os.environ.get('TELEMETRY_MAX_BUFFERED_EVENTS', '100'))
+
+Sink = Callable[[List[Dict[str, Any]]], None]
+
+
+def emf_stdout_sink(records: List[Dict[str, Any]]):
+    """
+    Write EMF records to stdout, where the Lambda log agent extracts the metrics
+    """
+    sys.stdout.write("".join(json.dumps(record, default=str) + "\n" for record in records))
+    sys.stdout.flush()
+
+
+class TelemetryBuffer:
+    """
+    Collect usage and interaction events and emit them in batches
+    """
+
+    def __init__(self, namespace: str = TELEMETRY_NAMESPACE, sink: Optional[Sink] = None,
+                 max_events: int = TELEMETRY_MAX_BUFFERED_EVENTS):
+        self.namespace = namespace
+        self.sink = sink or emf_stdout_sink
+        self.max_events = max_events
+        self._events: List[tuple] = []
+
+    def record(self, event_type: str, metrics: Optional[Dict[str, float]] = None,
+               dimensions: Optional[Dict[str, str]] = None, properties: Optional[Dict[str, Any]] = None,
+               units: Optional[Dict[str, str]] = None):
+        """
+        Buffer one event; metrics default to the Count unit
+        """
+        self._events.append((
+            int(time.time() * 1000), event_type, metrics or {}, dimensions or {}, properties or {}, units or {}
+        ))
+        if len(self._events) >= self.max_events:
+            self.flush()
+
+    def flush(self):
+        """
+        Emit all buffered events as EMF records
+        """
+        if not self._events:
+            return
+
+        events, self._events = self._events, []
+        try:
+            self.sink([self._to_emf(*event) for event in events])
+        except Exception as e:
+            logger.error(f"Error flushing telemetry: {str(e)}")
+
+    def flush_after(self, handler: Callable) -> Callable:
+        """
+        Decorate a Lambda handler so the buffer is flushed when the invocation ends
+        """
+        @wraps(handler)
+        def wrapper(event, context):
+            try:
+                return handler(event, context)
+            finally:
+                self.flush()
+        return wrapper
+
+    def _to_emf(self, timestamp: int, event_type: str, metrics: Dict[str, float], dimensions: Dict[str, str],
+                properties: Dict[str, Any], units: Dict[str, str]) -> Dict[str, Any]:
+        dimensions = dict(dimensions, EventType=event_type)
+        record = dict(properties)
+        record.update(dimensions)
+        record.update(metrics)
+        record["_aws"] = {
+            "Timestamp": timestamp,
+            "CloudWatchMetrics": [{
+                "Namespace": self.namespace,
+                "Dimensions": [list(dimensions.keys())],
+                "Metrics": [{"Name": name, "Unit": units.get(name, "Count")} for name in metrics]
+            }]
+        }
+        return record
+
+
+# Shared per-container buffer
+telemetry = TelemetryBuffer()
@@ -0,0 +1,57 @@
+"""
+Time fallback rendering against the concatenate-and-replace approach it replaced
+
+Run `python tests/benchmark_fallback_templates.py` from infrastructure/lambda.
+"""
+import os
+import sys
+import timeit
+from typing import Dict, List
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fallback_templates import FALLBACK_RESPONSES, render_fallback  # noqa: E402
+
+DISCLAIMER = "Remember to consult your healthcare provider for medical advice."
+LEGACY_RESPONSES = {name: text.replace("{data_points}", "") for name, text in FALLBACK_RESPONSES.items()}
+
+HEALTH_CONTEXT = [
+    {"type": "heart_rate", "value": 72, "unit": "bpm", "context": "resting"},
+    {"type": "steps", "value": 8247, "unit": "steps", "context": "daily total"},
+    {"type": "sleep", "value": 7.5, "unit": "hours", "context": "last night"},
+    {"type": "resting_heart_rate", "value": 58, "unit": "bpm", "context": "7 day average"}
+]
+
+
+def legacy_fallback(response_type: str, health_context: List[Dict]) -> str:
+    # The lambdas' original rendering: three hard-coded types, spliced in before the disclaimer
+    base_response = LEGACY_RESPONSES[response_type]
+    if health_context and response_type != "general":
+        context_info = "\n\nBased on your recent data:\n"
+        for data in health_context[:3]:
+            if data['type'] == 'heart_rate' and response_type == "heart_rate":
+                context_info += f"• Heart rate: {data['value']} bpm ({data['context']})\n"
+            elif data['type'] == 'steps' and response_type == "activity":
+                context_info += f"• Daily steps: {data['value']:,} steps\n"
+            elif data['type'] == 'sleep' and response_type == "sleep":
+                context_info += f"• Sleep duration: {data['value']} hours\n"
+        if context_info != "\n\nBased on your recent data:\n":
+            base_response = base_response.replace(DISCLAIMER, context_info + "\n" + DISCLAIMER)
+    return base_response
+
+
+def main():
+    number = 100000
+    print(f"{'response':>10}  {'legacy':>12}  {'bullets':>7}  {'current':>12}  {'bullets':>7}")
+    for response_type in ("heart_rate", "activity", "sleep", "general"):
+        columns = []
+        for render in (legacy_fallback, render_fallback):
+            timing = min(timeit.repeat(lambda: render(response_type, HEALTH_CONTEXT),
+                                       number=number, repeat=3)) / number * 1e6
+            bullets = render(response_type, HEALTH_CONTEXT).count("•") - LEGACY_RESPONSES[response_type].count("•")
+            columns.append(f"{timing:>9.2f} us  {bullets:>7}")
+        print(f"{response_type:>10}  " + "  ".join(columns))
+
+
+if __name__ == "__main__":
+    main()
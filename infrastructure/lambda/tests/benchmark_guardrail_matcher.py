@@ -0,0 +1,51 @@
+"""
+Time the guardrail matcher's single-regex and grouped scans across message sizes
+
+Run `python tests/benchmark_guardrail_matcher.py` from infrastructure/lambda; the
+faster column at each size shows where LONG_MESSAGE_CHARS should sit.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import guardrail_matcher  # noqa: E402
+from guardrail_matcher import HEALTH_ASSISTANT_CATEGORIES, classify_message  # noqa: E402
+
+SENTENCES = {
+    "matching": "I walked a lot today and my resting pulse felt higher than usual after lunch. ",
+    "no keywords": "The quick brown fox jumps over the lazy dog while the sun shines brightly above. ",
+    "near misses": "My interest in the restaurant was the heartiest, and the stepladder was secure. "
+}
+
+
+def substring_classify(message: str):
+    # What the lambdas did before the matcher: per-category substring scans without word boundaries
+    message_lower = message.lower()
+    return {category: True for category, keywords in HEALTH_ASSISTANT_CATEGORIES.items()
+            if any(keyword.rstrip("*") in message_lower for keyword in keywords)}
+
+
+def time_us(classify, message: str) -> float:
+    number = max(3, 20000 // len(message))
+    return min(timeit.repeat(lambda: classify(message), number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    threshold = guardrail_matcher.LONG_MESSAGE_CHARS
+    print(f"LONG_MESSAGE_CHARS = {threshold}")
+    print(f"{'message':>12}  {'chars':>7}  {'substring':>12}  {'single':>12}  {'grouped':>12}")
+    for name, sentence in SENTENCES.items():
+        for repeats in (1, 3, 10, 30, 100, 1000):
+            message = sentence * repeats
+            timings = [time_us(substring_classify, message)]
+            for forced_threshold in (len(message) + 1, 0):
+                guardrail_matcher.LONG_MESSAGE_CHARS = forced_threshold
+                timings.append(time_us(classify_message, message))
+            guardrail_matcher.LONG_MESSAGE_CHARS = threshold
+            print(f"{name:>12}  {len(message):>7}  " + "  ".join(f"{timing:>9.1f} us" for timing in timings))
+
+
+if __name__ == "__main__":
+    main()
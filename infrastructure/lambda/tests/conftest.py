@@ -0,0 +1,5 @@
+import os
+import sys
+
+# Lambda modules are deployed flat, so tests import them from the parent directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
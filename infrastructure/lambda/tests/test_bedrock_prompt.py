@@ -0,0 +1,51 @@
+import json
+
+from bedrock_prompt import (CACHE_POINT, CACHE_POINT_JSON, REQUEST_TEMPLATE, build_claude_request,
+                            encode_claude_request, strip_cache_points)
+
+HISTORY = [
+    {"role": "user", "content": "How did I sleep last week?"},
+    {"role": "assistant", "content": "You averaged 7 hours a night."}
+]
+
+
+def cached_texts(request):
+    blocks = list(request["system"])
+    for message in request["messages"]:
+        blocks.extend(message["content"])
+    return [block["text"] for block in blocks if block.get("cache_control") == CACHE_POINT]
+
+
+def test_first_turn_caches_only_the_system_prompt():
+    request = build_claude_request("What was my heart rate?", "Heart rate: 64 bpm")
+    assert cached_texts(request) == [REQUEST_TEMPLATE["system"][0]["text"]]
+    assert [block["text"] for block in request["messages"][0]["content"]] == [
+        "Heart rate: 64 bpm", "User question: What was my heart rate?"
+    ]
+
+
+def test_context_and_question_follow_the_cached_history():
+    request = build_claude_request("And this week?", "Sleep: 6.5 hours", history=HISTORY, summary="Earlier: steps")
+    messages = request["messages"]
+    assert [message["role"] for message in messages] == ["user", "assistant", "user"]
+    assert [block["text"] for block in messages[0]["content"]] == ["Earlier: steps", HISTORY[0]["content"]]
+    assert cached_texts(request)[-1] == HISTORY[1]["content"]
+    assert [block["text"] for block in messages[-1]["content"]] == ["Sleep: 6.5 hours", "User question: And this week?"]
+
+
+def test_cached_prefix_is_unchanged_on_the_next_turn():
+    first = build_claude_request("And this week?", "Sleep: 6.5 hours", history=HISTORY)
+    turns = HISTORY + [{"role": "user", "content": "And this week?"}, {"role": "assistant", "content": "6.5 hours."}]
+    second = build_claude_request("Why?", "Sleep: 6.4 hours", history=turns)
+    prefix = first["messages"][:len(HISTORY)]
+    prefix[-1] = dict(prefix[-1], content=[{"type": "text", "text": HISTORY[1]["content"]}])
+    assert second["messages"][:len(HISTORY)] == prefix
+
+
+def test_encoded_request_matches_json_and_strips_cleanly():
+    request = build_claude_request("Why?", "Sleep: 6.4 hours", history=HISTORY)
+    body = encode_claude_request(request)
+    assert json.loads(body) == request
+    stripped = json.loads(strip_cache_points(body))
+    assert CACHE_POINT_JSON not in json.dumps(stripped)
+    assert stripped["messages"][-1] == request["messages"][-1]
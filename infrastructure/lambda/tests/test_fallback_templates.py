@@ -0,0 +1,39 @@
+import pytest
+
+from fallback_templates import DATA_POINTS_HEADER, FALLBACK_RESPONSES, render_fallback
+
+HEALTH_CONTEXT = [
+    {"type": "heart_rate", "value": 64, "unit": "bpm", "context": "resting"},
+    {"type": "steps", "value": 12034, "unit": "steps", "context": "daily total"},
+    {"type": "sleep", "value": 6.25, "unit": "hours", "context": "last night"},
+    {"type": "body_temperature", "value": 36.6, "unit": "C"}
+]
+
+
+@pytest.mark.parametrize("response_type", sorted(FALLBACK_RESPONSES))
+def test_without_context_only_the_slot_is_removed(response_type):
+    response = render_fallback(response_type)
+    assert response == FALLBACK_RESPONSES[response_type].replace("{data_points}", "")
+    assert DATA_POINTS_HEADER not in response
+    assert response.endswith("Remember to consult your healthcare provider for medical advice.")
+
+
+@pytest.mark.parametrize("response_type, expected", [
+    ("heart_rate", "• Heart rate: 64 bpm (resting)\n"),
+    ("activity", "• Daily steps: 12,034 steps (daily total)\n"),
+    ("sleep", "• Sleep duration: 6.2 hours (last night)\n")
+])
+def test_topical_responses_show_only_their_readings(response_type, expected):
+    response = render_fallback(response_type, HEALTH_CONTEXT)
+    assert DATA_POINTS_HEADER + expected + "\n" in response
+    assert response.count("•") == FALLBACK_RESPONSES[response_type].count("•") + 1
+
+
+def test_general_response_shows_any_reading_type():
+    response = render_fallback("general", HEALTH_CONTEXT[2:])
+    assert "• Sleep duration: 6.2 hours (last night)\n" in response
+    assert "• Body temperature: 36.6 C\n" in response
+
+
+def test_unknown_response_types_use_the_general_template():
+    assert render_fallback("nutrition") == render_fallback("general")
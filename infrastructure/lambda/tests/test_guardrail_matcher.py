@@ -0,0 +1,57 @@
+import pytest
+
+import guardrail_matcher
+from guardrail_matcher import HEALTH_ASSISTANT_CATEGORIES, LONG_MESSAGE_CHARS, KeywordMatcher, classify_message
+
+MESSAGES = [
+    "What medication should I take for my headache?",
+    "I want to end my life",
+    "Thoughts of self-harming again",
+    "My resting pulse was 58 bpm after a restful night",
+    "The website is secure and my interest in the restaurant is high",
+    "Which drugstore sells cures? I was cured last year",
+    "Steps, steps and more walking; no stepladder needed",
+    "Emergencies happen; this is an emergency"
+]
+
+
+def normalized(matches):
+    return {category: sorted(keywords) for category, keywords in matches.items()}
+
+
+@pytest.mark.parametrize("message", MESSAGES)
+def test_long_message_scan_finds_the_same_keywords(monkeypatch, message):
+    short = classify_message(message)
+    padded = message + " filler" * (LONG_MESSAGE_CHARS // 7 + 1)
+    assert len(padded) >= LONG_MESSAGE_CHARS
+    assert normalized(classify_message(padded)) == normalized(short)
+
+    # The grouped scan must agree on the message alone, too
+    monkeypatch.setattr(guardrail_matcher, "LONG_MESSAGE_CHARS", 0)
+    assert normalized(classify_message(message)) == normalized(short)
+
+
+@pytest.mark.parametrize("message, category, expected", [
+    ("What medication should I take?", "medical", True),
+    ("Is this cure safe?", "medical", True),
+    ("The connection is secure", "medical", False),
+    ("I feel like I want to kill myself", "harmful", True),
+    ("My heartrate spiked", "heart_rate", True),
+    ("I took a rest", "sleep", True),
+    ("Great interest rates", "sleep", False)
+])
+def test_keywords_respect_word_boundaries(message, category, expected):
+    for text in (message, message + " ." * LONG_MESSAGE_CHARS):
+        assert (category in classify_message(text)) is expected
+
+
+def test_shorter_keywords_carry_their_categories():
+    matcher = KeywordMatcher({"short": ["self*"], "long": ["self-harm*"]})
+    assert set(matcher.match("self-harm")) == {"short", "long"}
+    assert set(matcher.match("self-harm" + " ." * LONG_MESSAGE_CHARS)) == {"short", "long"}
+
+
+def test_every_category_is_reachable():
+    for category, keywords in HEALTH_ASSISTANT_CATEGORIES.items():
+        text = " ".join(keyword.rstrip("*") for keyword in keywords)
+        assert category in classify_message(text)
@@ -0,0 +1,164 @@
+from typing import Dict, List
+
+import pytest
+
+from bedrock_prompt import CACHE_POINT_JSON, build_claude_request, encode_claude_request
+from model_router import AllModelsUnavailableError, ModelRouter, is_retryable_error, supports_prompt_caching
+from telemetry import telemetry
+
+PRIMARY, ALTERNATE, FAST = "model-large", "model-alternate", "model-fast"
+FACTUAL = "What was my resting heart rate yesterday?"
+OPEN_ENDED = "Explain how my sleep compares to last month"
+
+
+class StubClientError(Exception):
+    def __init__(self, code: str, status: int):
+        super().__init__(f"{code}: stubbed")
+        self.response = {"Error": {"Code": code}, "ResponseMetadata": {"HTTPStatusCode": status}}
+
+
+class StubBedrockClient:
+    def __init__(self):
+        self.errors: Dict[str, Exception] = {}
+        self.calls: List[str] = []
+        self.bodies: Dict[str, str] = {}
+
+    def invoke_model(self, modelId: str, body: str, **kwargs):
+        self.calls.append(modelId)
+        self.bodies[modelId] = body
+        if modelId in self.errors:
+            raise self.errors[modelId]
+        return {"body": modelId}
+
+
+class StubClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+@pytest.fixture(autouse=True)
+def silent_telemetry(monkeypatch):
+    monkeypatch.setattr(telemetry, "sink", lambda records: None)
+
+
+@pytest.fixture
+def client():
+    return StubBedrockClient()
+
+
+@pytest.fixture
+def clock():
+    return StubClock()
+
+
+@pytest.fixture
+def router(client, clock):
+    return ModelRouter([PRIMARY, ALTERNATE], fast_model_id=FAST, client=client,
+                       breaker_options={"clock": clock, "minimum_calls": 6, "base_backoff_seconds": 10})
+
+
+def open_breaker(router, client, model_id):
+    client.errors = {model_id: StubClientError("ServiceUnavailableException", 503)}
+    while router.breakers[model_id].state != "open":
+        router.invoke("{}", OPEN_ENDED)
+
+
+def test_short_factual_questions_route_to_the_fast_model_first(router, client):
+    assert router.route(FACTUAL) == ("fast", [FAST, PRIMARY, ALTERNATE])
+    assert router.invoke("{}", FACTUAL)[0] == FAST
+    assert client.calls == [FAST]
+
+
+def test_open_ended_questions_follow_the_configured_order(router, client):
+    assert router.route(OPEN_ENDED) == ("default", [PRIMARY, ALTERNATE, FAST])
+    assert router.invoke("{}", OPEN_ENDED)[0] == PRIMARY
+
+
+@pytest.mark.parametrize("error", [
+    StubClientError("ThrottlingException", 429),
+    StubClientError("InternalServerException", 500),
+    StubClientError("ModelTimeoutException", 408),
+    TimeoutError("read timed out")
+])
+def test_retryable_errors_fail_over_to_the_next_model(router, client, error):
+    assert is_retryable_error(error)
+    client.errors = {PRIMARY: error}
+    assert router.invoke("{}", OPEN_ENDED)[0] == ALTERNATE
+    assert client.calls == [PRIMARY, ALTERNATE]
+    assert router.stats[PRIMARY].errors == 1
+
+
+@pytest.mark.parametrize("code, status", [("ValidationException", 400), ("AccessDeniedException", 403)])
+def test_client_errors_are_reraised_without_counting_against_the_breaker(router, client, code, status):
+    error = StubClientError(code, status)
+    assert not is_retryable_error(error)
+    client.errors = {PRIMARY: error}
+    with pytest.raises(StubClientError):
+        router.invoke("{}", OPEN_ENDED)
+    assert client.calls == [PRIMARY]
+    assert router.stats[PRIMARY].errors == 0
+    assert router.breakers[PRIMARY].state == "closed"
+
+
+def test_breaker_opens_per_model_and_skips_only_that_model(router, client):
+    open_breaker(router, client, PRIMARY)
+    assert router.breakers[ALTERNATE].state == "closed"
+    assert router.breakers[FAST].state == "closed"
+
+    client.calls = []
+    assert router.invoke("{}", OPEN_ENDED)[0] == ALTERNATE
+    assert client.calls == [ALTERNATE]
+
+
+def test_half_open_probe_closes_the_breaker_on_success(router, client, clock):
+    open_breaker(router, client, PRIMARY)
+    clock.now += 10
+    client.errors, client.calls = {}, []
+    assert router.invoke("{}", OPEN_ENDED)[0] == PRIMARY
+    assert router.breakers[PRIMARY].state == "closed"
+
+
+def test_client_error_releases_the_half_open_probe(router, client, clock):
+    open_breaker(router, client, PRIMARY)
+    clock.now += 10
+    client.errors = {PRIMARY: StubClientError("ValidationException", 400)}
+    with pytest.raises(StubClientError):
+        router.invoke("{}", OPEN_ENDED)
+    assert router.breakers[PRIMARY].state == "half_open"
+
+    client.errors = {}
+    assert router.invoke("{}", OPEN_ENDED)[0] == PRIMARY
+    assert router.breakers[PRIMARY].state == "closed"
+
+
+def test_every_model_failing_raises_all_models_unavailable(router, client):
+    client.errors = {model_id: StubClientError("ThrottlingException", 429) for model_id in (PRIMARY, ALTERNATE, FAST)}
+    with pytest.raises(AllModelsUnavailableError):
+        router.invoke("{}", OPEN_ENDED)
+    assert client.calls == [PRIMARY, ALTERNATE, FAST]
+
+
+@pytest.mark.parametrize("model_id, expected", [
+    ("anthropic.claude-3-5-haiku-20241022-v1:0", True),
+    ("us.anthropic.claude-3-7-sonnet-20250219-v1:0", True),
+    ("anthropic.claude-3-5-sonnet-20240620-v1:0", False),
+    ("anthropic.claude-3-haiku-20240307-v1:0", False)
+])
+def test_prompt_caching_support_by_model_id(model_id, expected):
+    assert supports_prompt_caching(model_id) is expected
+
+
+def test_cache_points_are_sent_only_to_caching_models(client, clock):
+    router = ModelRouter([PRIMARY, ALTERNATE], fast_model_id=FAST, client=client,
+                         breaker_options={"clock": clock}, caching_models=[ALTERNATE])
+    history = [{"role": "user", "content": "How did I sleep?"}, {"role": "assistant", "content": "7 hours."}]
+    body = encode_claude_request(build_claude_request(OPEN_ENDED, "Sleep: 7h", history=history))
+    assert body.count(CACHE_POINT_JSON) == 2
+
+    client.errors = {PRIMARY: StubClientError("ThrottlingException", 429)}
+    router.invoke(body, OPEN_ENDED)
+    assert CACHE_POINT_JSON not in client.bodies[PRIMARY]
+    assert client.bodies[ALTERNATE] == body
@@ -0,0 +1,71 @@
+import re
+from typing import Any, Dict, List, Optional
+
+# Token accounting for Perplexity and Bedrock calls.
+#
+# Upstream `usage` blocks are authoritative: Perplexity reports OpenAI-style
+# prompt_tokens/completion_tokens and Bedrock Anthropic models report
+# input_tokens/output_tokens. When neither is present the counts fall back to a
+# fast local approximation of BPE tokenization.
+
+# Words, runs of up to three digits, and single punctuation characters
+TOKEN_PATTERN = re.compile(r"[^\W\d_]+|\d{1,3}|[^\w\s]|_")
+
+# Tokens added by the chat format for each message (role, separators)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    Approximate the BPE token count of a string without a tokenizer model
+    """
+    if not text:
+        return 0
+
+    tokens = 0
+    for piece in TOKEN_PATTERN.findall(text):
+        # Common short words are a single token; longer words split every ~4 chars
+        tokens += 1 if len(piece) <= 6 else (len(piece) + 3) // 4
+    return tokens
+
+
+def estimate_message_tokens(messages: Optional[List[Dict[str, Any]]]) -> int:
+    """
+    Approximate the prompt tokens of a chat message list
+    """
+    total = 0
+    for message in messages or []:
+        content = message.get("content", "")
+        if isinstance(content, list):
+            content = " ".join(block.get("text", "") for block in content if isinstance(block, dict))
+        total += MESSAGE_OVERHEAD_TOKENS + estimate_tokens(str(content))
+    return total
+
+
+def extract_usage(response_data: Dict[str, Any], prompt_messages: Optional[List[Dict[str, Any]]] = None,
+                  completion_text: Optional[str] = None) -> Dict[str, Any]:
+    """
+    Return input/output token counts, preferring the upstream usage fields
+    """
+    usage = response_data.get("usage") or {}
+
+    input_tokens = usage.get("prompt_tokens", usage.get("input_tokens"))
+    output_tokens = usage.get("completion_tokens", usage.get("output_tokens"))
+    source = "upstream"
+
+    if input_tokens is None:
+        input_tokens = estimate_message_tokens(prompt_messages)
+        source = "estimated"
+    if output_tokens is None:
+        output_tokens = estimate_tokens(completion_text)
+        source = "estimated"
+
+    return {
+        "input_tokens": int(input_tokens),
+        "output_tokens": int(output_tokens),
+        "total_tokens": int(input_tokens) + int(output_tokens),
+        # Prompt-cache segments (Bedrock Anthropic models); zero when caching is not in play
+        "cache_read_input_tokens": int(usage.get("cache_read_input_tokens") or 0),
+        "cache_write_input_tokens": int(usage.get("cache_creation_input_tokens") or 0),
+        "source": source
+    }
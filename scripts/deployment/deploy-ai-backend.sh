@@ -81,8 +81,8 @@ mkdir -p lambda-packages
 
 # Package Bedrock Health Assistant
 cd lambda
-zip -r ../lambda-packages/bedrock-health-assistant.zip bedrock-health-assistant.py
-zip -r ../lambda-packages/opensearch-health-indexer.zip opensearch-health-indexer.py
+zip -r ../lambda-packages/bedrock-health-assistant.zip bedrock-health-assistant.py *_*.py
+zip -r ../lambda-packages/opensearch-health-indexer.zip opensearch-health-indexer.py *_*.py
 cd ..
 
 echo_success "Lambda packages created"